@@ -2,28 +2,52 @@
 from __future__ import absolute_import, division, print_function
 
 from collections import defaultdict
+from functools import lru_cache
+import multiprocessing
 import tempfile
-import copy
 import json
 import os
+import pickle
 import urllib
 import bz2
 from os.path import join, isdir
 import sys
+import time
 import tqdm
 import re
 import requests
-from packaging.version import parse as parse_version
-from concurrent.futures import ProcessPoolExecutor, as_completed
-
-from conda_index.index import _apply_instructions
-from show_diff import show_record_diffs
-from get_license_family import get_license_family
+from concurrent.futures import ProcessPoolExecutor
+
+from show_diff import (
+    apply_instructions_view,
+    instructions_record_diffs,
+    iter_repodata_records,
+    load_patch_instructions,
+    print_spilled_diffs,
+    show_record_diffs,
+    spill_record_diffs,
+)
+from get_license_family import get_license_family, save_license_families
+from record_store import cow_index, dirty_keys, materialize_index
+from subdir_schedule import (
+    SubdirScheduler,
+    estimate_costs,
+    log_schedule,
+    max_memory,
+    read_stats,
+    repodata_sizes,
+    run_stats,
+    schedule_order,
+    write_stats,
+)
 from patch_yaml_utils import (
     patch_yaml_edit_index,
+    is_format_sensitive,
     _relax_exact,
+    ARTIFACT_KEYS,
     CB_PIN_REGEX,
     pad_list,
+    VersionOrdinals,
 )
 
 CHANNEL_NAME = "conda-forge"
@@ -317,7 +341,19 @@ OSX_SDK_FIXES = {
 }
 
 
-def _add_pybind11_abi_constraint(fn, record):
+# version constants compared against in the python patches below, ranked
+# together with the record versions of each subdir
+VERSION_CONSTANTS = (
+    "2.2.0",
+    "2.2.4",
+    "2.3.0",
+    "2.5.0",
+    "2.6.1",
+    "14.29.30037",
+)
+
+
+def _add_pybind11_abi_constraint(fn, record, versions=None):
     """the pybind11-abi package uses the internals version
 
     here are the ranges
@@ -342,17 +378,19 @@ def _add_pybind11_abi_constraint(fn, record):
 
     prior to 2.2.0 we set it to 0
     """
-    ver = parse_version(record["version"])
+    if versions is None:
+        versions = VersionOrdinals()
+    ver = record["version"]
 
-    if ver < parse_version("2.2.0"):
+    if versions.compare(ver, "2.2.0") < 0:
         abi_ver = "0"
-    elif ver < parse_version("2.2.4"):
+    elif versions.compare(ver, "2.2.4") < 0:
         abi_ver = "1"
-    elif ver < parse_version("2.3.0"):
+    elif versions.compare(ver, "2.3.0") < 0:
         abi_ver = "2"
-    elif ver < parse_version("2.5.0"):
+    elif versions.compare(ver, "2.5.0") < 0:
         abi_ver = "3"
-    elif ver <= parse_version("2.6.1"):
+    elif versions.compare(ver, "2.6.1") <= 0:
         abi_ver = "4"
     else:
         # past this we should have a constrains there already
@@ -489,6 +527,55 @@ def remove_python_abi(record):
 changes = set([])
 
 
+@lru_cache(maxsize=None)
+def _python_abi_constrains(python_deps, subdir, build_python):
+    """Return the constrains ``add_python_abi`` adds for a record and the
+    ``changes`` they make, as tuples.
+
+    ``python_deps`` are the ``python`` specs of the record's depends and
+    ``build_python`` is the ``XY`` of the last ``pyXY`` in its build string
+    (or None), which is all ``get_python_abi`` reads from it. Few distinct
+    combinations exist in a subdir, so the results are cached and shared.
+    """
+    build = None if build_python is None else "py" + build_python
+    new_constrains = []
+    new_changes = []
+    ver_strict_found = False
+    ver_relax_found = False
+
+    for dep in python_deps:
+        dep_split = dep.split(" ")
+        python_abi = None
+        if len(dep_split) == 3:
+            continue
+        if len(dep_split) == 1:
+            continue
+        elif dep_split[1] == "<3":
+            python_abi = get_python_abi("2.7", subdir, build)
+        elif dep_split[1].startswith(">="):
+            m = CB_PIN_REGEX.match(dep_split[1])
+            if m is None:
+                python_abi = get_python_abi("", subdir, build)
+            else:
+                lower = pad_list(m.group("lower").split("."), 2)[:2]
+                upper = pad_list(m.group("upper").split("."), 2)[:2]
+                if lower[0] == upper[0] and int(lower[1]) + 1 == int(upper[1]):
+                    python_abi = get_python_abi(m.group("lower"), subdir, build)
+                else:
+                    python_abi = get_python_abi("", subdir, build)
+        else:
+            python_abi = get_python_abi(dep_split[1], subdir, build)
+        if python_abi:
+            new_constrains.append(f"python_abi * *_{python_abi}")
+            new_changes.append((dep, f"python_abi * *_{python_abi}"))
+            ver_strict_found = True
+        else:
+            ver_relax_found = True
+    if not ver_strict_found and ver_relax_found:
+        new_constrains.append("pypy <0a0")
+    return tuple(new_constrains), tuple(new_changes)
+
+
 def add_python_abi(record, subdir):
     record_name = record["name"]
     # Make existing python and python-dependent packages conflict with pypy
@@ -505,53 +592,436 @@ def add_python_abi(record, subdir):
         and not has_dep(record, "pypy")
         and not has_dep(record, "python_abi")
     ):
-        python_abi = None
+        python_deps = tuple(
+            dep for dep in record.get("depends", []) if dep.split(" ")[0] == "python"
+        )
+        m = re.match(r".*py\d\d", record["build"])
+        build_python = m.group()[-2:] if m else None
+        python_abi_constrains, python_abi_changes = _python_abi_constrains(
+            python_deps, subdir, build_python
+        )
+        changes.update(python_abi_changes)
         new_constrains = record.get("constrains", [])
-        build = record["build"]
-        ver_strict_found = False
-        ver_relax_found = False
-
-        for dep in record.get("depends", []):
-            dep_split = dep.split(" ")
-            if dep_split[0] == "python":
-                if len(dep_split) == 3:
-                    continue
-                if len(dep_split) == 1:
-                    continue
-                elif dep_split[1] == "<3":
-                    python_abi = get_python_abi("2.7", subdir, build)
-                elif dep_split[1].startswith(">="):
-                    m = CB_PIN_REGEX.match(dep_split[1])
-                    if m is None:
-                        python_abi = get_python_abi("", subdir, build)
-                    else:
-                        lower = pad_list(m.group("lower").split("."), 2)[:2]
-                        upper = pad_list(m.group("upper").split("."), 2)[:2]
-                        if lower[0] == upper[0] and int(lower[1]) + 1 == int(upper[1]):
-                            python_abi = get_python_abi(m.group("lower"), subdir, build)
-                        else:
-                            python_abi = get_python_abi("", subdir, build)
-                else:
-                    python_abi = get_python_abi(dep_split[1], subdir, build)
-                if python_abi:
-                    new_constrains.append(f"python_abi * *_{python_abi}")
-                    changes.add((dep, f"python_abi * *_{python_abi}"))
-                    ver_strict_found = True
-                else:
-                    ver_relax_found = True
-        if not ver_strict_found and ver_relax_found:
-            new_constrains.append("pypy <0a0")
+        new_constrains.extend(python_abi_constrains)
         record["constrains"] = new_constrains
 
 
-def _gen_new_index_per_key(repodata, subdir, index_key):
+# The hardcoded patches of _gen_new_index_per_key, in the order they are
+# applied. Each is registered with the package names it can apply to, see
+# _record_handler.
+RECORD_HANDLERS = []
+
+LINUX_SYSROOT_SUBDIRS = ["linux-64", "linux-aarch64", "linux-ppc64le"]
+CDT_SUFFIXES = ["-cos6-x86_64", "-cos7-x86_64", "-cos7-aarch64", "-cos7-ppc64le"]
+
+
+def _record_handler(names=None, suffixes=None, subdirs=None):
+    """Register a patch ``handler(fn, record, subdir, deps, versions)`` for
+    ``_gen_new_index_per_key``.
+
+    ``names`` is a list of package names, or a function of the subdir
+    returning one, and ``suffixes`` a list of package name suffixes the
+    handler can apply to; without either, it applies to every record.
+    ``subdirs`` restricts the handler to these subdirs. ``deps`` is the
+    ``depends`` of the record before any of the handlers ran.
+    """
+
+    def _register(handler):
+        RECORD_HANDLERS.append((handler, names, suffixes, subdirs))
+        return handler
+
+    return _register
+
+
+class HandlerTable:
+    """The ``RECORD_HANDLERS`` of one subdir keyed by package name.
+
+    Handlers for exact names are looked up in a dict, handlers for name
+    suffixes are tested against the name, and ``handlers`` merges them with
+    the handlers for every record in registration order.
+    """
+
+    def __init__(self, subdir):
+        self.by_name = defaultdict(list)
+        self.by_suffix = []
+        self.every = []
+        self._handlers = {}
+        for pos, (handler, names, suffixes, subdirs) in enumerate(RECORD_HANDLERS):
+            if subdirs is not None and subdir not in subdirs:
+                continue
+            if callable(names):
+                names = names(subdir)
+            if names is not None:
+                for name in set(names):
+                    self.by_name[name].append((pos, handler))
+            elif suffixes is not None:
+                self.by_suffix.append((pos, handler, tuple(suffixes)))
+            else:
+                self.every.append((pos, handler))
+
+    def handlers(self, name):
+        """Return the handlers that can apply to the package ``name``."""
+        if name not in self._handlers:
+            handlers = self.every + self.by_name.get(name, [])
+            handlers.extend(
+                (pos, handler)
+                for pos, handler, suffixes in self.by_suffix
+                if name.endswith(suffixes)
+            )
+            handlers.sort(key=lambda pos_handler: pos_handler[0])
+            self._handlers[name] = [handler for _, handler in handlers]
+        return self._handlers[name]
+
+
+@lru_cache(maxsize=None)
+def handler_table(subdir):
+    """Return the ``HandlerTable`` of ``subdir``."""
+    return HandlerTable(subdir)
+
+
+########################################
+# Ecosystem-wide patches for changes in
+# metapackages, etc.
+# Generally managed by conda-forge/core
+########################################
+
+
+@_record_handler()
+def _add_license_family(fn, record, subdir, deps, versions):
+    if "license" in record and "license_family" not in record and record["license"]:
+        family = get_license_family(record["license"])
+        if family:
+            record["license_family"] = family
+
+
+@_record_handler()
+def _fix_python_abi(fn, record, subdir, deps, versions):
+    if record.get("timestamp", 0) < 1604417730000:
+        if subdir == "noarch":
+            remove_python_abi(record)
+        else:
+            add_python_abi(record, subdir)
+
+
+# add track_features to old python_abi pypy packages
+@_record_handler(names=["python_abi"])
+def _add_pypy_abi_track_feature(fn, record, subdir, deps, versions):
+    if "pypy" in record["build"] and "track_features" not in record:
+        record["track_features"] = "pypy"
+
+
+# replace =2.7 with ==2.7.* for compatibility with older conda
+@_record_handler()
+def _fix_single_equal_pins(fn, record, subdir, deps, versions):
+    new_deps = []
+    changed = False
+    for dep in record.get("depends", []):
+        dep_split = dep.split(" ")
+        if (
+            len(dep_split) == 2
+            and dep_split[1].startswith("=")
+            and not dep_split[1].startswith("==")
+        ):
+            split_or = dep_split[1].split("|")
+            split_or[0] = "=" + split_or[0] + ".*"
+            new_dep = dep_split[0] + " " + "|".join(split_or)
+            changed = True
+        else:
+            new_dep = dep
+        new_deps.append(new_dep)
+    if changed:
+        record["depends"] = new_deps
+
+
+# make sure pybind11 and pybind11-global have run constraints on
+# the abi metapackage
+# see https://github.com/conda-forge/conda-forge-repodata-patches-feedstock/issues/104  # noqa
+@_record_handler(names=["pybind11", "pybind11-global"])
+def _fix_pybind11_abi(fn, record, subdir, deps, versions):
+    if (
+        # this version has a constraint sometimes
+        versions.compare(record["version"], "2.6.1") <= 0
+        and not any(c.startswith("pybind11-abi ") for c in record.get("constrains", []))
+    ):
+        _add_pybind11_abi_constraint(fn, record, versions=versions)
+
+
+############################################
+# Compilers, Runtimes and Related Patches
+############################################
+
+
+@_record_handler(names=["vs2015_runtime"])
+def _fix_vs2015_runtime(fn, record, subdir, deps, versions):
+    if record.get("timestamp", 0) < 1633470721000:
+        if versions.compare(record["version"], "14.29.30037") < 0:
+            # make these conflict with ucrt
+            new_constrains = record.get("constrains", [])
+            new_constrains.append("ucrt <0a0")
+            record["constrains"] = new_constrains
+
+
+# fix only packages built before the run_exports was corrected.
+@_record_handler()
+def _fix_libflang(fn, record, subdir, deps, versions):
+    if (
+        any(dep == "libflang" or dep.startswith("libflang >=5.0.0") for dep in deps)
+        and record.get("timestamp", 0) < 1611789153000
+    ):
+        record["depends"].append("libflang <6.0.0.a0")
+
+
+@_record_handler(names=["clang", "clang-tools", "llvm", "llvm-tools", "llvmdev"])
+def _add_llvm_constrains(fn, record, subdir, deps, versions):
+    llvm_pkgs = ["clang", "clang-tools", "llvm", "llvm-tools", "llvmdev"]
+    record_name = record["name"]
+    new_constrains = record.get("constrains", [])
+    version = record["version"]
+    for pkg in llvm_pkgs:
+        if record_name == pkg:
+            continue
+        if pkg in new_constrains:
+            del new_constrains[pkg]
+        if any(constraint.startswith(f"{pkg} ") for constraint in new_constrains):
+            continue
+        new_constrains.append(f"{pkg} {version}.*")
+    record["constrains"] = new_constrains
+
+
+@_record_handler(names=lambda subdir: ["gcc_impl_" + subdir])
+def _relax_gcc_binutils(fn, record, subdir, deps, versions):
+    _relax_exact(fn, record, "binutils_impl_{}".format(subdir))
+
+
+# some symlinks changed in gfortran, so we need to adjust things
+# plus we missed a key version constraint
+@_record_handler(names=["gfortran"], subdirs=["osx-64", "osx-arm64"])
+def _fix_osx_gfortran(fn, record, subdir, deps, versions):
+    for i, dep in enumerate(record["depends"]):
+        if dep == f"gfortran_{subdir}":
+            record["depends"][i] = dep + " ==" + record["version"]
+
+
+# make sure the libgfortran version is bound from 3 to 4 for osx
+@_record_handler(subdirs=["osx-64"])
+def _fix_osx_libgfortran(fn, record, subdir, deps, versions):
+    _fix_libgfortran(fn, record)
+
+
+@_record_handler(names=["cctools", "ld64", "llvm-lto-tapi"], subdirs=["osx-64"])
+def _fix_osx_libcxx(fn, record, subdir, deps, versions):
+    _fix_libcxx(fn, record)
+
+
+@_record_handler(
+    names=[full_pkg_name.rsplit("-", 2)[0] for full_pkg_name in OSX_SDK_FIXES],
+    subdirs=["osx-64"],
+)
+def _fix_osx_sdk(fn, record, subdir, deps, versions):
+    full_pkg_name = fn.replace(".tar.bz2", "")
+    if full_pkg_name in OSX_SDK_FIXES:
+        _set_osx_virt_min(fn, record, OSX_SDK_FIXES[full_pkg_name])
+
+
+# when making the glibc 2.28 sysroots, we found we needed to go back
+# and add the current repodata hack packages to the cos7 sysroots
+# for aarch64, ppc64le and s390x
+@_record_handler(
+    names=[
+        prefix + __subdir
+        for __subdir in ["linux-s390x", "linux-aarch64", "linux-ppc64le"]
+        for prefix in ["kernel-headers_", "sysroot_"]
+    ]
+)
+def _add_sysroot_repodata_hack(fn, record, subdir, deps, versions):
+    __subdir = record["name"].split("_", 1)[1]
+    if (
+        record.get("timestamp", 0) < 1682273081000  # 2023-04-23
+        and record["version"] == "2.17"
+    ):
+        new_depends = record.get("depends", [])
+        new_depends.append("_sysroot_" + __subdir + "_curr_repodata_hack 4.*")
+        record["depends"] = new_depends
+
+
+# make old binutils packages conflict with the new sysroot packages
+# that have renamed the sysroot from conda_cos6 or conda_cos7 to just
+# conda
+@_record_handler(
+    names=lambda subdir: ["binutils", "binutils_impl_" + subdir, "ld_impl_" + subdir],
+    subdirs=LINUX_SYSROOT_SUBDIRS,
+)
+def _fix_old_binutils(fn, record, subdir, deps, versions):
+    if record.get("timestamp", 0) < 1589953178153:  # 2020-05-20
+        new_constrains = record.get("constrains", [])
+        new_constrains.append("sysroot_" + subdir + " ==99999999999")
+        record["constrains"] = new_constrains
+
+
+def _compiler_impl_names(subdir):
+    return ["gcc_impl_" + subdir, "gxx_impl_" + subdir, "gfortran_impl_" + subdir]
+
+
+# make sure the old compilers conflict with the new sysroot packages
+# and they only use libraries from the old compilers
+@_record_handler(names=_compiler_impl_names, subdirs=LINUX_SYSROOT_SUBDIRS)
+def _fix_old_compilers(fn, record, subdir, deps, versions):
+    if record["version"] in ["5.4.0", "7.2.0", "7.3.0", "8.2.0"]:
+        new_constrains = record.get("constrains", [])
+        for pkg in ["libgcc-ng", "libstdcxx-ng", "libgfortran", "libgomp"]:
+            new_constrains.append("{} 5.4.*|7.2.*|7.3.*|8.2.*|9.1.*|9.2.*".format(pkg))
+        new_constrains.append("binutils_impl_" + subdir + " <2.34")
+        new_constrains.append("ld_impl_" + subdir + " <2.34")
+        new_constrains.append("sysroot_" + subdir + " ==99999999999")
+        record["constrains"] = new_constrains
+
+
+# we pushed a few builds of the compilers past the list of versions
+# above which do not use the sysroot packages - this block catches those
+# it will also break some test builds of the new compilers but we should
+# not be using those anyways and they are marked as broken.
+@_record_handler(names=_compiler_impl_names, subdirs=LINUX_SYSROOT_SUBDIRS)
+def _fix_compilers_without_sysroot(fn, record, subdir, deps, versions):
+    if (
+        record["version"] not in ["5.4.0", "7.2.0", "7.3.0", "8.2.0"]
+        and not any(__r.startswith("sysroot_") for __r in record.get("depends", []))
+        and record.get("timestamp", 0) < 1626220800000  # 2020-07-14
+    ):
+        new_constrains = record.get("constrains", [])
+        new_constrains.append("sysroot_" + subdir + " ==99999999999")
+        record["constrains"] = new_constrains
+
+
+# all ctng activation packages that don't depend on the sysroot_*
+# packages are not compatible with the new sysroot_*-based compilers
+# root and cling must also be included as they have a builtin C++ interpreter
+@_record_handler(
+    names=lambda subdir: [
+        "gcc_" + subdir,
+        "gxx_" + subdir,
+        "gfortran_" + subdir,
+        "binutils_" + subdir,
+        "gcc_bootstrap_" + subdir,
+        "root_base",
+        "cling",
+    ],
+    subdirs=LINUX_SYSROOT_SUBDIRS,
+)
+def _fix_ctng_activation(fn, record, subdir, deps, versions):
+    if (
+        not any(__r.startswith("sysroot_") for __r in record.get("depends", []))
+        and record.get("timestamp", 0) < 1626220800000  # 2020-07-14
+    ):
+        new_constrains = record.get("constrains", [])
+        new_constrains.append("sysroot_" + subdir + " ==99999999999")
+        record["constrains"] = new_constrains
+
+
+@_record_handler(names=lambda subdir: ["gcc_impl_" + subdir])
+def _fix_gcc_impl_libgcc(fn, record, subdir, deps, versions):
+    if (
+        record["version"] in ["5.4.0", "7.2.0", "7.3.0", "8.2.0", "8.4.0", "9.3.0"]
+        and record.get("timestamp", 0) < 1627530043000  # 2021-07-29
+    ):
+        new_depends = record.get("depends", [])
+        new_depends.append("libgcc-ng <=9.3.0")
+        record["depends"] = new_depends
+
+
+# old CDTs with the conda_cos6 or conda_cos7 name in the sysroot need to
+# conflict with the new CDT and compiler packages
+# all of the new CDTs and compilers depend on the sysroot_{subdir} packages
+# so we use a constraint on those
+@_record_handler(suffixes=CDT_SUFFIXES, subdirs=["noarch"])
+def _fix_old_cdts(fn, record, subdir, deps, versions):
+    record_name = record["name"]
+    if not record_name.startswith("sysroot-") and not any(
+        __r.startswith("sysroot_") for __r in record.get("depends", [])
+    ):
+        if record_name.endswith("x86_64"):
+            sys_subdir = "linux-64"
+        elif record_name.endswith("aarch64"):
+            sys_subdir = "linux-aarch64"
+        elif record_name.endswith("ppc64le"):
+            sys_subdir = "linux-ppc64le"
+
+        new_constrains = record.get("constrains", [])
+        if not any(__r.startswith("sysroot_") for __r in new_constrains):
+            new_constrains.append("sysroot_" + sys_subdir + " ==99999999999")
+            record["constrains"] = new_constrains
+
+
+@_record_handler()
+def _relax_libllvm(fn, record, subdir, deps, versions):
+    llvm_pkgs = [
+        "libclang",
+        "clang",
+        "clang-tools",
+        "llvm",
+        "llvm-tools",
+        "llvmdev",
+    ]
+    for llvm in ["libllvm8", "libllvm9"]:
+        if any(dep.startswith(llvm) for dep in deps):
+            if record["name"] not in llvm_pkgs:
+                _relax_exact(fn, record, llvm, max_pin="x.x")
+            else:
+                _relax_exact(fn, record, llvm, max_pin="x.x.x")
+
+
+# Properly depend on clangdev 5.0.0 flang* for flang 5.0
+@_record_handler(names=["flang"])
+def _fix_flang_clangdev(fn, record, subdir, deps, versions):
+    deps = record["depends"]
+    if record["version"] == "5.0.0":
+        deps += ["clangdev * flang*"]
+
+
+# add as run_constrained for cling
+@_record_handler(names=["cling"])
+def _fix_cling_gxx(fn, record, subdir, deps, versions):
+    if record["version"] >= "0.8":
+        record.setdefault("constrains", []).extend(("gxx_linux-64 !=9.5.0",))
+
+
+############################################
+# Custom Patches that cannot be YAML-ized
+############################################
+
+# FIXME: disable patching-out blas_openblas feature
+# because hotfixes are not applied to gcc7 label
+# causing inconsistent behavior
+# if (record_name == "blas" and
+#         record["track_features"] == "blas_openblas"):
+#     instructions["packages"][fn]["track_features"] = None
+# if "features" in record:
+# if "blas_openblas" in record["features"]:
+#     # remove blas_openblas feature
+#     instructions["packages"][fn]["features"] = _extract_feature(
+#         record, "blas_openblas")
+#     if not any(d.startswith("blas ") for d in record["depends"]):
+#         depends = record['depends']
+#         depends.append("blas 1.* openblas")
+#         instructions["packages"][fn]["depends"] = depends
+
+
+def _gen_new_index_per_key(repodata, subdir, index_key, versions=None):
     """Make any changes to the index by adjusting the values directly.
 
     This function returns the new index with the adjustments.
     Finally, the new and old indices are then diff'ed to produce the repo
     data patches.
+
+    ``versions`` is the ``VersionOrdinals`` table of the subdir; it is built
+    from ``repodata[index_key]`` if not given.
+
+    The records of the new index are copy-on-write views of the records of
+    ``repodata``, see ``record_store``; ``materialize_index`` turns them into
+    plain dicts.
     """
-    index = copy.deepcopy(repodata[index_key])
+    index = cow_index(repodata[index_key])
+    if versions is None:
+        versions = VersionOrdinals.from_indexes(index, constants=VERSION_CONSTANTS)
 
     # deal with windows vc features
     if subdir.startswith("win-"):
@@ -585,302 +1055,109 @@ def _gen_new_index_per_key(repodata, subdir, index_key):
                         depends.append("vc %d.*" % vc_version)
                         record["depends"] = depends
 
+    table = handler_table(subdir)
     for fn, record in index.items():
-        record_name = record["name"]
         deps = record.get("depends", ())
+        for handler in table.handlers(record["name"]):
+            handler(fn, record, subdir, deps, versions)
 
-        ########################################
-        # Ecosystem-wide patches for changes in
-        # metapackages, etc.
-        # Generally managed by conda-forge/core
-        ########################################
-
-        if "license" in record and "license_family" not in record and record["license"]:
-            family = get_license_family(record["license"])
-            if family:
-                record["license_family"] = family
-
-        if record.get("timestamp", 0) < 1604417730000:
-            if subdir == "noarch":
-                remove_python_abi(record)
-            else:
-                add_python_abi(record, subdir)
-
-        # add track_features to old python_abi pypy packages
-        if (
-            record_name == "python_abi"
-            and "pypy" in record["build"]
-            and "track_features" not in record
-        ):
-            record["track_features"] = "pypy"
-
-        # replace =2.7 with ==2.7.* for compatibility with older conda
-        new_deps = []
-        changed = False
-        for dep in record.get("depends", []):
-            dep_split = dep.split(" ")
-            if (
-                len(dep_split) == 2
-                and dep_split[1].startswith("=")
-                and not dep_split[1].startswith("==")
-            ):
-                split_or = dep_split[1].split("|")
-                split_or[0] = "=" + split_or[0] + ".*"
-                new_dep = dep_split[0] + " " + "|".join(split_or)
-                changed = True
-            else:
-                new_dep = dep
-            new_deps.append(new_dep)
-        if changed:
-            record["depends"] = new_deps
-        del new_deps
-        del changed
-
-        # make sure pybind11 and pybind11-global have run constraints on
-        # the abi metapackage
-        # see https://github.com/conda-forge/conda-forge-repodata-patches-feedstock/issues/104  # noqa
-        if (
-            record_name in ["pybind11", "pybind11-global"]
-            # this version has a constraint sometimes
-            and (parse_version(record["version"]) <= parse_version("2.6.1"))
-            and not any(
-                c.startswith("pybind11-abi ") for c in record.get("constrains", [])
-            )
-        ):
-            _add_pybind11_abi_constraint(fn, record)
-
-        ############################################
-        # Compilers, Runtimes and Related Patches
-        ############################################
-
-        if (
-            record_name == "vs2015_runtime"
-            and record.get("timestamp", 0) < 1633470721000
-        ):
-            pversion = parse_version(record["version"])
-            vs2019_version = parse_version("14.29.30037")
-            if pversion < vs2019_version:
-                # make these conflict with ucrt
-                new_constrains = record.get("constrains", [])
-                new_constrains.append("ucrt <0a0")
-                record["constrains"] = new_constrains
-
-        # fix only packages built before the run_exports was corrected.
-        if (
-            any(dep == "libflang" or dep.startswith("libflang >=5.0.0") for dep in deps)
-            and record.get("timestamp", 0) < 1611789153000
-        ):
-            record["depends"].append("libflang <6.0.0.a0")
-
-        llvm_pkgs = ["clang", "clang-tools", "llvm", "llvm-tools", "llvmdev"]
-        if record_name in llvm_pkgs:
-            new_constrains = record.get("constrains", [])
-            version = record["version"]
-            for pkg in llvm_pkgs:
-                if record_name == pkg:
-                    continue
-                if pkg in new_constrains:
-                    del new_constrains[pkg]
-                if any(
-                    constraint.startswith(f"{pkg} ") for constraint in new_constrains
-                ):
-                    continue
-                new_constrains.append(f"{pkg} {version}.*")
-            record["constrains"] = new_constrains
-
-        if record_name == "gcc_impl_{}".format(subdir):
-            _relax_exact(fn, record, "binutils_impl_{}".format(subdir))
-
-        # some symlinks changed in gfortran, so we need to adjust things
-        # plus we missed a key version constraint
-        if subdir in ["osx-64", "osx-arm64"] and record_name == "gfortran":
-            for i, dep in enumerate(record["depends"]):
-                if dep == f"gfortran_{subdir}":
-                    record["depends"][i] = dep + " ==" + record["version"]
-
-        # make sure the libgfortran version is bound from 3 to 4 for osx
-        if subdir == "osx-64":
-            _fix_libgfortran(fn, record)
-            _fix_libcxx(fn, record)
-
-            full_pkg_name = fn.replace(".tar.bz2", "")
-            if full_pkg_name in OSX_SDK_FIXES:
-                _set_osx_virt_min(fn, record, OSX_SDK_FIXES[full_pkg_name])
-
-        # when making the glibc 2.28 sysroots, we found we needed to go back
-        # and add the current repodata hack packages to the cos7 sysroots
-        # for aarch64, ppc64le and s390x
-        for __subdir in ["linux-s390x", "linux-aarch64", "linux-ppc64le"]:
-            if (
-                record_name in ["kernel-headers_" + __subdir, "sysroot_" + __subdir]
-                and record.get("timestamp", 0) < 1682273081000  # 2023-04-23
-                and record["version"] == "2.17"
-            ):
-                new_depends = record.get("depends", [])
-                new_depends.append("_sysroot_" + __subdir + "_curr_repodata_hack 4.*")
-                record["depends"] = new_depends
-
-        # make old binutils packages conflict with the new sysroot packages
-        # that have renamed the sysroot from conda_cos6 or conda_cos7 to just
-        # conda
-        if (
-            subdir in ["linux-64", "linux-aarch64", "linux-ppc64le"]
-            and record_name
-            in ["binutils", "binutils_impl_" + subdir, "ld_impl_" + subdir]
-            and record.get("timestamp", 0) < 1589953178153  # 2020-05-20
-        ):
-            new_constrains = record.get("constrains", [])
-            new_constrains.append("sysroot_" + subdir + " ==99999999999")
-            record["constrains"] = new_constrains
+    return index
 
-        # make sure the old compilers conflict with the new sysroot packages
-        # and they only use libraries from the old compilers
-        if (
-            subdir in ["linux-64", "linux-aarch64", "linux-ppc64le"]
-            and record_name
-            in ["gcc_impl_" + subdir, "gxx_impl_" + subdir, "gfortran_impl_" + subdir]
-            and record["version"] in ["5.4.0", "7.2.0", "7.3.0", "8.2.0"]
-        ):
-            new_constrains = record.get("constrains", [])
-            for pkg in ["libgcc-ng", "libstdcxx-ng", "libgfortran", "libgomp"]:
-                new_constrains.append(
-                    "{} 5.4.*|7.2.*|7.3.*|8.2.*|9.1.*|9.2.*".format(pkg)
-                )
-            new_constrains.append("binutils_impl_" + subdir + " <2.34")
-            new_constrains.append("ld_impl_" + subdir + " <2.34")
-            new_constrains.append("sysroot_" + subdir + " ==99999999999")
-            record["constrains"] = new_constrains
 
-        # we pushed a few builds of the compilers past the list of versions
-        # above which do not use the sysroot packages - this block catches those
-        # it will also break some test builds of the new compilers but we should
-        # not be using those anyways and they are marked as broken.
-        if (
-            subdir in ["linux-64", "linux-aarch64", "linux-ppc64le"]
-            and record_name
-            in ["gcc_impl_" + subdir, "gxx_impl_" + subdir, "gfortran_impl_" + subdir]
-            and record["version"] not in ["5.4.0", "7.2.0", "7.3.0", "8.2.0"]
-            and not any(__r.startswith("sysroot_") for __r in record.get("depends", []))
-            and record.get("timestamp", 0) < 1626220800000  # 2020-07-14
-        ):
-            new_constrains = record.get("constrains", [])
-            new_constrains.append("sysroot_" + subdir + " ==99999999999")
-            record["constrains"] = new_constrains
+def _artifact_twins(repodata, subdir):
+    """Map the .conda files of ``repodata`` to their .tar.bz2 twins.
 
-        # all ctng activation packages that don't depend on the sysroot_*
-        # packages are not compatible with the new sysroot_*-based compilers
-        # root and cling must also be included as they have a builtin C++ interpreter
-        if (
-            subdir in ["linux-64", "linux-aarch64", "linux-ppc64le"]
-            and record_name
-            in [
-                "gcc_" + subdir,
-                "gxx_" + subdir,
-                "gfortran_" + subdir,
-                "binutils_" + subdir,
-                "gcc_bootstrap_" + subdir,
-                "root_base",
-                "cling",
-            ]
-            and not any(__r.startswith("sysroot_") for __r in record.get("depends", []))
-            and record.get("timestamp", 0) < 1626220800000  # 2020-07-14
-        ):
-            new_constrains = record.get("constrains", [])
-            new_constrains.append("sysroot_" + subdir + " ==99999999999")
-            record["constrains"] = new_constrains
+    The two files of a build only differ in their ``ARTIFACT_KEYS``, so the
+    .conda record can reuse the patched metadata of the .tar.bz2 record.
+    Builds whose metadata differs otherwise, or that a patch could tell apart
+    by filename or artifact fields, are not paired.
+    """
+    packages = repodata["packages"]
+    twins = {}
+    for fn, record in repodata["packages.conda"].items():
+        tar_fn = fn[: -len(".conda")] + ".tar.bz2"
+        if tar_fn not in packages:
+            continue
+        metadata = {k: v for k, v in record.items() if k not in ARTIFACT_KEYS}
+        tar_metadata = {
+            k: v for k, v in packages[tar_fn].items() if k not in ARTIFACT_KEYS
+        }
+        if metadata != tar_metadata:
+            continue
+        # the OSX SDK fixes are looked up by the .tar.bz2 filename only
+        if subdir == "osx-64" and tar_fn.replace(".tar.bz2", "") in OSX_SDK_FIXES:
+            continue
+        if is_format_sensitive(record["name"], [tar_fn, fn], subdir):
+            continue
+        twins[fn] = tar_fn
+    return twins
 
-        if (
-            record_name == "gcc_impl_{}".format(subdir)
-            and record["version"]
-            in ["5.4.0", "7.2.0", "7.3.0", "8.2.0", "8.4.0", "9.3.0"]
-            and record.get("timestamp", 0) < 1627530043000  # 2021-07-29
-        ):
-            new_depends = record.get("depends", [])
-            new_depends.append("libgcc-ng <=9.3.0")
-            record["depends"] = new_depends
-
-        # old CDTs with the conda_cos6 or conda_cos7 name in the sysroot need to
-        # conflict with the new CDT and compiler packages
-        # all of the new CDTs and compilers depend on the sysroot_{subdir} packages
-        # so we use a constraint on those
-        if (
-            subdir == "noarch"
-            and (
-                record_name.endswith("-cos6-x86_64")
-                or record_name.endswith("-cos7-x86_64")
-                or record_name.endswith("-cos7-aarch64")
-                or record_name.endswith("-cos7-ppc64le")
-            )
-            and not record_name.startswith("sysroot-")
-            and not any(__r.startswith("sysroot_") for __r in record.get("depends", []))
-        ):
-            if record_name.endswith("x86_64"):
-                sys_subdir = "linux-64"
-            elif record_name.endswith("aarch64"):
-                sys_subdir = "linux-aarch64"
-            elif record_name.endswith("ppc64le"):
-                sys_subdir = "linux-ppc64le"
 
-            new_constrains = record.get("constrains", [])
-            if not any(__r.startswith("sysroot_") for __r in new_constrains):
-                new_constrains.append("sysroot_" + sys_subdir + " ==99999999999")
-                record["constrains"] = new_constrains
-
-        llvm_pkgs = [
-            "libclang",
-            "clang",
-            "clang-tools",
-            "llvm",
-            "llvm-tools",
-            "llvmdev",
-        ]
-        for llvm in ["libllvm8", "libllvm9"]:
-            if any(dep.startswith(llvm) for dep in deps):
-                if record_name not in llvm_pkgs:
-                    _relax_exact(fn, record, llvm, max_pin="x.x")
-                else:
-                    _relax_exact(fn, record, llvm, max_pin="x.x.x")
-
-        # Properly depend on clangdev 5.0.0 flang* for flang 5.0
-        if record_name == "flang":
-            deps = record["depends"]
-            if record["version"] == "5.0.0":
-                deps += ["clangdev * flang*"]
-
-        # add as run_constrained for cling
-        if record_name == "cling" and record["version"] >= "0.8":
-            record.setdefault("constrains", []).extend(("gxx_linux-64 !=9.5.0",))
-
-        ############################################
-        # Custom Patches that cannot be YAML-ized
-        ############################################
-
-        # FIXME: disable patching-out blas_openblas feature
-        # because hotfixes are not applied to gcc7 label
-        # causing inconsistent behavior
-        # if (record_name == "blas" and
-        #         record["track_features"] == "blas_openblas"):
-        #     instructions["packages"][fn]["track_features"] = None
-        # if "features" in record:
-        # if "blas_openblas" in record["features"]:
-        #     # remove blas_openblas feature
-        #     instructions["packages"][fn]["features"] = _extract_feature(
-        #         record, "blas_openblas")
-        #     if not any(d.startswith("blas ") for d in record["depends"]):
-        #         depends = record['depends']
-        #         depends.append("blas 1.* openblas")
-        #         instructions["packages"][fn]["depends"] = depends
+def _gen_new_index(repodata, subdir):
+    return _gen_new_index_tracked(repodata, subdir)[0]
 
-    return index
 
+def _gen_new_index_tracked(repodata, subdir):
+    """Generate the new index and the keys the patches wrote to.
 
-def _gen_new_index(repodata, subdir):
-    indexes = {}
-    for index_key in ["packages", "packages.conda"]:
-        indexes[index_key] = _gen_new_index_per_key(repodata, subdir, index_key)
-        patch_yaml_edit_index(indexes[index_key], subdir)
+    Returns the new index and, per section, the keys written to per filename
+    of the records that were changed; all other records of the new index
+    are the raw records of ``repodata``.
+    """
+    versions = VersionOrdinals.from_indexes(
+        repodata["packages"], repodata["packages.conda"], constants=VERSION_CONSTANTS
+    )
+    new_packages = _gen_new_index_per_key(
+        repodata, subdir, "packages", versions=versions
+    )
+    patch_yaml_edit_index(new_packages, subdir, versions=versions)
+
+    # .conda records with a .tar.bz2 twin are not patched again, they get a copy
+    # of the patched twin with their own artifact fields
+    twins = _artifact_twins(repodata, subdir)
+    new_conda = _gen_new_index_per_key(
+        {
+            "packages.conda": {
+                fn: record
+                for fn, record in repodata["packages.conda"].items()
+                if fn not in twins
+            }
+        },
+        subdir,
+        "packages.conda",
+        versions=versions,
+    )
+    patch_yaml_edit_index(new_conda, subdir, versions=versions)
+
+    dirty = {"packages": dirty_keys(new_packages), "packages.conda": {}}
+    conda_dirty = dirty_keys(new_conda)
+
+    # unchanged records and lists are shared with the raw repodata from here on
+    new_packages = materialize_index(new_packages)
+    new_conda = materialize_index(new_conda)
+    indexes = {"packages": new_packages, "packages.conda": {}}
+    for fn, record in repodata["packages.conda"].items():
+        if fn not in twins:
+            indexes["packages.conda"][fn] = new_conda[fn]
+            if fn in conda_dirty:
+                dirty["packages.conda"][fn] = conda_dirty[fn]
+            continue
+        tar_fn = twins[fn]
+        if tar_fn not in dirty["packages"]:
+            indexes["packages.conda"][fn] = record
+            continue
+        new_record = {
+            key: value
+            for key, value in new_packages[tar_fn].items()
+            if key not in ARTIFACT_KEYS
+        }
+        for key in ARTIFACT_KEYS:
+            if key in record:
+                new_record[key] = record[key]
+        indexes["packages.conda"][fn] = new_record
+        dirty["packages.conda"][fn] = dirty["packages"][tar_fn]
 
-    return indexes
+    return indexes, dirty
 
 
 def _add_removals(instructions, subdir):
@@ -901,7 +1178,8 @@ def _add_removals(instructions, subdir):
     instructions["remove"].extend(tuple(set(currvals)))
 
 
-def _gen_patch_instructions(index, new_index, subdir):
+def _new_instructions(subdir):
+    """Return the patch instructions of ``subdir`` without any package patches."""
     instructions = {
         "patch_instructions_version": 1,
         "packages": defaultdict(dict),
@@ -912,6 +1190,27 @@ def _gen_patch_instructions(index, new_index, subdir):
 
     _add_removals(instructions, subdir)
 
+    return instructions
+
+
+def _gen_patch_instructions(index, new_index, subdir, dirty=None):
+    """Generate the patch instructions turning ``index`` into ``new_index``.
+
+    By default all records are diff'ed. If ``dirty`` is given, as returned by
+    ``_gen_new_index_tracked``, only the keys written to of the changed
+    records are compared; the result is the same.
+    """
+    instructions = _new_instructions(subdir)
+
+    if dirty is None:
+        _add_index_diffs(instructions, index, new_index)
+    else:
+        _add_dirty_diffs(instructions, index, new_index, dirty)
+
+    return instructions
+
+
+def _add_index_diffs(instructions, index, new_index):
     # diff all items in the index and put any differences in the instructions
     for pkgs_section_key in ["packages", "packages.conda"]:
         for fn in index.get(pkgs_section_key, {}):
@@ -939,74 +1238,423 @@ def _gen_patch_instructions(index, new_index, subdir):
                         pkgs_section_key
                     ][fn][key]
 
-    return instructions
 
+def _add_dirty_diffs(instructions, index, new_index, dirty):
+    for pkgs_section_key in ["packages", "packages.conda"]:
+        for fn, keys in dirty[pkgs_section_key].items():
+            record = index[pkgs_section_key][fn]
+            new_record = new_index[pkgs_section_key][fn]
+            for key in keys:
+                if key not in new_record:
+                    assert key not in record, (key, record, new_record)
+                    continue
+                if key not in record or record[key] != new_record[key]:
+                    instructions[pkgs_section_key][fn][key] = new_record[key]
+
+
+def _check_patch_instructions(instructions, index, new_index):
+    """Check ``instructions`` against a full diff of ``index`` and ``new_index``."""
+    expected = {"packages": defaultdict(dict), "packages.conda": defaultdict(dict)}
+    _add_index_diffs(expected, index, new_index)
+    for pkgs_section_key, section in expected.items():
+        if instructions[pkgs_section_key] != section:
+            fns = sorted(
+                fn
+                for fn in set(section) | set(instructions[pkgs_section_key])
+                if section.get(fn) != instructions[pkgs_section_key].get(fn)
+            )
+            raise AssertionError(
+                "%s patch instructions differ from the full diff for %s"
+                % (pkgs_section_key, fns[:10])
+            )
 
-def _do_subdir(subdir):
-    with tempfile.TemporaryDirectory() as tmpdir:
-        raw_repodata_path = os.path.join(tmpdir, "repodata_from_packages.json.bz2")
-        ref_repodata_path = os.path.join(tmpdir, "repodata.json.bz2")
-        raw_url = f"{BASE_URL}/{subdir}/repodata_from_packages.json.bz2"
-        urllib.request.urlretrieve(raw_url, raw_repodata_path)
-        ref_url = f"{BASE_URL}/{subdir}/repodata.json.bz2"
-        urllib.request.urlretrieve(ref_url, ref_repodata_path)
 
+def _print_stage_time(subdir, stage, start):
+    print(f"{subdir}: {stage} in {time.perf_counter() - start:.1f}s", flush=True)
+
+
+def _print_cache_stats(subdir, name, info):
+    lookups = info.hits + info.misses
+    rate = 100 * info.hits / lookups if lookups else 0
+    print(
+        f"{subdir}: {name} cache hits {info.hits}/{lookups} ({rate:.0f}%)",
+        flush=True,
+    )
+
+
+def worker_pool(max_workers):
+    """Return the process pool the subdirs are processed on.
+
+    On Linux the workers are forked explicitly, rather than started with
+    the default method of the interpreter, which is forkserver from Python
+    3.14. They start with the rules this process parsed when importing
+    ``patch_yaml_utils`` instead of parsing them again.
+    """
+    if sys.platform.startswith("linux"):
+        mp_context = multiprocessing.get_context("fork")
+    else:
+        mp_context = None
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
+
+
+def _download_subdir(subdir, dirname, prev_instructions=None):
+    """Download the repodata of ``subdir`` to ``dirname``.
+
+    Returns the paths of the raw and of the reference repodata; the latter is
+    not needed, and None, when diffing against ``prev_instructions``.
+    """
+    raw_repodata_path = os.path.join(dirname, "repodata_from_packages.json.bz2")
+    raw_url = f"{BASE_URL}/{subdir}/repodata_from_packages.json.bz2"
+    urllib.request.urlretrieve(raw_url, raw_repodata_path)
+    if prev_instructions is not None:
+        return raw_repodata_path, None
+    ref_repodata_path = os.path.join(dirname, "repodata.json.bz2")
+    ref_url = f"{BASE_URL}/{subdir}/repodata.json.bz2"
+    urllib.request.urlretrieve(ref_url, ref_repodata_path)
+    return raw_repodata_path, ref_repodata_path
+
+
+def _write_patch_instructions(subdir, instructions):
+    # Output this to $PREFIX so that we bundle the JSON files.
+    prefix_dir = os.getenv("PREFIX", "tmp")
+    prefix_subdir = join(prefix_dir, subdir)
+    if not isdir(prefix_subdir):
+        os.makedirs(prefix_subdir)
+    patch_instructions_path = join(prefix_subdir, "patch_instructions.json")
+    with open(patch_instructions_path, "w") as fh:
+        json.dump(instructions, fh, indent=2, sort_keys=True, separators=(",", ": "))
+
+
+def _subdir_diffs(
+    subdir,
+    repodata,
+    ref_repodata_path,
+    instructions,
+    stream_ref=False,
+    prev_instructions=None,
+):
+    """Diff the records patched with ``instructions`` against the reference."""
+    start = time.perf_counter()
+    if prev_instructions is not None:
+        ref_instructions = load_patch_instructions(prev_instructions, subdir)
+        diffs = instructions_record_diffs(
+            subdir, repodata, ref_instructions, instructions, False
+        )
+    else:
+        if stream_ref:
+            ref_repodata = iter_repodata_records(ref_repodata_path)
+        else:
+            with bz2.open(ref_repodata_path) as fh:
+                ref_repodata = json.load(fh)
+        new_repodata = apply_instructions_view(subdir, repodata, instructions)
+        diffs = show_record_diffs(
+            subdir, ref_repodata, new_repodata, False, group_diffs=True
+        )
+    _print_stage_time(subdir, "applied instructions and diffed", start)
+    return diffs
+
+
+def _spill_diffs(subdir, diffs, spill_dir):
+    path = os.path.join(spill_dir, subdir + ".diff")
+    spill_record_diffs(diffs, path)
+    return path
+
+
+def _do_subdir(
+    subdir, spill_dir, verify=False, stream_ref=False, prev_instructions=None
+):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        raw_repodata_path, ref_repodata_path = _download_subdir(
+            subdir, tmpdir, prev_instructions
+        )
         with bz2.open(raw_repodata_path) as fh:
             repodata = json.load(fh)
-        with bz2.open(ref_repodata_path) as fh:
-            ref_repodata = json.load(fh)
-
-        prefix_dir = os.getenv("PREFIX", "tmp")
-        prefix_subdir = join(prefix_dir, subdir)
-        if not isdir(prefix_subdir):
-            os.makedirs(prefix_subdir)
 
         # Step 2a. Generate a new index.
-        new_index = _gen_new_index(repodata, subdir)
-
-        # Step 2b. Generate the instructions by diff'ing the indices.
-        instructions = _gen_patch_instructions(repodata, new_index, subdir)
+        start = time.perf_counter()
+        _python_abi_constrains.cache_clear()
+        new_index, dirty = _gen_new_index_tracked(repodata, subdir)
+        save_license_families()
+        _print_stage_time(subdir, "generated new index", start)
+        _print_cache_stats(subdir, "python_abi", _python_abi_constrains.cache_info())
+
+        # Step 2b. Generate the instructions by diff'ing the changed records.
+        start = time.perf_counter()
+        instructions = _gen_patch_instructions(repodata, new_index, subdir, dirty=dirty)
+        _print_stage_time(subdir, "generated patch instructions", start)
+        if verify:
+            start = time.perf_counter()
+            _check_patch_instructions(instructions, repodata, new_index)
+            _print_stage_time(subdir, "verified patch instructions", start)
 
         # Step 2c. Output this to $PREFIX so that we bundle the JSON files.
-        patch_instructions_path = join(prefix_subdir, "patch_instructions.json")
-        with open(patch_instructions_path, "w") as fh:
-            json.dump(
-                instructions, fh, indent=2, sort_keys=True, separators=(",", ": ")
-            )
+        _write_patch_instructions(subdir, instructions)
 
         # Step 3. Show the diff
-        new_repodata = _apply_instructions(subdir, repodata, instructions)
-        return subdir, show_record_diffs(
-            subdir, ref_repodata, new_repodata, False, group_diffs=True
+        diffs = _subdir_diffs(
+            subdir,
+            repodata,
+            ref_repodata_path,
+            instructions,
+            stream_ref=stream_ref,
+            prev_instructions=prev_instructions,
         )
+        return subdir, _spill_diffs(subdir, diffs, spill_dir)
+
+
+def _shard_names(repodata, shards):
+    """Assign the package names of ``repodata`` to ``shards`` shards.
+
+    The names go, most records first, to the shard with the fewest records
+    so far. All records of a package, including the .tar.bz2 twin of a .conda
+    record, end up in the same shard.
+    """
+    counts = defaultdict(int)
+    for pkgs_section_key in ["packages", "packages.conda"]:
+        for record in repodata[pkgs_section_key].values():
+            counts[record["name"]] += 1
+    sizes = [0] * shards
+    assignment = {}
+    for name in sorted(counts, key=lambda name: (-counts[name], name)):
+        shard = sizes.index(min(sizes))
+        assignment[name] = shard
+        sizes[shard] += counts[name]
+    return assignment
+
+
+def _shard_repodata(repodata, shards):
+    """Split the records of ``repodata`` into ``shards`` by package name."""
+    assignment = _shard_names(repodata, shards)
+    parts = [{"packages": {}, "packages.conda": {}} for _ in range(shards)]
+    for pkgs_section_key in ["packages", "packages.conda"]:
+        for fn, record in repodata[pkgs_section_key].items():
+            parts[assignment[record["name"]]][pkgs_section_key][fn] = record
+    return parts
+
+
+def _gen_shard_instructions(repodata, subdir, verify=False):
+    """Generate the package patch instructions of one shard of a subdir.
+
+    Every patch only looks at one record, so the instructions of the shards
+    of a subdir together are those of the whole subdir, see
+    ``_merge_shard_instructions``.
+    """
+    new_index, dirty = _gen_new_index_tracked(repodata, subdir)
+    instructions = {"packages": defaultdict(dict), "packages.conda": defaultdict(dict)}
+    _add_dirty_diffs(instructions, repodata, new_index, dirty)
+    if verify:
+        _check_patch_instructions(instructions, repodata, new_index)
+    return {key: dict(value) for key, value in instructions.items()}
+
+
+def _merge_shard_instructions(subdir, parts):
+    """Merge the ``_gen_shard_instructions`` of all shards of a subdir."""
+    instructions = _new_instructions(subdir)
+    for part in parts:
+        for pkgs_section_key in ["packages", "packages.conda"]:
+            instructions[pkgs_section_key].update(part[pkgs_section_key])
+    return instructions
+
+
+def _prepare_subdir_shards(subdir, workdir, shards, prev_instructions=None):
+    """Download ``subdir`` into ``workdir`` and pickle its shards there."""
+    start = time.perf_counter()
+    dirname = os.path.join(workdir, subdir)
+    os.makedirs(dirname, exist_ok=True)
+    raw_repodata_path, ref_repodata_path = _download_subdir(
+        subdir, dirname, prev_instructions
+    )
+    with bz2.open(raw_repodata_path) as fh:
+        repodata = json.load(fh)
+    shard_paths = []
+    for i, part in enumerate(_shard_repodata(repodata, shards)):
+        shard_path = os.path.join(dirname, f"shard-{i}.pickle")
+        with open(shard_path, "wb") as fh:
+            pickle.dump(part, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        shard_paths.append(shard_path)
+    _print_stage_time(subdir, f"split into {shards} shards", start)
+    return raw_repodata_path, ref_repodata_path, shard_paths
+
+
+def _do_shard(subdir, shard_path, verify=False):
+    start = time.perf_counter()
+    with open(shard_path, "rb") as fh:
+        repodata = pickle.load(fh)
+    os.remove(shard_path)
+    _python_abi_constrains.cache_clear()
+    instructions = _gen_shard_instructions(repodata, subdir, verify=verify)
+    save_license_families()
+    name = os.path.basename(shard_path)
+    _print_stage_time(subdir, f"patched {name}", start)
+    _print_cache_stats(subdir, "python_abi", _python_abi_constrains.cache_info())
+    return instructions
+
+
+def _finish_subdir(
+    subdir,
+    spill_dir,
+    raw_repodata_path,
+    ref_repodata_path,
+    parts,
+    stream_ref=False,
+    prev_instructions=None,
+):
+    instructions = _merge_shard_instructions(subdir, parts)
+    _write_patch_instructions(subdir, instructions)
+    with bz2.open(raw_repodata_path) as fh:
+        repodata = json.load(fh)
+    diffs = _subdir_diffs(
+        subdir,
+        repodata,
+        ref_repodata_path,
+        instructions,
+        stream_ref=stream_ref,
+        prev_instructions=prev_instructions,
+    )
+    return subdir, _spill_diffs(subdir, diffs, spill_dir)
+
+
+def _run_scheduled(scheduler, subdirs, costs, spill_dir, args):
+    """Yield the ``(subdir, path)`` of ``subdirs``, patched one job each.
+
+    The diffs of each subdir are spilled to the file at ``path``.
+    """
+    for subdir in subdirs:
+        scheduler.submit(
+            ("subdir", subdir),
+            *costs[subdir],
+            _do_subdir,
+            subdir,
+            spill_dir,
+            args.verify,
+            args.stream_ref,
+            args.prev_instructions,
+        )
+    for _, fut in scheduler.as_completed():
+        yield fut.result()
+
+
+def _run_sharded(scheduler, subdirs, costs, shards, spill_dir, args):
+    """Yield the ``(subdir, path)`` of ``subdirs`` patched in ``shards`` each.
+
+    Each subdir is downloaded and split by one worker, its shards are patched
+    by as many workers and the instructions are merged, written and diffed
+    by a last one. The shards are expected to take a ``shards``-th of the
+    memory of their subdir.
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        for subdir in subdirs:
+            scheduler.submit(
+                ("prepare", subdir),
+                *costs[subdir],
+                _prepare_subdir_shards,
+                subdir,
+                workdir,
+                shards,
+                args.prev_instructions,
+            )
+        paths = {}
+        parts = {}
+        for (stage, subdir), fut in scheduler.as_completed():
+            priority, memory = costs[subdir]
+            if stage == "prepare":
+                raw_path, ref_path, shard_paths = fut.result()
+                paths[subdir] = (raw_path, ref_path)
+                parts[subdir] = [None] * len(shard_paths)
+                for i, shard_path in enumerate(shard_paths):
+                    scheduler.submit(
+                        (i, subdir),
+                        priority,
+                        memory // shards,
+                        _do_shard,
+                        subdir,
+                        shard_path,
+                        args.verify,
+                    )
+            elif stage == "finish":
+                yield fut.result()
+            else:
+                parts[subdir][stage] = fut.result()
+                if all(part is not None for part in parts[subdir]):
+                    scheduler.submit(
+                        ("finish", subdir),
+                        priority,
+                        memory,
+                        _finish_subdir,
+                        subdir,
+                        spill_dir,
+                        *paths[subdir],
+                        parts.pop(subdir),
+                        stream_ref=args.stream_ref,
+                        prev_instructions=args.prev_instructions,
+                    )
 
 
 def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="generate the repodata patch instructions"
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="check the patch instructions against a diff of the full index",
+    )
+    parser.add_argument(
+        "--stream-ref",
+        action="store_true",
+        help="read the reference repodata record by record to save memory",
+    )
+    parser.add_argument(
+        "--prev-instructions",
+        default=None,
+        metavar="SOURCE",
+        help=(
+            "diff against the raw repodata patched with the patch instructions "
+            "in SOURCE/<subdir>/patch_instructions.json, a local directory or "
+            "base URL, instead of downloading the current repodata"
+        ),
+    )
+    args = parser.parse_args()
+
     if "CF_SUBDIR" in os.environ:
         # For local debugging
         subdirs = os.environ["CF_SUBDIR"].split(";")
     else:
         subdirs = SUBDIRS
 
-    with ProcessPoolExecutor(
-        max_workers=int(os.environ["CPU_COUNT"]) if "CPU_COUNT" in os.environ else None
-    ) as exc:
-        futs = [exc.submit(_do_subdir, subdir) for subdir in subdirs]
-        for fut in tqdm.tqdm(
-            as_completed(futs), desc="patching repodata", total=len(subdirs)
+    # the number of shards each subdir is split into to patch it in parallel
+    shards = int(os.environ.get("CF_SUBDIR_SHARDS", "1"))
+
+    # start the subdirs expected to take longest first, as many at once as
+    # fit into MAX_MEMORY
+    stats = read_stats()
+    sizes = repodata_sizes(subdirs, BASE_URL, known=stats)
+    costs = estimate_costs(subdirs, sizes, stats)
+    subdirs = schedule_order(subdirs, costs)
+    budget = max_memory()
+    log_schedule(subdirs, costs, budget)
+
+    max_workers = int(os.environ["CPU_COUNT"]) if "CPU_COUNT" in os.environ else None
+    with tempfile.TemporaryDirectory() as spill_dir, worker_pool(max_workers) as exc:
+        scheduler = SubdirScheduler(exc, max_workers, budget)
+        if shards > 1:
+            results = _run_sharded(scheduler, subdirs, costs, shards, spill_dir, args)
+        else:
+            results = _run_scheduled(scheduler, subdirs, costs, spill_dir, args)
+        for subdir, path in tqdm.tqdm(
+            results, desc="patching repodata", total=len(subdirs)
         ):
-            subdir, vals = fut.result()
             print("\n", flush=True, end="")
             print("=" * 80, flush=True)
             print("=" * 80, flush=True)
             print(subdir, flush=True)
-            for key, val in vals.items():
-                for v in val:
-                    print(v, flush=True)
-                for k in key:
-                    print(k, flush=True)
+            print_spilled_diffs(path)
             print("\n", flush=True, end="")
 
+    write_stats(run_stats(subdirs, sizes, stats, scheduler.seconds))
+
 
 if __name__ == "__main__":
     sys.exit(main())
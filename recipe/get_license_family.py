@@ -1,5 +1,20 @@
+import hashlib
+import importlib.metadata
+import json
+import os
+import tempfile
+
 import license_expression
 
+from show_diff import CACHE_DIR
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LICENSE_FAMILIES_PATH = os.path.join(CACHE_DIR, "license_families.json")
+
 mapping = {
     "AGPL-3.0-or-later": "AGPL",
     "AGPL-3.0-only": "AGPL",
@@ -31,8 +46,8 @@ precedence = {
 }
 
 
-def get_license_family(license):
-    licensing = license_expression.Licensing()
+def _parse_license_family(license):
+    licensing = _get_licensing()
     family = None
     try:
         parsed_licenses_with_exception = licensing.license_symbols(
@@ -56,3 +71,100 @@ def get_license_family(license):
     except license_expression.ExpressionError:
         return None
     return family
+
+
+_licensing = None
+# license string -> family, None until loaded from LICENSE_FAMILIES_PATH
+_families = None
+_new_families = {}
+
+
+def _get_licensing():
+    global _licensing
+    if _licensing is None:
+        _licensing = license_expression.Licensing()
+    return _licensing
+
+
+def _families_version():
+    """Identify the parser and tables the persisted families were made with."""
+    try:
+        version = importlib.metadata.version("license-expression")
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    tables = json.dumps(
+        [version, mapping, sorted(precedence.items())], sort_keys=True
+    ).encode()
+    return hashlib.sha256(tables).hexdigest()
+
+
+def _read_families(path):
+    try:
+        with open(path) as fh:
+            data = json.load(fh)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("version") != _families_version():
+        return {}
+    return data.get("families", {})
+
+
+def get_license_family(license):
+    """Return the license family of the SPDX expression ``license`` or None.
+
+    Results are memoized per process and persisted with
+    ``save_license_families`` in ``LICENSE_FAMILIES_PATH``, so that later
+    processes skip parsing the strings already seen.
+    """
+    global _families
+    if _families is None:
+        _families = _read_families(LICENSE_FAMILIES_PATH)
+    try:
+        return _families[license]
+    except KeyError:
+        family = _families[license] = _new_families[license] = _parse_license_family(
+            license
+        )
+        return family
+
+
+def save_license_families():
+    """Merge the families found by this process into ``LICENSE_FAMILIES_PATH``.
+
+    The file is read, merged and replaced under an exclusive lock of
+    ``LICENSE_FAMILIES_PATH + ".lock"``, so entries that other workers save
+    at the same time are kept. The table is written to a temporary file that
+    replaces the old one, so readers never see a partial file.
+    """
+    if not _new_families:
+        return
+    cache_dir = os.path.dirname(LICENSE_FAMILIES_PATH)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        lock = open(LICENSE_FAMILIES_PATH + ".lock", "a")
+    except OSError:
+        # the table is only a cache
+        return
+    with lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        families = _read_families(LICENSE_FAMILIES_PATH)
+        families.update(_new_families)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".json.tmp")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "w") as fh:
+                json.dump(
+                    {"version": _families_version(), "families": families},
+                    fh,
+                    sort_keys=True,
+                )
+            # mkstemp creates the file readable by its owner only
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, LICENSE_FAMILIES_PATH)
+        except OSError:
+            os.remove(tmp_path)
+            return
+    _new_families.clear()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""Run the patch instruction generation as independent jobs.
+
+``plan`` splits the records of each subdir by package name into jobs and
+writes one JSON job descriptor per job. A descriptor names the subdir, the
+index sections and the half-open range of package names it covers, and the
+digests of the rule set and of the input repodata it was planned for.
+``run`` executes one job from the local input files, on any machine, and
+writes a partial instructions file. ``merge`` checks that the partials of a
+subdir are complete and consistent and writes its ``patch_instructions.json``,
+as ``gen_patch_json.py`` does.
+
+The inputs are read from ``<input-dir>/<subdir>/repodata_from_packages.json.bz2``,
+the layout of the ``show_diff.py`` cache.
+"""
+
+import bz2
+import glob
+import hashlib
+import json
+import os
+import urllib
+
+from gen_patch_json import (
+    BASE_URL,
+    SUBDIRS,
+    _gen_shard_instructions,
+    _merge_shard_instructions,
+    _write_patch_instructions,
+)
+from get_license_family import save_license_families
+from show_diff import CACHE_DIR
+
+JOB_VERSION = 1
+INPUT_FILENAME = "repodata_from_packages.json.bz2"
+SECTIONS = ("packages", "packages.conda")
+# the modules and YAML files whose contents decide the patches
+RULE_FILES = (
+    "gen_patch_json.py",
+    "get_license_family.py",
+    "patch_yaml_utils.py",
+    "record_store.py",
+    "patch_yaml/*.yaml",
+)
+
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def rules_digest():
+    """Return a digest of the rule set in ``RULE_FILES``."""
+    recipe_dir = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha256()
+    for pattern in RULE_FILES:
+        for path in sorted(glob.glob(os.path.join(recipe_dir, pattern))):
+            h.update(os.path.relpath(path, recipe_dir).encode() + b"\0")
+            h.update(_file_digest(path).encode())
+    return h.hexdigest()
+
+
+def _input_path(input_dir, subdir):
+    return os.path.join(input_dir, subdir, INPUT_FILENAME)
+
+
+def _load_repodata(path):
+    with bz2.open(path) as fh:
+        return json.load(fh)
+
+
+def _name_ranges(repodata, jobs):
+    """Split the package names of ``repodata`` into ``jobs`` contiguous ranges.
+
+    The ranges are half-open ``[start, stop)``, the first starts and the last
+    stops at None, and each holds about as many records as the others.
+    """
+    counts = {}
+    for pkgs_section_key in SECTIONS:
+        for record in repodata[pkgs_section_key].values():
+            counts[record["name"]] = counts.get(record["name"], 0) + 1
+    names = sorted(counts)
+    total = sum(counts.values())
+    starts = [None]
+    seen = 0
+    for name in names:
+        if seen >= total * len(starts) / jobs and len(starts) < jobs:
+            starts.append(name)
+        seen += counts[name]
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def _in_range(name, start, stop):
+    return (start is None or name >= start) and (stop is None or name < stop)
+
+
+def select_names(repodata, start, stop):
+    """Return the records of ``repodata`` with a name in ``[start, stop)``."""
+    return {
+        pkgs_section_key: {
+            fn: record
+            for fn, record in repodata[pkgs_section_key].items()
+            if _in_range(record["name"], start, stop)
+        }
+        for pkgs_section_key in SECTIONS
+    }
+
+
+def plan_jobs(subdirs, input_dir, jobs_per_subdir):
+    """Return the job descriptors of ``subdirs``, ``jobs_per_subdir`` each."""
+    rules = rules_digest()
+    jobs = []
+    for subdir in subdirs:
+        path = _input_path(input_dir, subdir)
+        inputs = {INPUT_FILENAME: _file_digest(path)}
+        ranges = _name_ranges(_load_repodata(path), jobs_per_subdir)
+        for i, (start, stop) in enumerate(ranges):
+            jobs.append(
+                {
+                    "version": JOB_VERSION,
+                    "id": f"{subdir}-{i:03d}",
+                    "subdir": subdir,
+                    "sections": list(SECTIONS),
+                    "names": [start, stop],
+                    "rules": rules,
+                    "inputs": inputs,
+                }
+            )
+    return jobs
+
+
+def _check_job(job, input_dir):
+    if job["version"] != JOB_VERSION:
+        raise ValueError(f"job {job['id']} has version {job['version']}")
+    if job["rules"] != rules_digest():
+        raise ValueError(f"job {job['id']} was planned for another rule set")
+    subdir_dir = os.path.dirname(_input_path(input_dir, job["subdir"]))
+    for fname, digest in job["inputs"].items():
+        if _file_digest(os.path.join(subdir_dir, fname)) != digest:
+            raise ValueError(f"job {job['id']} was planned for another {fname}")
+
+
+def run_job(job, input_dir, verify=False):
+    """Run ``job`` on the files in ``input_dir`` and return its partial."""
+    _check_job(job, input_dir)
+    repodata = _load_repodata(_input_path(input_dir, job["subdir"]))
+    repodata = select_names(repodata, *job["names"])
+    instructions = _gen_shard_instructions(repodata, job["subdir"], verify=verify)
+    save_license_families()
+    partial = {"job": job}
+    for pkgs_section_key in job["sections"]:
+        partial[pkgs_section_key] = instructions[pkgs_section_key]
+    return partial
+
+
+def merge_partials(subdir, partials):
+    """Merge the partials of all jobs of ``subdir`` into its instructions.
+
+    Raises a ValueError if the partials were made with different rule sets or
+    inputs, do not cover every package name exactly once or patch the same
+    file twice.
+    """
+    jobs = sorted(
+        (partial["job"] for partial in partials),
+        key=lambda job: (job["names"][0] is not None, job["names"][0] or ""),
+    )
+    if not jobs:
+        raise ValueError(f"no partials for {subdir}")
+    for job in jobs:
+        if job["subdir"] != subdir:
+            raise ValueError(f"job {job['id']} is for {job['subdir']}, not {subdir}")
+        if job["sections"] != list(SECTIONS):
+            raise ValueError(f"job {job['id']} only covers {job['sections']}")
+        for key in ["version", "rules", "inputs"]:
+            if job[key] != jobs[0][key]:
+                raise ValueError(
+                    f"jobs {jobs[0]['id']} and {job['id']} differ in {key}"
+                )
+
+    stop = None
+    for i, job in enumerate(jobs):
+        start = job["names"][0]
+        if start != stop:
+            raise ValueError(f"job {job['id']} starts at {start!r}, not {stop!r}")
+        stop = job["names"][1]
+        if stop is None and i != len(jobs) - 1:
+            raise ValueError(f"job {job['id']} overlaps the following jobs")
+    if stop is not None:
+        raise ValueError(f"no job covers the names from {stop!r} of {subdir}")
+
+    for pkgs_section_key in SECTIONS:
+        fns = [fn for partial in partials for fn in partial[pkgs_section_key]]
+        if len(fns) != len(set(fns)):
+            raise ValueError(f"the partials of {subdir} patch a file twice")
+    return _merge_shard_instructions(subdir, partials)
+
+
+def _read_json(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def _write_json(path, data):
+    with open(path, "w") as fh:
+        json.dump(data, fh, indent=2, sort_keys=True, separators=(",", ": "))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="generate the repodata patch instructions as separate jobs"
+    )
+    parser.add_argument(
+        "--input-dir",
+        default=CACHE_DIR,
+        help="directory with <subdir>/" + INPUT_FILENAME + ", default is the cache",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plan = commands.add_parser("plan", help="write the job descriptors")
+    plan.add_argument("jobs_dir", help="directory to write the jobs to")
+    plan.add_argument(
+        "--subdirs", nargs="*", default=None, help="subdir(s) to plan, default is all"
+    )
+    plan.add_argument(
+        "--jobs-per-subdir", type=int, default=1, help="number of jobs per subdir"
+    )
+    plan.add_argument(
+        "--download",
+        action="store_true",
+        help="download the input repodata first, rather than using local files",
+    )
+
+    run = commands.add_parser("run", help="run one job and write its partial")
+    run.add_argument("job", help="job descriptor file")
+    run.add_argument("partials_dir", help="directory to write the partial to")
+    run.add_argument(
+        "--verify",
+        action="store_true",
+        help="check the instructions against a diff of the full index",
+    )
+
+    merge = commands.add_parser(
+        "merge", help="merge the partials into patch_instructions.json in $PREFIX"
+    )
+    merge.add_argument("partials_dir", help="directory with the partials")
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        subdirs = SUBDIRS if args.subdirs is None else args.subdirs
+        if args.download:
+            for subdir in subdirs:
+                path = _input_path(args.input_dir, subdir)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                url = f"{BASE_URL}/{subdir}/{INPUT_FILENAME}"
+                urllib.request.urlretrieve(url, path)
+        os.makedirs(args.jobs_dir, exist_ok=True)
+        for job in plan_jobs(subdirs, args.input_dir, args.jobs_per_subdir):
+            _write_json(os.path.join(args.jobs_dir, job["id"] + ".json"), job)
+            print(job["id"], flush=True)
+    elif args.command == "run":
+        job = _read_json(args.job)
+        partial = run_job(job, args.input_dir, verify=args.verify)
+        os.makedirs(args.partials_dir, exist_ok=True)
+        _write_json(os.path.join(args.partials_dir, job["id"] + ".json"), partial)
+    else:
+        partials = {}
+        for path in sorted(glob.glob(os.path.join(args.partials_dir, "*.json"))):
+            partial = _read_json(path)
+            partials.setdefault(partial["job"]["subdir"], []).append(partial)
+        for subdir, subdir_partials in partials.items():
+            _write_patch_instructions(subdir, merge_partials(subdir, subdir_partials))
+            print(subdir, flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,17 @@ import yaml
 import glob
 import os
 import string
-from packaging.version import parse as parse_version
+import numpy as np
+from packaging.version import InvalidVersion, parse as parse_version
 import fnmatch as _fnmatch
+import operator
 import re
+from bisect import bisect_left
+from collections import defaultdict
 from functools import lru_cache
 
+from record_store import record_data
+
 ALLOWED_TEMPLATE_KEYS = [
     "name",
     "version",
@@ -19,7 +25,7 @@ ALLOWED_TEMPLATE_KEYS = [
     "patch_version",
 ]
 
-from patch_yaml_model import PatchYaml  # noqa
+from patch_yaml_model import PatchYaml, scalar_repodata_keys  # noqa
 
 OPERATORS = ["==", ">=", "<=", ">", "<", "!="]
 
@@ -77,12 +83,6 @@ def fnmatch(name, pat):
     return match(name) is not None
 
 
-def _fnmatch_str_or_list(item, v):
-    if not isinstance(v, list):
-        v = [v]
-    return any(fnmatch(str(item), str(_v)) for _v in v)
-
-
 @lru_cache(maxsize=32768)
 def _get_vars_for_template(value, allow_old=False):
     if value is None:
@@ -117,9 +117,59 @@ def _get_ver_comp(version, ind):
         return "0"
 
 
-def _maybe_process_template(value, record, subdir, old=None):
-    tvars = _get_vars_for_template(value, allow_old=old is not None)
-    if tvars:
+DERIVED_TEMPLATE_KEYS = [
+    "next_version",
+    "major_version",
+    "minor_version",
+    "patch_version",
+]
+
+_MISSING = object()
+
+
+class Template:
+    """A ``then`` value with its ``string.Template`` variables found at load time.
+
+    Values without variables are returned unchanged. Other values are
+    rendered once per distinct combination of the inputs they read (record
+    fields, the subdir and the ``old`` spec) and cached for later records.
+    """
+
+    __slots__ = ("value", "tvars", "fields", "template", "cache")
+
+    def __init__(self, value, allow_old=False):
+        self.value = value
+        self.tvars = _get_vars_for_template(value, allow_old=allow_old)
+        fields = {
+            key
+            for key in self.tvars
+            if key not in DERIVED_TEMPLATE_KEYS and key not in ["subdir", "old"]
+        }
+        if any(key in DERIVED_TEMPLATE_KEYS for key in self.tvars):
+            fields.add("version")
+        self.fields = tuple(sorted(fields))
+        self.template = string.Template(value) if self.tvars else None
+        self.cache = {}
+
+    @property
+    def is_constant(self):
+        return not self.tvars
+
+    def __call__(self, record, subdir, old=None):
+        if not self.tvars:
+            return self.value
+
+        key = (
+            tuple(record.get(field, _MISSING) for field in self.fields),
+            subdir if "subdir" in self.tvars else None,
+            old if "old" in self.tvars else None,
+        )
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+
+        tvars = self.tvars
         data = {key: record[key] for key in tvars if key in record}
         if "subdir" in tvars:
             data["subdir"] = subdir
@@ -133,92 +183,308 @@ def _maybe_process_template(value, record, subdir, old=None):
             data["minor_version"] = _get_ver_comp(record["version"], 1)
         if "patch_version" in tvars:
             data["patch_version"] = _get_ver_comp(record["version"], 2)
-        return string.Template(value).substitute(**data)
-    else:
+        value = self.template.substitute(**data)
+        self.cache[key] = value
         return value
 
 
-def _test_patch_yaml(patch_yaml, record, subdir, fn):
-    keep = True
-    for k, v in patch_yaml["if"].items():
-        if k.startswith("not_"):
-            k = k[4:]
-            neg = True
+class VersionOrdinals:
+    """Ordinal ranks of the version strings found in one subdir.
+
+    Every distinct version string is parsed once and mapped to its rank in
+    sorted version order (equal versions such as ``1.0`` and ``1.0.0`` share a
+    rank), so that comparing two known versions is an integer comparison.
+    Strings missing from the table, e.g. invalid versions, are compared by
+    parsing them as before.
+    """
+
+    def __init__(self, versions=()):
+        parsed = {}
+        for version in set(versions):
+            try:
+                parsed[version] = parse_version(version)
+            except (InvalidVersion, TypeError):
+                pass
+
+        self.ranks = {}
+        rank = -1
+        prev = None
+        for version in sorted(parsed, key=parsed.__getitem__):
+            if prev is None or parsed[version] != prev:
+                rank += 1
+                prev = parsed[version]
+            self.ranks[version] = rank
+
+    @classmethod
+    def from_indexes(cls, *indexes, constants=()):
+        """Build the table from the records of ``indexes`` plus the version
+        constants used by the patch rules and ``constants``."""
+        versions = set(RULE_VERSION_CONSTANTS)
+        versions.update(constants)
+        for index in indexes:
+            versions.update(record["version"] for record in index.values())
+        return cls(versions)
+
+    def compare(self, a, b):
+        """Return -1, 0 or 1 as version ``a`` is lower, equal or greater than ``b``."""
+        ranks = self.ranks
+        if a in ranks and b in ranks:
+            a = ranks[a]
+            b = ranks[b]
         else:
-            neg = False
+            a = parse_version(a)
+            b = parse_version(b)
+        return (a > b) - (a < b)
 
-        if k in record:
-            if k == "version" and not any(
-                symb in v for symb in ["*", "[", "]", "?", "(", ")"]
-            ):
-                _keep = parse_version(record[k]) == parse_version(v)
-            else:
-                _keep = fnmatch(str(record[k]), str(v))
 
-        elif k == "subdir_in":
-            _keep = _fnmatch_str_or_list(subdir, v)
+class PatchContext:
+    """State shared by the compiled patch rules while patching one subdir."""
 
-        elif k[-3:] in ["_lt", "_le", "_gt", "_ge", "_eq", "_ne"] and (
-            k[:-3] in record
-            or k[:-3] in ["timestamp"]  # some records do not have a timestamp
-        ):
-            subk = k[:-3]
+    def __init__(self, subdir, versions=None):
+        self.subdir = subdir
+        self.versions = VersionOrdinals() if versions is None else versions
+        # results of the glob matches of the 'if' clauses by memo key and
+        # matched value, see _memoize_match
+        self.memo = defaultdict(dict)
+        # results of the depends/constrains rewrites, see _cache_rewrite
+        self.rewrites = {}
+        self.interned = {}
 
-            # some records do not have some keys, so we can
-            # special case that here
-            if subk == "timestamp":
-                rv = record.get(subk, 0)
-            else:
-                rv = record[subk]
-
-            if subk == "version":
-                rv = parse_version(rv)
-                v = parse_version(v)
-            elif subk in ["build_number", "timestamp"]:
-                rv = int(rv)
-                v = int(v)
-
-            op = k[-2:]
-            if op == "lt":
-                _keep = rv < v
-            elif op == "le":
-                _keep = rv <= v
-            elif op == "gt":
-                _keep = rv > v
-            elif op == "ge":
-                _keep = rv >= v
-            elif op == "eq":
-                _keep = rv == v
-            elif op == "ne":
-                _keep = rv != v
-
-        elif k.endswith("_in") and k[:-3] in record:
-            subk = k[:-3]
-            _keep = _fnmatch_str_or_list(record[subk], v)
-
-        elif k.startswith("has_") and k[len("has_") :] in ["depends", "constrains"]:
-            subk = k[len("has_") :]
-            if not isinstance(v, list):
-                v = [v]
-            _keep = all(
-                any(fnmatch(dep, _v) for dep in record.get(subk, [])) for _v in v
-            )
 
-        elif k == "artifact_in":
-            _keep = _fnmatch_str_or_list(fn, v)
+IF_RECORD_KEYS = frozenset(key for key, _ in scalar_repodata_keys)
+IF_COMPARISONS = {
+    "lt": operator.lt,
+    "le": operator.le,
+    "gt": operator.gt,
+    "ge": operator.ge,
+    "eq": operator.eq,
+    "ne": operator.ne,
+}
+VERSION_GLOB_SYMBOLS = ["*", "[", "]", "?", "(", ")"]
 
-        else:
-            raise KeyError("Unrecognized 'if' key '%s'!" % k)
 
-        if neg:
-            keep = keep and (not _keep)
-        else:
-            keep = keep and _keep
+def _compile_fnmatch(pat):
+    """Return a one-argument ``fnmatch`` bound to the pattern ``pat``."""
+    match = _fnmatch_build_re(os.path.normcase(str(pat)))
+    normcase = os.path.normcase
+
+    def _match(name):
+        return match(normcase(name)) is not None
+
+    return _match
+
+
+def _compile_fnmatch_any(v):
+    """Return a one-argument ``fnmatch`` that matches any pattern in ``v``."""
+    if not isinstance(v, list):
+        v = [v]
+    matchers = [_compile_fnmatch(_v) for _v in v]
+    if len(matchers) == 1:
+        return matchers[0]
+
+    def _match(name):
+        return any(m(name) for m in matchers)
+
+    return _match
+
+
+def _memoize_match(match, memo_key):
+    """Return ``match`` memoized in ``ctx.memo[memo_key]`` by the matched value.
+
+    Records share most of the values the glob clauses read (names, build
+    strings and above all the entries of ``depends``), so within a subdir
+    each distinct value is only matched once. ``memo_key`` identifies the
+    patterns; clauses with the same patterns share their results.
+    """
+
+    def _match(value, ctx):
+        memo = ctx.memo[memo_key]
+        try:
+            return memo[value]
+        except KeyError:
+            res = memo[value] = match(value)
+            return res
+
+    return _match
+
+
+class IfClause:
+    """One condition of a patch's ``if`` block, compiled once at load time.
+
+    ``test(record, ctx, fn)`` evaluates the condition for a record of the
+    ``PatchContext`` ``ctx`` without its ``not_`` prefix; ``neg`` says whether
+    the result has to be negated. ``field`` is the record field the condition
+    reads (``None`` for ``subdir_in`` and
+    ``artifact_in``), ``op`` is one of the ``IF_COMPARISONS`` names or
+    ``"glob"``, ``"in"``, ``"has"``, ``"subdir_in"`` or ``"artifact_in"``, and
+    ``value`` is the constant it is tested against (parsed to an int for
+    integer fields; versions are kept as strings and ranked by the
+    ``VersionOrdinals`` of the context).
+    """
+
+    __slots__ = ("key", "field", "op", "value", "neg", "test", "cost")
+
+    def __init__(self, key, field, op, value, neg, test, cost):
+        self.key = key
+        self.field = field
+        self.op = op
+        self.value = value
+        self.neg = neg
+        self.test = test
+        self.cost = cost
+
+    def __repr__(self):
+        return "IfClause(%r)" % self.key
+
 
-        if not keep:
-            break
+def _compile_comparison(field, op, v):
+    cmp = IF_COMPARISONS[op]
+    if field == "version":
+        # fail on invalid versions when loading the rules
+        parse_version(v)
 
-    return keep
+        def _test(record, ctx, fn):
+            return cmp(ctx.versions.compare(record["version"], v), 0)
+
+    elif field == "timestamp":
+        # some records do not have a timestamp
+        v = int(v)
+
+        def _test(record, ctx, fn):
+            return cmp(int(record.get("timestamp", 0)), v)
+
+    elif field == "build_number":
+        v = int(v)
+
+        def _test(record, ctx, fn):
+            return cmp(int(record["build_number"]), v)
+
+    else:
+
+        def _test(record, ctx, fn):
+            return cmp(record[field], v)
+
+    return v, _test
+
+
+def _compile_if_clause(k, v):
+    """Compile the ``if`` entry ``k: v`` into an ``IfClause``.
+
+    Raises ``KeyError`` for keys the patch YAML engine does not understand.
+    """
+    key = k
+    if k.startswith("not_"):
+        k = k[4:]
+        neg = True
+    else:
+        neg = False
+
+    if k in IF_RECORD_KEYS:
+        if k == "version" and not any(symb in v for symb in VERSION_GLOB_SYMBOLS):
+            value, _test = _compile_comparison("version", "eq", v)
+            return IfClause(key, k, "eq", value, neg, _test, 1)
+
+        match = _memoize_match(_compile_fnmatch(v), ("glob", str(v)))
+
+        def _test(record, ctx, fn):
+            return match(str(record[k]), ctx)
+
+        return IfClause(key, k, "glob", v, neg, _test, 2)
+
+    if k == "subdir_in":
+        match = _compile_fnmatch_any(v)
+
+        def _test(record, ctx, fn):
+            return match(str(ctx.subdir))
+
+        return IfClause(key, None, "subdir_in", v, neg, _test, 0)
+
+    if k == "artifact_in":
+        match = _compile_fnmatch_any(v)
+
+        def _test(record, ctx, fn):
+            return match(str(fn))
+
+        return IfClause(key, None, "artifact_in", v, neg, _test, 1)
+
+    if k[-3:-2] == "_" and k[-2:] in IF_COMPARISONS and k[:-3] in IF_RECORD_KEYS:
+        value, _test = _compile_comparison(k[:-3], k[-2:], v)
+        return IfClause(key, k[:-3], k[-2:], value, neg, _test, 1)
+
+    if k.endswith("_in") and k[:-3] in IF_RECORD_KEYS:
+        field = k[:-3]
+        match = _memoize_match(
+            _compile_fnmatch_any(v),
+            ("in", tuple(str(_v) for _v in v) if isinstance(v, list) else str(v)),
+        )
+
+        def _test(record, ctx, fn):
+            return match(str(record[field]), ctx)
+
+        return IfClause(key, field, "in", v, neg, _test, 2)
+
+    if k.startswith("has_") and k[len("has_") :] in ["depends", "constrains"]:
+        field = k[len("has_") :]
+        if not isinstance(v, list):
+            v = [v]
+        matchers = [_compile_fnmatch(_v) for _v in v]
+        # bit i of the mask of a dependency is set if it matches matchers[i]
+        all_found = (1 << len(matchers)) - 1
+        dep_mask = _memoize_match(
+            lambda dep: sum(1 << i for i, m in enumerate(matchers) if m(dep)),
+            ("has", tuple(str(_v) for _v in v)),
+        )
+
+        def _test(record, ctx, fn):
+            found = 0
+            if found == all_found:
+                return True
+            for dep in record.get(field, []):
+                found |= dep_mask(dep, ctx)
+                if found == all_found:
+                    return True
+            return False
+
+        return IfClause(key, field, "has", v, neg, _test, 3)
+
+    raise KeyError("Unrecognized 'if' key '%s'!" % key)
+
+
+def _cannot_raise(clause):
+    # the subdir and artifact name always exist, as does the name of a
+    # record, and a missing timestamp counts as 0
+    return (
+        clause.op in ["subdir_in", "artifact_in"]
+        or clause.field == "name"
+        or (clause.field == "timestamp" and clause.op in IF_COMPARISONS)
+    )
+
+
+def _compile_if(if_block):
+    """Compile an ``if`` block into a tuple of ``IfClause`` objects.
+
+    The clauses are tested in the order of the block, since a clause may
+    only be valid for the records the clauses before it select, e.g. a
+    ``version_lt`` on records of a ``name`` whose versions all parse. Only
+    the clauses that cannot raise are moved to the front, cheapest first.
+    """
+    clauses = [_compile_if_clause(k, v) for k, v in if_block.items()]
+    first = sorted(filter(_cannot_raise, clauses), key=lambda clause: clause.cost)
+    return tuple(first) + tuple(
+        clause for clause in clauses if not _cannot_raise(clause)
+    )
+
+
+def _test_if_clauses(clauses, record, ctx, fn):
+    for clause in clauses:
+        if clause.test(record, ctx, fn) == clause.neg:
+            return False
+    return True
+
+
+def _test_patch_yaml(patch_yaml, record, subdir, fn):
+    ctx = PatchContext(subdir)
+    return _test_if_clauses(_compile_if(patch_yaml["if"]), record, ctx, fn)
 
 
 def _extract_track_feature(record, feature_name):
@@ -403,206 +669,710 @@ def _pin_looser(fn, record, fix_dep, max_pin=None, upper_bound=None):
             record["depends"] = depends
 
 
-def _apply_patch_yaml(patch_yaml, record, subdir, fn):
-    for inst in patch_yaml["then"]:
-        for k, v in inst.items():
-            if k.startswith("add_") and k[len("add_") :] in ["depends", "constrains"]:
-                subk = k[len("add_") :]
-                if not isinstance(v, list):
-                    v = [v]
-                depends = record.get(subk, [])
+class ThenOp:
+    """One operation of a patch's ``then`` block, compiled once at load time.
+
+    ``apply(record, ctx, fn)`` edits a record of the ``PatchContext`` ``ctx``
+    in place. ``field`` is the record field the operation writes and
+    ``templates`` are the compiled values it renders for each record.
+    """
 
-                v = [_maybe_process_template(_v, record, subdir) for _v in v]
+    __slots__ = ("key", "field", "templates", "apply")
 
-                for _v in v:
-                    if _v not in depends:
-                        depends.append(_v)
+    def __init__(self, key, field, templates, apply):
+        self.key = key
+        self.field = field
+        self.templates = templates
+        self.apply = apply
+
+    def __repr__(self):
+        return "ThenOp(%r)" % self.key
+
+
+def _compile_dep_matcher(template):
+    """Return ``get_match(record, subdir)`` giving a one-argument ``fnmatch``
+    for the pattern ``template`` renders to."""
+    if template.is_constant:
+        match = _compile_fnmatch(template.value)
+
+        def _get_match(record, subdir):
+            return match
+
+    else:
+
+        def _get_match(record, subdir):
+            pat = template(record, subdir)
+            return lambda name: fnmatch(name, pat)
+
+    return _get_match
+
+
+def _cache_rewrite(op):
+    """Cache the results of the rewrite ``op`` of a depends/constrains list.
 
+    The rewritten list only depends on the input list and on the inputs of
+    the op's templates (record fields and subdir), so the result is cached
+    in ``ctx.rewrites`` by those and equal results are hash-consed into one
+    tuple in ``ctx.interned``. Records that produce the same list then share
+    its strings; each record still gets its own list, since later stages
+    edit the lists of the patched index in place.
+    """
+    apply = op.apply
+    field = op.field
+    fields = tuple(sorted({f for template in op.templates for f in template.fields}))
+    uses_subdir = any("subdir" in template.tvars for template in op.templates)
+
+    def _apply(record, ctx, fn):
+        data = record_data(record)
+        deps = data.get(field)
+        if not isinstance(deps, list):
+            apply(record, ctx, fn)
+            return
+
+        deps = tuple(deps)
+        key = (
+            op,
+            deps,
+            tuple(data.get(f, _MISSING) for f in fields),
+            ctx.subdir if uses_subdir else None,
+        )
+        try:
+            res = ctx.rewrites[key]
+        except KeyError:
+            scratch = dict(data)
+            scratch[field] = list(deps)
+            apply(scratch, ctx, fn)
+            res = tuple(scratch[field])
+            res = ctx.rewrites[key] = ctx.interned.setdefault(res, res)
+        if res != deps:
+            record[field] = list(res)
+
+    op.apply = _apply
+    return op
+
+
+def _compile_then_op(k, v):
+    """Compile the ``then`` entry ``k: v`` into a ``ThenOp``.
+
+    Raises ``KeyError`` for keys the patch YAML engine does not understand.
+    """
+    if k.startswith("add_") and k[len("add_") :] in ["depends", "constrains"]:
+        subk = k[len("add_") :]
+        if not isinstance(v, list):
+            v = [v]
+        templates = [Template(_v) for _v in v]
+
+        def _apply(record, ctx, fn):
+            depends = record.get(subk, [])
+            for _v in [template(record, ctx.subdir) for template in templates]:
+                if _v not in depends:
+                    depends.append(_v)
+            record[subk] = depends
+
+        return ThenOp(k, subk, templates, _apply)
+
+    if k.startswith("remove_") and k[len("remove_") :] in ["depends", "constrains"]:
+        subk = k[len("remove_") :]
+        if not isinstance(v, list):
+            v = [v]
+        matchers = [_compile_fnmatch(_v) for _v in v]
+
+        def _apply(record, ctx, fn):
+            depends = record.get(subk, [])
+
+            deps_to_remove = set()
+            for match in matchers:
+                for dep in depends:
+                    if match(dep):
+                        deps_to_remove.add(dep)
+
+            for dep in deps_to_remove:
+                depends.remove(dep)
+
+            if depends:
                 record[subk] = depends
+            elif not depends and subk in record:
+                del record[subk]
 
-            elif k.startswith("remove_") and k[len("remove_") :] in [
-                "depends",
-                "constrains",
-            ]:
-                subk = k[len("remove_") :]
-                if not isinstance(v, list):
-                    v = [v]
-                depends = record.get(subk, [])
+        return ThenOp(k, subk, [], _apply)
 
-                deps_to_remove = set()
-                for _v in v:
-                    for dep in depends:
-                        if fnmatch(dep, _v):
-                            deps_to_remove.add(dep)
-
-                for dep in deps_to_remove:
-                    depends.remove(dep)
-
-                if depends:
-                    record[subk] = depends
-                elif not depends and subk in record:
-                    del record[subk]
-
-            elif k.startswith("reset_") and k[len("reset_") :] in [
-                "depends",
-                "constrains",
-            ]:
-                subk = k[len("reset_") :]
-                if not isinstance(v, list):
-                    v = [v]
-
-                record[subk] = [_maybe_process_template(_v, record, subdir) for _v in v]
-
-            elif k == "remove_track_features":
-                if "track_features" in record and record["track_features"] is not None:
-                    if not isinstance(v, list):
-                        v = [v]
-                    for _v in v:
-                        record["track_features"] = _extract_track_feature(record, _v)
-                        if record["track_features"] is None:
-                            break
-
-            elif k == "add_track_features":
-                if not isinstance(v, list):
-                    v = [v]
-                for _v in v:
-                    record["track_features"] = _add_track_feature(record, _v)
-
-            elif k.startswith("replace_") and k[len("replace_") :] in [
-                "depends",
-                "constrains",
-            ]:
-                subk = k[len("replace_") :]
-                pat = _maybe_process_template(v["old"], record, subdir)
-                for dep in record.get(subk, []):
-                    if fnmatch(dep, pat):
-                        new_dep = _maybe_process_template(
-                            v["new"], record, subdir, old=dep
-                        )
-                        _replace_pin(
-                            dep,
-                            new_dep,
-                            record.get(subk, []),
-                            record,
-                            target=subk,
-                        )
-
-            elif k.startswith("rename_") and k[len("rename_") :] in [
-                "depends",
-                "constrains",
-            ]:
-                subk = k[len("rename_") :]
-                _rename_dependency(
-                    fn,
-                    record,
-                    _maybe_process_template(v["old"], record, subdir),
-                    _maybe_process_template(v["new"], record, subdir),
-                    target=subk,
-                )
+    if k.startswith("reset_") and k[len("reset_") :] in ["depends", "constrains"]:
+        subk = k[len("reset_") :]
+        if not isinstance(v, list):
+            v = [v]
+        templates = [Template(_v) for _v in v]
 
-            elif k == "relax_exact_depends":
-                fix_dep = _maybe_process_template(v["name"], record, subdir)
-                max_pin = v.get("max_pin", None)
-                _relax_exact(fn, record, fix_dep, max_pin=max_pin)
-
-            elif k == "tighten_depends":
-                pat = _maybe_process_template(v["name"], record, subdir)
-                max_pin = v.get("max_pin", None)
-                upper_bound = v.get("upper_bound", None)
-                if upper_bound is not None:
-                    upper_bound = _maybe_process_template(
-                        str(upper_bound), record, subdir
-                    )
-                for dep in record.get("depends", []):
-                    dep_name = dep.split(" ")[0]
-                    if fnmatch(dep_name, pat):
-                        _pin_stricter(
-                            fn,
-                            record,
-                            dep_name,
-                            max_pin,
-                            upper_bound=upper_bound,
-                        )
-
-            elif k == "loosen_depends":
-                pat = _maybe_process_template(v["name"], record, subdir)
-                max_pin = v.get("max_pin", None)
-                upper_bound = v.get("upper_bound", None)
-                if upper_bound is not None:
-                    upper_bound = _maybe_process_template(
-                        str(upper_bound), record, subdir
+        def _apply(record, ctx, fn):
+            record[subk] = [template(record, ctx.subdir) for template in templates]
+
+        return ThenOp(k, subk, templates, _apply)
+
+    if k == "remove_track_features":
+        if not isinstance(v, list):
+            v = [v]
+
+        def _apply(record, ctx, fn):
+            if "track_features" in record and record["track_features"] is not None:
+                for _v in v:
+                    record["track_features"] = _extract_track_feature(record, _v)
+                    if record["track_features"] is None:
+                        break
+
+        return ThenOp(k, "track_features", [], _apply)
+
+    if k == "add_track_features":
+        if not isinstance(v, list):
+            v = [v]
+
+        def _apply(record, ctx, fn):
+            for _v in v:
+                record["track_features"] = _add_track_feature(record, _v)
+
+        return ThenOp(k, "track_features", [], _apply)
+
+    if k.startswith("replace_") and k[len("replace_") :] in ["depends", "constrains"]:
+        subk = k[len("replace_") :]
+        old = Template(v["old"])
+        new = Template(v["new"], allow_old=True)
+        get_match = _compile_dep_matcher(old)
+
+        def _apply(record, ctx, fn):
+            match = get_match(record, ctx.subdir)
+            for dep in record.get(subk, []):
+                if match(dep):
+                    _replace_pin(
+                        dep,
+                        new(record, ctx.subdir, old=dep),
+                        record.get(subk, []),
+                        record,
+                        target=subk,
                     )
-                for dep in record.get("depends", []):
-                    dep_name = dep.split(" ")[0]
-                    if fnmatch(dep_name, pat):
-                        _pin_looser(
-                            fn,
-                            record,
-                            dep_name,
-                            max_pin=max_pin,
-                            upper_bound=upper_bound,
-                        )
 
-            else:
-                raise KeyError("Unrecognized 'then' key '%s'!" % k)
+        return _cache_rewrite(ThenOp(k, subk, [old, new], _apply))
 
+    if k.startswith("rename_") and k[len("rename_") :] in ["depends", "constrains"]:
+        subk = k[len("rename_") :]
+        old = Template(v["old"])
+        new = Template(v["new"])
+
+        def _apply(record, ctx, fn):
+            _rename_dependency(
+                fn,
+                record,
+                old(record, ctx.subdir),
+                new(record, ctx.subdir),
+                target=subk,
+            )
+
+        return _cache_rewrite(ThenOp(k, subk, [old, new], _apply))
+
+    if k == "relax_exact_depends":
+        name = Template(v["name"])
+        max_pin = v.get("max_pin", None)
+
+        def _apply(record, ctx, fn):
+            _relax_exact(fn, record, name(record, ctx.subdir), max_pin=max_pin)
+
+        return _cache_rewrite(ThenOp(k, "depends", [name], _apply))
+
+    if k in ["tighten_depends", "loosen_depends"]:
+        name = Template(v["name"])
+        get_match = _compile_dep_matcher(name)
+        max_pin = v.get("max_pin", None)
+        upper_bound = v.get("upper_bound", None)
+        if upper_bound is not None:
+            upper_bound = Template(str(upper_bound))
+        templates = [name] if upper_bound is None else [name, upper_bound]
+        pin = _pin_stricter if k == "tighten_depends" else _pin_looser
+
+        def _apply(record, ctx, fn):
+            match = get_match(record, ctx.subdir)
+            _upper_bound = None
+            if upper_bound is not None:
+                _upper_bound = upper_bound(record, ctx.subdir)
+            for dep in record.get("depends", []):
+                dep_name = dep.split(" ")[0]
+                if match(dep_name):
+                    pin(fn, record, dep_name, max_pin, upper_bound=_upper_bound)
+
+        return _cache_rewrite(ThenOp(k, "depends", templates, _apply))
+
+    raise KeyError("Unrecognized 'then' key '%s'!" % k)
+
+
+def _compile_then(then_block):
+    """Compile a ``then`` block into a tuple of ``ThenOp`` objects."""
+    return tuple(_compile_then_op(k, v) for inst in then_block for k, v in inst.items())
+
+
+def _apply_then_ops(ops, record, ctx, fn):
+    for op in ops:
+        op.apply(record, ctx, fn)
+
+
+def _apply_patch_yaml(patch_yaml, record, subdir, fn):
+    ctx = PatchContext(subdir)
+    _apply_then_ops(_compile_then(patch_yaml["then"]), record, ctx, fn)
+
+
+# record fields that differ between the .tar.bz2 and .conda files of a build
+ARTIFACT_KEYS = frozenset(
+    ["md5", "sha256", "size", "legacy_bz2_md5", "legacy_bz2_size"]
+)
+
+NEGATED_COMPARISONS = {"lt": "ge", "le": "gt", "gt": "le", "ge": "lt"}
+
+
+def _timestamp_range(clauses):
+    """Return the ``(lo, hi)`` bounds, with ``lo <= timestamp < hi``, that the
+    timestamp comparisons in ``clauses`` impose, or None if there are none.
+    Either bound is None when it is open."""
+    lo = hi = None
+    for clause in clauses:
+        if clause.field != "timestamp" or clause.op not in IF_COMPARISONS:
+            continue
+        op = clause.op
+        if clause.neg:
+            op = NEGATED_COMPARISONS.get(op)
+        if op in ["lt", "le", "eq"]:
+            _hi = clause.value if op == "lt" else clause.value + 1
+            hi = _hi if hi is None else min(hi, _hi)
+        if op in ["gt", "ge", "eq"]:
+            _lo = clause.value + 1 if op == "gt" else clause.value
+            lo = _lo if lo is None else max(lo, _lo)
+    if lo is None and hi is None:
+        return None
+    return lo, hi
+
+
+class PatchRule:
+    """A patch YAML document compiled for repeated evaluation."""
+
+    def __init__(self, patch_yaml, fname):
+        self.patch_yaml = patch_yaml
+        self.fname = fname
+        try:
+            self.clauses = _compile_if(patch_yaml["if"])
+            self.ops = _compile_then(patch_yaml["then"])
+        except KeyError as e:
+            raise KeyError("%s (in '%s')" % (e.args[0], fname)) from e
+        self.timestamp_range = _timestamp_range(self.clauses)
+        # whether the rule can tell the .tar.bz2 and .conda twins of a build
+        # apart
+        self.format_sensitive = any(
+            clause.op == "artifact_in" or clause.field in ARTIFACT_KEYS
+            for clause in self.clauses
+        )
+
+    def test(self, record, ctx, fn):
+        return _test_if_clauses(self.clauses, record, ctx, fn)
+
+    def apply(self, record, ctx, fn):
+        _apply_then_ops(self.ops, record, ctx, fn)
+
+
+ALL_RULES = [PatchRule(patch_yaml, fname) for patch_yaml, fname in ALL_YAMLS]
+RULE_VERSION_CONSTANTS = frozenset(
+    clause.value
+    for rule in ALL_RULES
+    for clause in rule.clauses
+    if clause.field == "version" and clause.op in IF_COMPARISONS
+)
 
 CONDA_PKG_NAME_RE = re.compile(r"^[a-z0-9_.-]+$")
 
 
-def shortlist_relevant_filenames(index, package_name_selector):
-    if CONDA_PKG_NAME_RE.match(package_name_selector) is not None:
-        # package name does not contain wildcards
-        return [
-            fn
-            for fn, record in index.items()
-            if record["name"] == package_name_selector
+def _literal_prefix(pattern):
+    """Return the part of a glob pattern before its first wildcard."""
+    for i, c in enumerate(pattern):
+        if c in "*?[":
+            return pattern[:i]
+    return pattern
+
+
+def _record_timestamp(record):
+    # some records do not have a timestamp
+    return int(record.get("timestamp", 0))
+
+
+class NameIndex:
+    """Filenames of one index section grouped by package name.
+
+    Exact names are resolved with a dict lookup. Glob patterns are only
+    tested against the package names sharing their literal prefix, so the
+    cost of a lookup scales with the number of matching records instead of
+    the size of the index.
+
+    The filenames of each name, and of the section as a whole, are ordered by
+    timestamp so that rules bounded by a timestamp (see
+    ``PatchRule.timestamp_range``) only visit the records inside the bounds.
+    """
+
+    def __init__(self, index):
+        timestamps = {fn: _record_timestamp(record) for fn, record in index.items()}
+        self.fns = sorted(index, key=lambda fn: (timestamps[fn], fn))
+        self.timestamps = [timestamps[fn] for fn in self.fns]
+
+        fns_by_name = defaultdict(list)
+        for fn in self.fns:
+            fns_by_name[index[fn]["name"]].append(fn)
+        self.fns_by_name = dict(fns_by_name)
+        self.timestamps_by_name = {
+            name: [timestamps[fn] for fn in fns]
+            for name, fns in self.fns_by_name.items()
+        }
+        self.names = sorted(self.fns_by_name)
+
+    @staticmethod
+    def _bounds(timestamps, timestamp_range):
+        if timestamp_range is None:
+            return 0, len(timestamps)
+        lo, hi = timestamp_range
+        start = 0 if lo is None else bisect_left(timestamps, lo)
+        stop = len(timestamps) if hi is None else bisect_left(timestamps, hi)
+        return start, stop
+
+    @classmethod
+    def _slice(cls, fns, timestamps, timestamp_range):
+        if timestamp_range is None:
+            return fns
+        start, stop = cls._bounds(timestamps, timestamp_range)
+        return fns[start:stop]
+
+    def timestamp_slice(self, timestamp_range=None):
+        """Return the ``(start, stop)`` positions in ``fns`` of the records
+        inside ``timestamp_range``."""
+        return self._bounds(self.timestamps, timestamp_range)
+
+    def filenames(self, timestamp_range=None):
+        return self._slice(self.fns, self.timestamps, timestamp_range)
+
+    def names_matching(self, pattern):
+        pattern = str(pattern)
+        if CONDA_PKG_NAME_RE.match(pattern) is not None:
+            # package name does not contain wildcards
+            return [pattern] if pattern in self.fns_by_name else []
+
+        prefix = _literal_prefix(pattern)
+        names = []
+        for i in range(bisect_left(self.names, prefix), len(self.names)):
+            name = self.names[i]
+            if not name.startswith(prefix):
+                break
+            if fnmatch(name, pattern):
+                names.append(name)
+        return names
+
+    def filenames_matching(self, patterns, timestamp_range=None):
+        if not isinstance(patterns, list):
+            patterns = [patterns]
+        names = set()
+        for pattern in patterns:
+            names.update(self.names_matching(pattern))
+        fns = [
+            self._slice(
+                self.fns_by_name[name], self.timestamps_by_name[name], timestamp_range
+            )
+            for name in names
         ]
-    return index.keys()
+        if len(fns) == 1:
+            return fns[0]
+        return sorted(fn for _fns in fns for fn in _fns)
+
+
+def _is_literal_pattern(pat):
+    return isinstance(pat, str) and not any(c in pat for c in "*?[")
+
+
+INT_LITERAL_RE = re.compile(r"^(0|[1-9][0-9]*)$")
+
+
+class RecordColumns:
+    """Columnar view of the scalar fields of one index section.
+
+    The records are stored in the timestamp order of ``NameIndex.fns`` with
+    one numpy array per field: name id, subdir id, timestamp, build_number
+    and version rank (from the ``VersionOrdinals`` of the subdir). Numeric
+    and exact-match clauses of rules that do not select on a package name
+    are evaluated as boolean masks over a timestamp slice of the arrays;
+    only the rows that survive are tested by the compiled rule.
+
+    Rows a clause cannot decide from the columns, e.g. records with a
+    version missing from the ordinal table or without a subdir, are kept
+    in the mask so that the compiled rule sees them.
+    """
+
+    def __init__(self, index, fns, versions):
+        self.fns = fns
+        self.versions = versions
+        records = [index[fn] for fn in fns]
+
+        self.ids = {}
+        for field in ["name", "subdir"]:
+            ids = {}
+            for record in records:
+                value = record.get(field)
+                if isinstance(value, str) and value not in ids:
+                    ids[value] = len(ids)
+            self.ids[field] = ids
+
+        self.columns = {
+            "name": np.array(
+                [self.ids["name"].get(record.get("name"), -1) for record in records],
+                dtype=np.int64,
+            ),
+            "subdir": np.array(
+                [
+                    self.ids["subdir"].get(record.get("subdir"), -1)
+                    for record in records
+                ],
+                dtype=np.int64,
+            ),
+            "timestamp": np.array(
+                [_record_timestamp(record) for record in records], dtype=np.int64
+            ),
+            "version": np.array(
+                [versions.ranks.get(record["version"], -1) for record in records],
+                dtype=np.int64,
+            ),
+        }
+        build_numbers = [record.get("build_number") for record in records]
+        if all(type(bn) is int for bn in build_numbers):
+            self.columns["build_number"] = np.array(build_numbers, dtype=np.int64)
+
+    def _id_mask(self, field, values, start, stop):
+        ids = [self.ids[field][v] for v in values if v in self.ids[field]]
+        column = self.columns[field][start:stop]
+        return np.isin(column, ids), column < 0
+
+    def _clause_mask(self, clause, start, stop):
+        """Return ``(mask, undecided)`` for ``clause`` without its negation, or
+        None if the clause cannot be evaluated on the columns."""
+        field, op, value = clause.field, clause.op, clause.value
+        if op in IF_COMPARISONS:
+            if field in ["timestamp", "build_number"]:
+                if field not in self.columns:
+                    return None
+                column = self.columns[field][start:stop]
+                return IF_COMPARISONS[op](column, value), None
+            if field == "version":
+                rank = self.versions.ranks.get(value)
+                if rank is None:
+                    return None
+                column = self.columns["version"][start:stop]
+                return IF_COMPARISONS[op](column, rank), column < 0
+            if field in ["name", "subdir"] and op in ["eq", "ne"]:
+                if not isinstance(value, str):
+                    return None
+                mask, undecided = self._id_mask(field, [value], start, stop)
+                return (mask if op == "eq" else ~mask), undecided
+            return None
+
+        if field in ["name", "subdir"] and op in ["glob", "in"]:
+            values = value if isinstance(value, list) else [value]
+            if not all(_is_literal_pattern(v) for v in values):
+                return None
+            return self._id_mask(field, values, start, stop)
+
+        if field == "build_number" and op == "in" and field in self.columns:
+            values = value if isinstance(value, list) else [value]
+            if not all(INT_LITERAL_RE.match(str(v)) for v in values):
+                return None
+            column = self.columns["build_number"][start:stop]
+            return np.isin(column, [int(v) for v in values]), None
+
+        return None
+
+    def filenames(self, clauses, start, stop):
+        """Return the filenames in ``[start, stop)`` whose columns do not rule
+        out ``clauses``."""
+        mask = np.ones(stop - start, dtype=bool)
+        for clause in clauses:
+            res = self._clause_mask(clause, start, stop)
+            if res is None:
+                continue
+            _mask, undecided = res
+            if clause.neg:
+                _mask = ~_mask
+            if undecided is not None:
+                _mask = _mask | undecided
+            mask &= _mask
+        return [self.fns[start + i] for i in np.flatnonzero(mask)]
+
+
+def shortlist_relevant_filenames(name_index, rule, columns=None):
+    """Return the filenames of the records ``rule`` could apply to.
+
+    If the rule does not select on a package name and the ``RecordColumns``
+    of the section are given, the records are prefiltered with them.
+    """
+    if_block = rule.patch_yaml["if"]
+    if "name" in if_block:
+        return name_index.filenames_matching(if_block["name"], rule.timestamp_range)
+    if "name_in" in if_block:
+        return name_index.filenames_matching(if_block["name_in"], rule.timestamp_range)
+    if columns is None:
+        return name_index.filenames(rule.timestamp_range)
+    start, stop = name_index.timestamp_slice(rule.timestamp_range)
+    return columns.filenames(rule.clauses, start, stop)
+
+
+class RuleTable:
+    """Decision table of the patch rules for one subdir.
+
+    Rules whose ``subdir_in``/``not_subdir_in`` clauses exclude the subdir
+    are dropped when the table is built. The remaining rules are keyed by
+    the exact package names of their ``name``/``name_in`` selector; rules
+    selecting names with wildcards or not selecting on a name at all go to
+    a fallback list. ``candidates`` merges both for a package name in the
+    original rule order.
+    """
+
+    def __init__(self, rules, subdir):
+        ctx = PatchContext(subdir)
+        self.by_name = defaultdict(list)
+        self.wildcard = []
+        self._candidates = {}
+        for pos, rule in enumerate(rules):
+            if any(
+                clause.op == "subdir_in" and clause.test(None, ctx, None) == clause.neg
+                for clause in rule.clauses
+            ):
+                continue
+
+            if_block = rule.patch_yaml["if"]
+            if "name" in if_block:
+                patterns = if_block["name"]
+            elif "name_in" in if_block:
+                patterns = if_block["name_in"]
+            else:
+                self.wildcard.append((pos, rule, None))
+                continue
+
+            if not isinstance(patterns, list):
+                patterns = [patterns]
+            patterns = [str(pattern) for pattern in patterns]
+            if all(CONDA_PKG_NAME_RE.match(pattern) for pattern in patterns):
+                for name in set(patterns):
+                    self.by_name[name].append((pos, rule))
+            else:
+                self.wildcard.append((pos, rule, patterns))
+
+    def candidates(self, name):
+        """Return the rules that could apply to the package ``name``."""
+        if name not in self._candidates:
+            rules = list(self.by_name.get(name, []))
+            rules.extend(
+                (pos, rule)
+                for pos, rule, patterns in self.wildcard
+                if patterns is None
+                or any(fnmatch(name, pattern) for pattern in patterns)
+            )
+            rules.sort(key=lambda pos_rule: pos_rule[0])
+            self._candidates[name] = [rule for _, rule in rules]
+        return self._candidates[name]
+
+
+@lru_cache(maxsize=None)
+def rule_table(subdir):
+    """Return the ``RuleTable`` of all the patch rules for ``subdir``."""
+    return RuleTable(ALL_RULES, subdir)
 
 
-def patch_yaml_edit_index(index, subdir):
+def is_format_sensitive(name, fns, subdir):
+    """Return whether the patch rules for ``subdir`` could patch the files
+    ``fns`` of one build of the package ``name`` differently, i.e. a rule
+    that could apply reads an artifact field (``ARTIFACT_KEYS``) or has an
+    ``artifact_in`` clause that does not give the same result for all files.
+    """
+    ctx = PatchContext(subdir)
+    for rule in rule_table(subdir).candidates(name):
+        if not rule.format_sensitive:
+            continue
+        for clause in rule.clauses:
+            if clause.field in ARTIFACT_KEYS:
+                return True
+            if clause.op == "artifact_in":
+                if len({clause.test(None, ctx, fn) for fn in fns}) > 1:
+                    return True
+    return False
+
+
+PATCH_YAML_ENGINES = ["rules", "records"]
+
+
+def _test_and_apply_rule(rule, record, ctx, fn):
+    try:
+        if rule.test(record_data(record), ctx, fn):
+            rule.apply(record, ctx, fn)
+    except Exception as e:
+        import traceback
+
+        patch_yaml = rule.patch_yaml
+        fname = rule.fname
+        print(
+            "=" * 80
+            + "\n"
+            + "=" * 80
+            + "\nError in testing/applying patch yaml from '%s': \n\n%s"
+            % (fname, yaml.safe_dump(patch_yaml, default_flow_style=False)),
+            flush=True,
+        )
+        try:
+            PatchYaml(**patch_yaml)
+        except Exception as se:
+            print(
+                f"Schema error in '{os.path.basename(fname)}': {se}",
+                flush=True,
+            )
+        print(
+            "=" * 80 + "\n" + "=" * 80,
+            flush=True,
+        )
+        traceback.print_exc()
+        raise e
+
+
+def patch_yaml_edit_index(index, subdir, versions=None, engine=None):
+    """Apply the patch YAML rules to the records of ``index`` in place.
+
+    With the default ``"rules"`` engine each rule is tested against the
+    records it could apply to. The ``"records"`` engine instead visits each
+    record once and tests the candidate rules of its ``rule_table``. Both
+    apply the rules to a record in the same order and give the same result.
+    The engine can also be selected with the ``CF_PATCH_YAML_ENGINE``
+    environment variable.
+    """
+    if engine is None:
+        engine = os.environ.get("CF_PATCH_YAML_ENGINE", "rules")
+    if engine not in PATCH_YAML_ENGINES:
+        raise ValueError(
+            "Unknown patch yaml engine '%s', expected one of %s"
+            % (engine, PATCH_YAML_ENGINES)
+        )
+    if versions is None:
+        versions = VersionOrdinals.from_indexes(index)
+    ctx = PatchContext(subdir, versions=versions)
     keep_pkgs = os.environ.get("CF_PKGS", None)
     if keep_pkgs is not None:
         keep_pkgs = set(keep_pkgs.split(";"))
-    fns = sorted(index)
-    for patch_yaml, fname in ALL_YAMLS:
-        if "name" in patch_yaml["if"]:
-            pkg_name = patch_yaml["if"]["name"]
-            fns_to_process = shortlist_relevant_filenames(index, pkg_name)
-        else:
-            fns_to_process = fns
 
-        for fn in fns_to_process:
+    if engine == "records":
+        table = rule_table(subdir)
+        for fn, record in index.items():
+            if keep_pkgs is not None and record["name"] not in keep_pkgs:
+                continue
+            for rule in table.candidates(record["name"]):
+                _test_and_apply_rule(rule, record, ctx, fn)
+        return index
+
+    name_index = NameIndex(index)
+    columns = RecordColumns(index, name_index.fns, versions)
+    for rule in ALL_RULES:
+        for fn in shortlist_relevant_filenames(name_index, rule, columns=columns):
             record = index[fn]
             if keep_pkgs is not None and record["name"] not in keep_pkgs:
                 continue
-            try:
-                if _test_patch_yaml(patch_yaml, record, subdir, fn):
-                    _apply_patch_yaml(patch_yaml, record, subdir, fn)
-            except Exception as e:
-                import traceback
-
-                print(
-                    "=" * 80
-                    + "\n"
-                    + "=" * 80
-                    + "\nError in testing/applying patch yaml from '%s': \n\n%s"
-                    % (fname, yaml.safe_dump(patch_yaml, default_flow_style=False)),
-                    flush=True,
-                )
-                try:
-                    PatchYaml(**patch_yaml)
-                except Exception as se:
-                    print(
-                        f"Schema error in '{os.path.basename(fname)}': {se}",
-                        flush=True,
-                    )
-                print(
-                    "=" * 80 + "\n" + "=" * 80,
-                    flush=True,
-                )
-                traceback.print_exc()
-                raise e
+            _test_and_apply_rule(rule, record, ctx, fn)
 
     return index
@@ -0,0 +1,246 @@
+"""Copy-on-write views of repodata records.
+
+``_gen_new_index`` used to deep-copy each index section before patching it,
+although only a small fraction of the records ever change. ``cow_index``
+instead wraps every record in a ``CowRecord`` that shares its dict and lists
+with the raw repodata until a patch first writes to it. ``materialize_index``
+turns the patched views back into plain dicts; records that were never
+written to are returned as the raw records themselves. ``dirty_keys``
+records which keys of which records were written to, so that the patch
+instructions only need to compare those.
+"""
+
+from collections.abc import MutableMapping, MutableSequence
+
+_MISSING = object()
+_NONE = frozenset()
+
+
+class CowList(MutableSequence):
+    """A list value of a ``CowRecord`` that is copied on its first write.
+
+    Until then reads go to the list of the raw record. The copy replaces the
+    raw list in the record, unless the record's key was assigned another
+    value in the meantime, in which case only the copy is changed, as with a
+    list that was replaced in a plain dict.
+    """
+
+    __slots__ = ("_record", "_key", "_raw", "_own")
+
+    def __init__(self, record, key, raw):
+        self._record = record
+        self._key = key
+        self._raw = raw
+        self._own = None
+
+    def _list(self):
+        return self._raw if self._own is None else self._own
+
+    def _writable(self):
+        if self._own is None:
+            self._own = list(self._raw)
+            record = self._record
+            if record._data.get(self._key) is self._raw:
+                record._copy_data()
+                record._data[self._key] = self._own
+                record._owned.add(self._key)
+                record._dirty.add(self._key)
+        return self._own
+
+    # reads
+    def __getitem__(self, i):
+        return self._list()[i]
+
+    def __len__(self):
+        return len(self._list())
+
+    def __iter__(self):
+        return iter(self._list())
+
+    def __reversed__(self):
+        return reversed(self._list())
+
+    def __contains__(self, value):
+        return value in self._list()
+
+    def index(self, *args):
+        return self._list().index(*args)
+
+    def count(self, value):
+        return self._list().count(value)
+
+    def __eq__(self, other):
+        if isinstance(other, CowList):
+            other = other._list()
+        return self._list() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __add__(self, other):
+        if isinstance(other, CowList):
+            other = other._list()
+        return self._list() + other
+
+    def __repr__(self):
+        return repr(self._list())
+
+    # writes
+    def __setitem__(self, i, value):
+        self._writable()[i] = value
+
+    def __delitem__(self, i):
+        del self._writable()[i]
+
+    def insert(self, i, value):
+        self._writable().insert(i, value)
+
+    def append(self, value):
+        self._writable().append(value)
+
+    def extend(self, values):
+        self._writable().extend(values)
+
+    def pop(self, i=-1):
+        return self._writable().pop(i)
+
+    def remove(self, value):
+        self._writable().remove(value)
+
+    def clear(self):
+        self._writable().clear()
+
+    def reverse(self):
+        self._writable().reverse()
+
+    def sort(self, **kwargs):
+        self._writable().sort(**kwargs)
+
+    def __iadd__(self, values):
+        self._writable().extend(values)
+        return self
+
+
+class CowRecord(MutableMapping):
+    """A dict-like view of a raw repodata record that is copied on write.
+
+    The first write shallow-copies the record's dict; list values are only
+    copied when they are written to, through the ``CowList`` views returned
+    for them. Lists assigned to the record are owned by it, as in a plain
+    dict.
+    """
+
+    __slots__ = ("_raw", "_data", "_owned", "_dirty", "_views")
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._data = raw
+        # keys whose list values are not shared with the raw record, keys
+        # that were written to and the views of the shared lists; these are
+        # only allocated when needed
+        self._owned = _NONE
+        self._dirty = _NONE
+        self._views = None
+
+    @property
+    def changed(self):
+        """Whether the record was written to."""
+        return self._data is not self._raw
+
+    @property
+    def dirty(self):
+        """The keys that were set, deleted or had their list written to."""
+        return self._dirty
+
+    def _copy_data(self):
+        if self._data is self._raw:
+            self._data = dict(self._raw)
+            self._owned = set()
+            self._dirty = set()
+
+    def _view(self, key, value):
+        if type(value) is not list or key in self._owned:
+            return value
+        if self._views is None:
+            self._views = {}
+        view = self._views.get(key)
+        if view is None or view._raw is not value:
+            view = self._views[key] = CowList(self, key, value)
+        return view
+
+    def __getitem__(self, key):
+        return self._view(key, self._data[key])
+
+    def get(self, key, default=None):
+        value = self._data.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        return self._view(key, value)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __setitem__(self, key, value):
+        self._copy_data()
+        if self._views is not None:
+            self._views.pop(key, None)
+        self._dirty.add(key)
+        if isinstance(value, CowList):
+            if value._own is None:
+                # still the raw list, keep sharing it
+                self._data[key] = value._raw
+                self._owned.discard(key)
+                return
+            value = value._own
+        self._data[key] = value
+        self._owned.add(key)
+
+    def __delitem__(self, key):
+        self._copy_data()
+        del self._data[key]
+        if self._views is not None:
+            self._views.pop(key, None)
+        self._owned.discard(key)
+        self._dirty.add(key)
+
+    def __repr__(self):
+        return "CowRecord(%r)" % (self._data,)
+
+    def materialize(self):
+        """Return the record as a plain dict, the raw record if unchanged."""
+        return self._data
+
+
+def record_data(record):
+    """Return the current dict of a ``CowRecord``, for reading only.
+
+    Plain dicts are returned as is.
+    """
+    return record._data if type(record) is CowRecord else record
+
+
+def cow_index(records):
+    """Wrap the records of an index section in ``CowRecord`` views."""
+    return {fn: CowRecord(record) for fn, record in records.items()}
+
+
+def dirty_keys(index):
+    """Return the keys written to per filename of the changed records."""
+    return {fn: record.dirty for fn, record in index.items() if record.changed}
+
+
+def materialize_index(index):
+    """Return the plain dicts of the ``CowRecord`` views of ``index``.
+
+    Unchanged records and list values are shared with the raw repodata the
+    index was made from, so neither may be edited in place afterwards.
+    """
+    return {fn: record.materialize() for fn, record in index.items()}
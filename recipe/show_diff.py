@@ -2,12 +2,15 @@
 
 import bz2
 import difflib
+import hashlib
 import json
 import os
+import re
+import shutil
+import sys
+import tempfile
 import urllib
-from concurrent.futures import ProcessPoolExecutor, as_completed
-
-from conda_index.index import _apply_instructions
+from collections.abc import Mapping
 
 CACHE_DIR = os.environ.get(
     "CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
@@ -26,114 +29,742 @@ def sort_lists(obj):
     return obj
 
 
-def show_record_diffs(subdir, ref_repodata, new_repodata, fail_fast, group_diffs=True):
+# list order is not significant for these fields
+SET_KEYS = ("depends", "constrains")
+_MISSING = object()
+
+
+def _freeze(value):
+    if value is _MISSING or isinstance(value, (str, int, float, bool, type(None))):
+        return value
+    return ("json", json.dumps(value, sort_keys=True))
+
+
+def _list_layout(ref, new):
+    """Return the changes between two sorted lists of distinct items.
+
+    The items of both lists are walked in order; each removed or added item
+    is kept with whether it is the last of its list, since only the last
+    item is rendered without a trailing comma. Kept items between changes
+    are collapsed into ``"="`` runs, except the ones that are or stop being
+    the last.
+    """
+    ref_last, new_last = ref[-1], new[-1]
+    ref_items, new_items = set(ref), set(new)
+    layout = []
+    for item in sorted(ref_items.union(new_items)):
+        if item not in new_items:
+            entry = ("-", item, item == ref_last)
+        elif item not in ref_items:
+            entry = ("+", item, item == new_last)
+        elif (item == ref_last) != (item == new_last):
+            entry = ("~", item, item == ref_last)
+        else:
+            entry = "="
+        if entry != "=" or (layout and layout[-1] != "="):
+            layout.append(entry)
+    while layout and layout[-1] == "=":
+        layout.pop()
+    return tuple(layout)
+
+
+def _shifted_block(key, pkg, keys, other):
+    """Whether the lines of ``pkg[key]``, missing in the other record, can
+    be rendered at more than one place.
+
+    A list or dict value ends with the same line as a list or dict before
+    it, and ``difflib`` picks either of them depending on the length of the
+    unchanged lines around it.
+    """
+    value = pkg.get(key)
+    if other is not _MISSING or not isinstance(value, (list, dict)) or not value:
+        return False
+    pos = keys.index(key)
+    if pos == 0:
+        return False
+    prev = pkg[keys[pos - 1]]
+    return type(prev) is type(value) and len(prev) > 0
+
+
+def record_diff_key(ref_pkg, new_pkg):
+    """Return a hashable summary of the differences between two records.
+
+    Returns None if the records are the same. Records with the same key have
+    the same ``render_record_diff`` lines. ``license_family`` is ignored,
+    since it gets added for new packages, and the ``depends`` and
+    ``constrains`` lists are compared as sorted lists: their entry is the
+    ``_list_layout`` of the changes if neither list is empty nor has
+    duplicates, otherwise both lists.
+
+    Besides the values that differ, the key keeps what else shows up in the
+    rendered diff: whether a key is the last of its record, which drops the
+    trailing comma of its line, and ``"="`` for each run of unchanged keys
+    between two changed ones, since adjacent changed lines are rendered as
+    one block. Records where that is not enough, see ``_shifted_block``, are
+    keyed by both records.
+    """
+    ref_keys = sorted(k for k in ref_pkg if k != "license_family")
+    new_keys = sorted(k for k in new_pkg if k != "license_family")
+    ref_last = ref_keys[-1] if ref_keys else None
+    new_last = new_keys[-1] if new_keys else None
+    diff = []
+    for key in sorted(set(ref_keys).union(new_keys)):
+        ref = ref_pkg.get(key, _MISSING)
+        new = new_pkg.get(key, _MISSING)
+        if _shifted_block(key, ref_pkg, ref_keys, new) or _shifted_block(
+            key, new_pkg, new_keys, ref
+        ):
+            return (
+                (
+                    "records",
+                    _freeze(
+                        sort_lists(dict(zip(ref_keys, map(ref_pkg.get, ref_keys))))
+                    ),
+                    _freeze(
+                        sort_lists(dict(zip(new_keys, map(new_pkg.get, new_keys))))
+                    ),
+                ),
+            )
+        commas = (key != ref_last, key != new_last)
+        if key in SET_KEYS and isinstance(ref, list) and isinstance(new, list):
+            ref, new = sorted(ref), sorted(new)
+        if ref == new and type(ref) is type(new) and commas[0] == commas[1]:
+            entry = "="
+        elif (
+            key in SET_KEYS
+            and isinstance(ref, list)
+            and isinstance(new, list)
+            and ref
+            and new
+            and len(set(ref)) == len(ref)
+            and len(set(new)) == len(new)
+        ):
+            entry = (key, commas, _list_layout(ref, new))
+        else:
+            entry = (key, commas, _freeze(ref), _freeze(new))
+        if entry != "=" or (diff and diff[-1] != "="):
+            diff.append(entry)
+    while diff and diff[-1] == "=":
+        diff.pop()
+    return tuple(diff) or None
+
+
+def record_digest(record):
+    """Return a digest of the canonical form of a record.
+
+    ``license_family`` is left out and the ``depends`` and ``constrains``
+    lists are sorted, so records with the same digest have no
+    ``record_diff_key``.
+    """
+    canonical = {
+        k: sorted(v) if k in SET_KEYS and isinstance(v, list) else v
+        for k, v in record.items()
+        if k != "license_family"
+    }
+    dump = json.dumps(canonical, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(dump.encode(), digest_size=16).hexdigest()
+
+
+def repodata_digests(repodata):
+    """Return the ``record_digest`` of each record of ``repodata``."""
+    return {
+        index_key: {
+            name: record_digest(record)
+            for name, record in repodata.get(index_key, {}).items()
+        }
+        for index_key in ["packages", "packages.conda"]
+    }
+
+
+# bump when record_digest changes
+DIGESTS_VERSION = 1
+
+
+def _digests_source(repodata_path):
+    stat = os.stat(repodata_path)
+    return [DIGESTS_VERSION, stat.st_size, stat.st_mtime_ns]
+
+
+def read_repodata_digests(repodata_path):
+    """Return the digests cached next to ``repodata_path``, None if stale."""
+    try:
+        with open(repodata_path + ".digests.json") as fh:
+            cached = json.load(fh)
+        if cached["source"] == _digests_source(repodata_path):
+            return cached["digests"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def write_repodata_digests(repodata_path, digests):
+    """Cache the ``repodata_digests`` of ``repodata_path`` next to it."""
+    digests_path = repodata_path + ".digests.json"
+    try:
+        source = _digests_source(repodata_path)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(digests_path) or ".", suffix=".json.tmp"
+        )
+    except OSError:
+        # the digests are only a cache
+        return
+    try:
+        with os.fdopen(fd, "w") as fh:
+            json.dump({"source": source, "digests": digests}, fh)
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, digests_path)
+    except OSError:
+        os.remove(tmp_path)
+
+
+def load_repodata_digests(repodata_path, repodata):
+    """Return the ``repodata_digests`` of the repodata read from ``repodata_path``.
+
+    The digests are cached in a file next to ``repodata_path`` and reused as
+    long as that file is not replaced, e.g. by a new download.
+    """
+    digests = read_repodata_digests(repodata_path)
+    if digests is None:
+        digests = repodata_digests(repodata)
+        write_repodata_digests(repodata_path, digests)
+    return digests
+
+
+_JSON_WS = re.compile(r"[ \t\n\r]*")
+
+
+class _JSONStream:
+    """Parse JSON values one at a time from a text file read in chunks."""
+
+    def __init__(self, fh, chunk_size=1 << 20):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.fh.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+
+    def skip_ws(self):
+        while True:
+            self.pos = _JSON_WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.eof:
+                return
+            self._fill()
+
+    def peek(self):
+        self.skip_ws()
+        if self.pos >= len(self.buf):
+            raise ValueError("unexpected end of JSON stream")
+        return self.buf[self.pos]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(
+                "expected %r at %r" % (char, self.buf[self.pos : self.pos + 40])
+            )
+        self.pos += 1
+
+    def value(self):
+        self.skip_ws()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            else:
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            self._fill()
+
+    def members(self):
+        """Yield the keys of an object; the caller parses each value."""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise ValueError("expected ',' or '}' after the value of %r" % key)
+
+
+def iter_repodata_records(repodata_path):
+    """Yield ``(index_key, filename, record)`` from a ``repodata.json.bz2`` file.
+
+    The file is parsed one record at a time, so unlike ``json.load`` the
+    whole repodata is never held in memory. The records come in file order.
+    """
+    with bz2.open(repodata_path, "rt") as fh:
+        stream = _JSONStream(fh)
+        for key in stream.members():
+            if key in ["packages", "packages.conda"]:
+                for fn in stream.members():
+                    yield key, fn, stream.value()
+            else:
+                stream.value()
+
+
+def render_record_diff(ref_pkg, new_pkg):
+    """Return the unified diff lines of the JSON dumps of two records."""
+    ref_pkg = {k: v for k, v in ref_pkg.items() if k != "license_family"}
+    new_pkg = {k: v for k, v in new_pkg.items() if k != "license_family"}
+
+    # list order is not significant for depends and constrains
+    ref_lines = json.dumps(
+        sort_lists(ref_pkg),
+        indent=2,
+        sort_keys=True,
+    ).splitlines()
+    new_lines = json.dumps(
+        sort_lists(new_pkg),
+        indent=2,
+        sort_keys=True,
+    ).splitlines()
+
+    return [
+        ln
+        for ln in difflib.unified_diff(ref_lines, new_lines, n=0, lineterm="")
+        if not (ln.startswith("+++") or ln.startswith("---") or ln.startswith("@@"))
+    ]
+
+
+def iter_record_diffs(subdir, ref_records, new_repodata, ref_digests=None):
+    """Yield the records of ``ref_records`` that differ in ``new_repodata``.
+
+    ``ref_records`` yields ``(index_key, filename, record)``, e.g. from the
+    items of the reference repodata or from ``iter_repodata_records``. For
+    each differing record ``(record_diff_key, filename, ref_record,
+    new_record)`` is yielded.
+
+    Records that are not equal are first compared by their ``record_digest``;
+    ``ref_digests`` are the ``repodata_digests`` of the reference repodata if
+    already known, otherwise they are computed as needed.
+    """
     keep_pkgs = os.environ.get("CF_PKGS", None)
     if keep_pkgs is not None:
         keep_pkgs = set(keep_pkgs.split(";"))
 
-    if group_diffs:
-        final_lines = {}
-    else:
-        final_lines = []
-    for index_key in ["packages", "packages.conda"]:
-        for name, ref_pkg in ref_repodata[index_key].items():
-            if name in new_repodata[index_key]:
-                new_pkg = new_repodata[index_key][name]
-            else:
-                new_pkg = {}
+    for index_key, name, ref_pkg in ref_records:
+        new_pkg = new_repodata[index_key].get(name, {})
 
-            if keep_pkgs is not None and ref_pkg["name"] not in keep_pkgs:
+        if keep_pkgs is not None and ref_pkg["name"] not in keep_pkgs:
+            continue
+
+        # most records are the same, and those that only differ in
+        # license_family or list order have the same digest
+        if name in new_repodata[index_key]:
+            if ref_pkg == new_pkg:
+                continue
+            ref_digest = None
+            if ref_digests is not None:
+                ref_digest = ref_digests[index_key].get(name)
+            if (ref_digest or record_digest(ref_pkg)) == record_digest(new_pkg):
                 continue
 
-            # license_family gets added for new packages, ignore it in the diff
-            ref_pkg.pop("license_family", None)
-            new_pkg.pop("license_family", None)
+        key = record_diff_key(ref_pkg, new_pkg)
+        if key is not None:
+            yield key, name, ref_pkg, new_pkg
 
-            # list order is not significant for depends and constrains
-            ref_pkg = sort_lists(ref_pkg)
-            new_pkg = sort_lists(new_pkg)
 
-            if ref_pkg == new_pkg:
-                continue
+def _repodata_records(repodata):
+    for index_key in ["packages", "packages.conda"]:
+        for name, record in repodata[index_key].items():
+            yield index_key, name, record
 
-            ref_lines = json.dumps(
-                ref_pkg,
-                indent=2,
-                sort_keys=True,
-            ).splitlines()
-            new_lines = json.dumps(
-                new_pkg,
-                indent=2,
-                sort_keys=True,
-            ).splitlines()
-
-            if group_diffs:
-                _key = []
-                for ln in difflib.unified_diff(ref_lines, new_lines, n=0, lineterm=""):
-                    if (
-                        ln.startswith("+++")
-                        or ln.startswith("---")
-                        or ln.startswith("@@")
-                    ):
-                        continue
-                    _key.append(ln)
-                _key = tuple(_key)
-                if _key not in final_lines:
-                    final_lines[_key] = set()
-                final_lines[_key].add(f"{subdir}::{name}")
-            else:
-                final_lines.append()
-                for ln in difflib.unified_diff(ref_lines, new_lines, n=0, lineterm=""):
-                    if (
-                        ln.startswith("+++")
-                        or ln.startswith("---")
-                        or ln.startswith("@@")
-                    ):
-                        continue
-                    final_lines.append(ln)
-
-            if final_lines and fail_fast:
-                return final_lines
 
+def show_record_diffs(
+    subdir, ref_repodata, new_repodata, fail_fast, group_diffs=True, ref_digests=None
+):
+    """Return the differences between the records of two repodata.
+
+    ``ref_repodata`` is either a repodata dict or an iterable of the
+    ``(index_key, filename, record)`` of the reference records, see
+    ``iter_record_diffs``. Only one record per group of differences is kept,
+    so a streamed reference repodata is never held in memory.
+    """
+    if isinstance(ref_repodata, dict):
+        ref_repodata = _repodata_records(ref_repodata)
+
+    # the records are grouped by record_diff_key, each group is rendered once
+    groups = {}
+    final_lines = []
+    for key, name, ref_pkg, new_pkg in iter_record_diffs(
+        subdir, ref_repodata, new_repodata, ref_digests=ref_digests
+    ):
+        if group_diffs:
+            if key not in groups:
+                groups[key] = (ref_pkg, new_pkg, set())
+            groups[key][2].add(f"{subdir}::{name}")
+        else:
+            final_lines.append(f"{subdir}::{name}")
+            final_lines.extend(render_record_diff(ref_pkg, new_pkg))
+
+        if fail_fast:
+            break
+
+    if group_diffs:
+        return _render_groups(groups)
     return final_lines
 
 
+def _render_groups(groups):
+    # groups whose keys differ only in unchanged keys render the same
+    final_lines = {}
+    for ref_pkg, new_pkg, names in groups.values():
+        lines = tuple(render_record_diff(ref_pkg, new_pkg))
+        final_lines.setdefault(lines, set()).update(names)
+    return final_lines
+
+
+def _streamed_digests(ref_records, digests):
+    """Pass ``ref_records`` through and collect their digests in ``digests``."""
+    for index_key, name, record in ref_records:
+        digests[index_key][name] = record_digest(record)
+        yield index_key, name, record
+
+
+def _stream_record_diffs(
+    subdir, ref_repodata_path, new_repodata, fail_fast, group_diffs=True
+):
+    """``show_record_diffs`` reading the reference records from their file."""
+    ref_records = iter_repodata_records(ref_repodata_path)
+    ref_digests = read_repodata_digests(ref_repodata_path)
+    if ref_digests is not None:
+        return show_record_diffs(
+            subdir,
+            ref_records,
+            new_repodata,
+            fail_fast,
+            group_diffs=group_diffs,
+            ref_digests=ref_digests,
+        )
+
+    ref_digests = {"packages": {}, "packages.conda": {}}
+    diffs = show_record_diffs(
+        subdir,
+        _streamed_digests(ref_records, ref_digests),
+        new_repodata,
+        fail_fast,
+        group_diffs=group_diffs,
+        ref_digests=ref_digests,
+    )
+    if not (fail_fast and diffs):
+        write_repodata_digests(ref_repodata_path, ref_digests)
+    return diffs
+
+
+def _patch_record(record, patch):
+    """Return a copy of ``record`` updated with ``patch`` like conda_index does.
+
+    Lists and scalars replace the old values, dicts are patched recursively
+    and a None value deletes the key, or sets it to None if it is missing.
+    """
+    record = dict(record)
+    for key, value in patch.items():
+        if hasattr(value, "keys"):
+            old = record.get(key)
+            record[key] = _patch_record(old, value) if hasattr(old, "keys") else value
+        elif value is None and key in record:
+            del record[key]
+        else:
+            record[key] = value
+    return record
+
+
+class PatchedRecords(Mapping):
+    """A read-only view of an index section with patch instructions applied.
+
+    Only the records with patches or revocations are patched, when first
+    looked up; all other lookups go to the raw records, which are never
+    modified. Removed filenames are left out.
+    """
+
+    def __init__(self, records, patches, revoked, removed):
+        self._records = records
+        # the patches of each filename, in the order they are applied
+        self._patches = patches
+        # the number of revocations of each filename
+        self._revoked = revoked
+        self._removed = removed
+        self._patched = {}
+
+    def __getitem__(self, fn):
+        if fn in self._removed:
+            raise KeyError(fn)
+        record = self._records[fn]
+        if fn not in self._patches and fn not in self._revoked:
+            return record
+        try:
+            return self._patched[fn]
+        except KeyError:
+            pass
+        for patch in self._patches.get(fn, ()):
+            record = _patch_record(record, patch)
+        if fn in self._revoked:
+            record = dict(record)
+            record["revoked"] = True
+            record["depends"] = record["depends"] + (
+                ["package_has_been_revoked"] * self._revoked[fn]
+            )
+        self._patched[fn] = record
+        return record
+
+    def __contains__(self, fn):
+        return fn not in self._removed and fn in self._records
+
+    def __iter__(self):
+        return (fn for fn in self._records if fn not in self._removed)
+
+    def __len__(self):
+        return len(self._records) - sum(fn in self._records for fn in self._removed)
+
+
+def apply_instructions_view(subdir, repodata, instructions):
+    """Return ``repodata`` patched with ``instructions`` without copying it.
+
+    The result is what ``conda_index.index._apply_instructions`` makes of
+    ``repodata``, except that the index sections are ``PatchedRecords``
+    views and ``repodata`` itself is left alone.
+    """
+    sections = {"packages": {}, "packages.conda": {}}
+    for fn, patch in instructions.get("packages", {}).items():
+        sections["packages"].setdefault(fn, []).append(patch)
+        conda_fn = fn.replace(".tar.bz2", ".conda")
+        sections["packages.conda"].setdefault(conda_fn, []).append(patch)
+    for fn, patch in instructions.get("packages.conda", {}).items():
+        sections["packages.conda"].setdefault(fn, []).append(patch)
+
+    revoked = {"packages": {}, "packages.conda": {}}
+    removed = {"packages": set(), "packages.conda": set()}
+    for fns, targets in [
+        (instructions.get("revoke", ()), revoked),
+        (instructions.get("remove", ()), removed),
+    ]:
+        for fn in fns:
+            for index_key in ["packages", "packages.conda"]:
+                if index_key == "packages.conda" and fn.endswith(".tar.bz2"):
+                    fn = fn[: -len(".tar.bz2")] + ".conda"
+                if fn not in repodata.get(index_key, {}):
+                    continue
+                if targets is revoked:
+                    revoked[index_key][fn] = revoked[index_key].get(fn, 0) + 1
+                else:
+                    removed[index_key].add(fn)
+
+    new_repodata = dict(repodata)
+    new_removed = list(repodata.get("removed", []))
+    for index_key in ["packages", "packages.conda"]:
+        records = repodata.get(index_key, {})
+        # records are only removed once, and not when empty
+        new_removed.extend(fn for fn in removed[index_key] if records[fn])
+        new_repodata[index_key] = PatchedRecords(
+            records,
+            {
+                fn: patches
+                for fn, patches in sections[index_key].items()
+                if fn in records
+            },
+            revoked[index_key],
+            removed[index_key],
+        )
+    new_repodata["removed"] = sorted(new_removed)
+    return new_repodata
+
+
+def load_patch_instructions(source, subdir):
+    """Read the ``patch_instructions.json`` of ``subdir`` from ``source``.
+
+    ``source`` is a local directory or a base URL laid out like the output
+    of ``gen_patch_json.py``, i.e. with ``<subdir>/patch_instructions.json``.
+    """
+    if "://" in source:
+        url = f"{source.rstrip('/')}/{subdir}/patch_instructions.json"
+        with urllib.request.urlopen(url) as fh:
+            return json.load(fh)
+    with open(os.path.join(source, subdir, "patch_instructions.json")) as fh:
+        return json.load(fh)
+
+
+def _patched_filenames(instructions):
+    """Return the filenames per section that ``_apply_instructions`` touches."""
+    fns = {"packages": set(), "packages.conda": set()}
+    for fn in instructions.get("packages", {}):
+        fns["packages"].add(fn)
+        fns["packages.conda"].add(fn.replace(".tar.bz2", ".conda"))
+    fns["packages.conda"].update(instructions.get("packages.conda", {}))
+    for fn in [*instructions.get("revoke", ()), *instructions.get("remove", ())]:
+        fns["packages"].add(fn)
+        if fn.endswith(".tar.bz2"):
+            fn = fn[: -len(".tar.bz2")] + ".conda"
+        fns["packages.conda"].add(fn)
+    return fns
+
+
+def instructions_record_diffs(
+    subdir,
+    raw_repodata,
+    ref_instructions,
+    new_instructions,
+    fail_fast,
+    group_diffs=True,
+):
+    """Return the ``show_record_diffs`` between two sets of patch instructions.
+
+    The reference records are the records of ``raw_repodata`` patched with
+    ``ref_instructions``, e.g. the published ones, instead of the downloaded
+    ``repodata.json.bz2``. Only the records either set of instructions
+    touches can differ, so only those are patched and compared.
+    """
+    fns = _patched_filenames(ref_instructions)
+    for index_key, new_fns in _patched_filenames(new_instructions).items():
+        fns[index_key].update(new_fns)
+    records = {
+        index_key: {
+            fn: record
+            for fn, record in raw_repodata[index_key].items()
+            if fn in fns[index_key]
+        }
+        for index_key in ["packages", "packages.conda"]
+    }
+
+    ref_repodata = apply_instructions_view(subdir, records, ref_instructions)
+    new_repodata = apply_instructions_view(subdir, records, new_instructions)
+    return show_record_diffs(
+        subdir, ref_repodata, new_repodata, fail_fast, group_diffs=group_diffs
+    )
+
+
 def do_subdir(
-    subdir, raw_repodata_path, ref_repodata_path, fail_fast, group_diffs=True
+    subdir,
+    raw_repodata_path,
+    ref_repodata_path,
+    fail_fast,
+    group_diffs=True,
+    stream_ref=False,
+    ref_instructions=None,
 ):
     from gen_patch_json import _gen_new_index, _gen_patch_instructions
+    from get_license_family import save_license_families
 
     with bz2.open(raw_repodata_path) as fh:
         raw_repodata = json.load(fh)
-    with bz2.open(ref_repodata_path) as fh:
-        ref_repodata = json.load(fh)
     new_index = _gen_new_index(raw_repodata, subdir)
+    save_license_families()
     instructions = _gen_patch_instructions(raw_repodata, new_index, subdir)
-    new_repodata = _apply_instructions(subdir, raw_repodata, instructions)
+    if ref_instructions is not None:
+        return instructions_record_diffs(
+            subdir,
+            raw_repodata,
+            ref_instructions,
+            instructions,
+            fail_fast,
+            group_diffs=group_diffs,
+        )
+
+    new_repodata = apply_instructions_view(subdir, raw_repodata, instructions)
+    if stream_ref:
+        return _stream_record_diffs(
+            subdir, ref_repodata_path, new_repodata, fail_fast, group_diffs=group_diffs
+        )
+
+    with bz2.open(ref_repodata_path) as fh:
+        ref_repodata = json.load(fh)
     return show_record_diffs(
-        subdir, ref_repodata, new_repodata, fail_fast, group_diffs=group_diffs
+        subdir,
+        ref_repodata,
+        new_repodata,
+        fail_fast,
+        group_diffs=group_diffs,
+        ref_digests=load_repodata_digests(ref_repodata_path, ref_repodata),
     )
 
 
+def spill_record_diffs(diffs, path):
+    """Write ``diffs`` to ``path`` as the lines they are printed as.
+
+    ``diffs`` is the result of ``show_record_diffs``: for each group, the
+    names of its records are followed by the lines of its diff. Workers
+    spill their diffs instead of returning them, so that the parent only
+    has to copy the file to its output, see ``print_spilled_diffs``.
+    Returns whether there are any diffs.
+    """
+    with open(path, "w") as fh:
+        if isinstance(diffs, dict):
+            for key, names in diffs.items():
+                fh.writelines(name + "\n" for name in names)
+                fh.writelines(line + "\n" for line in key)
+        else:
+            fh.writelines(line + "\n" for line in diffs)
+    return bool(diffs)
+
+
+def print_spilled_diffs(path):
+    """Copy the diffs spilled to ``path`` to stdout and remove the file."""
+    sys.stdout.flush()
+    with open(path) as fh:
+        shutil.copyfileobj(fh, sys.stdout)
+    sys.stdout.flush()
+    os.remove(path)
+
+
 def download_subdir(subdir, raw_repodata_path, ref_repodata_path):
     raw_url = f"{BASE_URL}/{subdir}/repodata_from_packages.json.bz2"
     urllib.request.urlretrieve(raw_url, raw_repodata_path)
+    if ref_repodata_path is None:
+        return
     ref_url = f"{BASE_URL}/{subdir}/repodata.json.bz2"
     urllib.request.urlretrieve(ref_url, ref_repodata_path)
 
 
-def _process_subdir(subdir, use_cache, fail_fast, group_diffs=True):
+def _process_subdir(
+    subdir,
+    spill_dir,
+    use_cache,
+    fail_fast,
+    group_diffs=True,
+    stream_ref=False,
+    prev_instructions=None,
+):
     subdir_dir = os.path.join(CACHE_DIR, subdir)
     if not os.path.exists(subdir_dir):
         os.makedirs(subdir_dir)
     raw_repodata_path = os.path.join(subdir_dir, "repodata_from_packages.json.bz2")
     ref_repodata_path = os.path.join(subdir_dir, "repodata.json.bz2")
+    ref_instructions = None
+    if prev_instructions is not None:
+        # the reference records are rebuilt from the raw repodata
+        ref_instructions = load_patch_instructions(prev_instructions, subdir)
+        ref_repodata_path = None
     if not use_cache:
         download_subdir(subdir, raw_repodata_path, ref_repodata_path)
     vals = do_subdir(
-        subdir, raw_repodata_path, ref_repodata_path, fail_fast, group_diffs=group_diffs
+        subdir,
+        raw_repodata_path,
+        ref_repodata_path,
+        fail_fast,
+        group_diffs=group_diffs,
+        stream_ref=stream_ref,
+        ref_instructions=ref_instructions,
     )
-    return subdir, vals
+    path = os.path.join(spill_dir, subdir + ".diff")
+    return subdir, path, spill_record_diffs(vals, path)
 
 
 if __name__ == "__main__":
@@ -156,40 +787,74 @@ if __name__ == "__main__":
     parser.add_argument(
         "--no-group-diffs", action="store_true", help="do not group diffs by content"
     )
+    parser.add_argument(
+        "--stream-ref",
+        action="store_true",
+        help="read the reference repodata record by record to save memory",
+    )
+    parser.add_argument(
+        "--prev-instructions",
+        default=None,
+        metavar="SOURCE",
+        help=(
+            "compare against the raw repodata patched with the patch "
+            "instructions in SOURCE/<subdir>/patch_instructions.json, a local "
+            "directory or base URL, instead of downloading the current repodata"
+        ),
+    )
     args = parser.parse_args()
 
-    from gen_patch_json import SUBDIRS
+    from gen_patch_json import SUBDIRS, worker_pool
+    from subdir_schedule import (
+        SubdirScheduler,
+        estimate_costs,
+        log_schedule,
+        max_memory,
+        read_stats,
+        repodata_sizes,
+        run_stats,
+        schedule_order,
+        write_stats,
+    )
 
     if args.subdirs is None:
         subdirs = SUBDIRS
     else:
         subdirs = args.subdirs
 
-    with ProcessPoolExecutor() as exc:
-        futs = [
-            exc.submit(
+    # start the subdirs expected to take longest first, as many at once as
+    # fit into MAX_MEMORY
+    stats_path = os.path.join(CACHE_DIR, "show_diff_stats.json")
+    stats = read_stats(stats_path)
+    sizes = repodata_sizes(subdirs, BASE_URL, CACHE_DIR, known=stats)
+    costs = estimate_costs(subdirs, sizes, stats)
+    subdirs = schedule_order(subdirs, costs)
+    budget = max_memory()
+    log_schedule(subdirs, costs, budget)
+
+    with tempfile.TemporaryDirectory() as spill_dir, worker_pool(None) as exc:
+        scheduler = SubdirScheduler(exc, None, budget)
+        for subdir in subdirs:
+            scheduler.submit(
+                ("subdir", subdir),
+                *costs[subdir],
                 _process_subdir,
                 subdir,
+                spill_dir,
                 args.use_cache,
                 args.fail_fast,
                 group_diffs=not args.no_group_diffs,
+                stream_ref=args.stream_ref,
+                prev_instructions=args.prev_instructions,
             )
-            for subdir in subdirs
-        ]
-        for fut in as_completed(futs):
-            subdir, vals = fut.result()
+        for _, fut in scheduler.as_completed():
+            subdir, path, has_diffs = fut.result()
             print("=" * 80, flush=True)
             print("=" * 80, flush=True)
-            if args.fail_fast and vals:
+            if args.fail_fast and has_diffs:
                 print(subdir + " has non-zero patch diff", flush=True)
             else:
                 print(subdir, flush=True)
-            if args.no_group_diffs:
-                for val in vals:
-                    print(val, flush=True)
-            else:
-                for key, val in vals.items():
-                    for v in val:
-                        print(v, flush=True)
-                    for k in key:
-                        print(k, flush=True)
+            print_spilled_diffs(path)
+
+    write_stats(run_stats(subdirs, sizes, stats, scheduler.seconds), stats_path)
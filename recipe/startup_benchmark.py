@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Measure the time from creating the worker pool to the first record patched.
+
+``spawn`` starts each worker from scratch, importing the modules and parsing
+the YAML rules again, and ``fork`` uses ``worker_pool``, whose workers are
+forked with the rules the parent parsed on import. Each mode runs in its own
+process so that the modes do not share any loaded state.
+"""
+
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+MODES = ("spawn", "fork")
+
+
+def _first_record(created, subdir):
+    from gen_patch_json import _gen_new_index_tracked
+
+    repodata = {
+        "packages": {
+            "numpy-1.21.0-py39h0_0.tar.bz2": {
+                "name": "numpy",
+                "version": "1.21.0",
+                "build": "py39h0_0",
+                "build_number": 0,
+                "depends": ["python >=3.9,<3.10.0a0", "libblas >=3.8.0,<4.0a0"],
+                "license": "BSD-3-Clause",
+                "subdir": subdir,
+                "timestamp": 1625000000000,
+            }
+        },
+        "packages.conda": {},
+    }
+    _gen_new_index_tracked(repodata, subdir)
+    return time.time() - created
+
+
+def run_mode(mode, workers, subdirs):
+    """Return the seconds until each of ``workers`` patched its first record."""
+    import gen_patch_json
+
+    created = time.time()
+    if mode == "fork":
+        exc = gen_patch_json.worker_pool(workers)
+    else:
+        exc = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context(mode)
+        )
+    with exc:
+        futs = [
+            exc.submit(_first_record, created, subdirs[i % len(subdirs)])
+            for i in range(workers)
+        ]
+        return sorted(fut.result() for fut in futs)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="number of workers"
+    )
+    parser.add_argument(
+        "--subdirs",
+        nargs="*",
+        default=["linux-64", "noarch"],
+        help="subdir(s) the workers patch a record of",
+    )
+    parser.add_argument(
+        "--modes", nargs="*", default=list(MODES), choices=MODES, help="pool modes"
+    )
+    parser.add_argument("--run-mode", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_mode is not None:
+        times = run_mode(args.run_mode, args.workers, args.subdirs)
+        print(" ".join(f"{t:.3f}" for t in times))
+        return
+
+    for mode in args.modes:
+        out = subprocess.run(
+            [sys.executable, __file__, "--run-mode", mode]
+            + ["--workers", str(args.workers), "--subdirs"]
+            + args.subdirs,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        times = [float(t) for t in out.split()]
+        print(
+            f"{mode}: first record after {times[0]:.2f}s, "
+            f"on all {len(times)} workers after {times[-1]:.2f}s",
+            flush=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""Largest-first, memory-aware scheduling of subdir jobs on a process pool.
+
+The time and memory it takes to patch or diff a subdir grow with the size of
+its repodata, and linux-64 is many times the size of the smallest subdirs.
+Submitting the subdirs in ``SUBDIRS`` order can start the biggest ones last,
+and running several of them at once can exhaust the memory of a small build
+agent. ``SubdirScheduler`` starts the jobs with the largest expected run time
+first and only as many at once as fit into a ``MAX_MEMORY`` budget, based on
+the compressed size of the repodata and the stats of the previous run.
+"""
+
+import json
+import os
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from show_diff import CACHE_DIR
+
+STATS_PATH = os.path.join(CACHE_DIR, "subdir_stats.json")
+# rough peak memory of a job per byte of the compressed raw repodata: the
+# bz2 JSON expands about tenfold and its Python objects take several times
+# the size of the JSON again
+MEMORY_PER_COMPRESSED_BYTE = 60
+RAW_REPODATA = "repodata_from_packages.json.bz2"
+_UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_memory(value):
+    """Parse a number of bytes like ``"8G"``, ``"512M"`` or ``"1000000"``."""
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in _UNITS:
+        return int(float(value[:-1]) * _UNITS[value[-1]])
+    return int(value)
+
+
+def max_memory():
+    """Return the ``MAX_MEMORY`` budget in bytes, None if not set."""
+    if os.environ.get("MAX_MEMORY"):
+        return parse_memory(os.environ["MAX_MEMORY"])
+    return None
+
+
+def _format_memory(value):
+    for unit in "TGMK":
+        if value >= _UNITS[unit]:
+            return f"{value / _UNITS[unit]:.1f}{unit}"
+    return str(value)
+
+
+def read_stats(path=STATS_PATH):
+    """Return the stats of the previous run by subdir, empty if there are none."""
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_stats(stats, path=STATS_PATH):
+    """Merge ``stats`` into the stats file, see ``read_stats``."""
+    merged = read_stats(path)
+    merged.update(stats)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".json.tmp")
+    except OSError:
+        # the stats are only a hint
+        return
+    try:
+        with os.fdopen(fd, "w") as fh:
+            json.dump(merged, fh, indent=2, sort_keys=True)
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.remove(tmp_path)
+
+
+def repodata_sizes(subdirs, base_url, cache_dir=None, known=()):
+    """Return the compressed sizes of the raw repodata of ``subdirs``.
+
+    The sizes are read from the files in ``cache_dir/<subdir>`` if there are
+    any, or else from a HEAD request, except for the subdirs in ``known``.
+    Subdirs whose size cannot be found are left out.
+    """
+    sizes = {}
+    for subdir in subdirs:
+        path = cache_dir and os.path.join(cache_dir, subdir, RAW_REPODATA)
+        if path and os.path.exists(path):
+            sizes[subdir] = os.path.getsize(path)
+        elif subdir not in known:
+            url = f"{base_url}/{subdir}/{RAW_REPODATA}"
+            try:
+                request = urllib.request.Request(url, method="HEAD")
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    sizes[subdir] = int(response.headers["Content-Length"])
+            except (OSError, TypeError, ValueError):
+                pass
+    return sizes
+
+
+def estimate_costs(subdirs, sizes, stats):
+    """Return the expected ``(seconds, memory)`` of each of ``subdirs``.
+
+    ``sizes`` has the compressed size of the raw repodata of the subdirs that
+    are known before the run, e.g. from a cache or a HEAD request, and
+    ``stats`` the sizes and run times of the previous run. Subdirs without
+    a run time are expected to take as long per byte as the others took on
+    average, and subdirs without any size to be as large as the largest
+    known one. Without any run times, the sizes stand in for the seconds.
+    """
+    known = {}
+    for subdir in subdirs:
+        size = sizes.get(subdir) or stats.get(subdir, {}).get("size")
+        if size:
+            known[subdir] = size
+    default_size = max(known.values(), default=0)
+    timed = [
+        (stats[subdir]["seconds"], stats[subdir]["size"])
+        for subdir in subdirs
+        if stats.get(subdir, {}).get("seconds") and stats[subdir].get("size")
+    ]
+    rate = sum(t[0] for t in timed) / sum(t[1] for t in timed) if timed else 1
+    costs = {}
+    for subdir in subdirs:
+        size = known.get(subdir, default_size)
+        seconds = stats.get(subdir, {}).get("seconds") or size * rate
+        costs[subdir] = (seconds, size * MEMORY_PER_COMPRESSED_BYTE)
+    return costs
+
+
+def log_schedule(subdirs, costs, budget):
+    """Print the order the subdirs are started in and their expected costs."""
+    budget = "unlimited" if budget is None else _format_memory(budget)
+    print(f"schedule (memory budget {budget}):", flush=True)
+    for subdir in subdirs:
+        seconds, memory = costs[subdir]
+        print(
+            f"  {subdir}: priority {seconds:.1f}, memory ~{_format_memory(memory)}",
+            flush=True,
+        )
+
+
+def schedule_order(subdirs, costs):
+    """Return ``subdirs`` ordered from the largest to the smallest expected cost."""
+    return sorted(subdirs, key=lambda subdir: -costs[subdir][0])
+
+
+def run_stats(subdirs, sizes, stats, seconds):
+    """Return the stats of this run, see ``read_stats``.
+
+    ``seconds`` has the run times of the jobs of a ``SubdirScheduler`` whose
+    tags are ``(stage, subdir)``; the times of all stages of a subdir add up.
+    """
+    totals = {}
+    for (_, subdir), value in seconds.items():
+        totals[subdir] = totals.get(subdir, 0) + value
+    new_stats = {}
+    for subdir in subdirs:
+        if subdir not in totals:
+            continue
+        new_stats[subdir] = {"seconds": round(totals[subdir], 3)}
+        size = sizes.get(subdir) or stats.get(subdir, {}).get("size")
+        if size:
+            new_stats[subdir]["size"] = size
+    return new_stats
+
+
+class SubdirScheduler:
+    """Submit jobs to ``exc`` by priority and within a memory budget.
+
+    Jobs are started in order of decreasing priority, as long as fewer than
+    ``max_workers`` are running and the sum of their memory costs stays within
+    ``max_memory``. A job that does not fit waits for running jobs to finish,
+    and the jobs after it wait as well, so that it is not delayed further;
+    a job larger than the whole budget runs alone.
+    """
+
+    def __init__(self, exc, max_workers, max_memory=None):
+        self._exc = exc
+        self._max_workers = max_workers or os.cpu_count() or 1
+        self._max_memory = max_memory
+        self._queue = []
+        self._submitted = 0
+        self._running = {}
+        self._memory = 0
+        self.seconds = {}
+
+    def submit(self, tag, priority, memory, fn, *args, **kwargs):
+        """Queue ``fn(*args, **kwargs)``, yielded by ``as_completed`` as ``tag``."""
+        self._queue.append((priority, self._submitted, tag, memory, fn, args, kwargs))
+        self._submitted += 1
+        self._queue.sort(key=lambda item: (item[0], -item[1]))
+        self._start()
+
+    def _start(self):
+        while self._queue and len(self._running) < self._max_workers:
+            memory = self._queue[-1][3]
+            if (
+                self._running
+                and self._max_memory is not None
+                and self._memory + memory > self._max_memory
+            ):
+                break
+            _, _, tag, memory, fn, args, kwargs = self._queue.pop()
+            fut = self._exc.submit(fn, *args, **kwargs)
+            self._running[fut] = (tag, memory, time.perf_counter())
+            self._memory += memory
+
+    def as_completed(self):
+        """Yield ``(tag, future)`` of the jobs as they finish.
+
+        Jobs submitted while iterating are yielded as well.
+        """
+        while self._running:
+            done, _ = wait(self._running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                tag, memory, start = self._running.pop(fut)
+                self._memory -= memory
+                self.seconds[tag] = time.perf_counter() - start
+                self._start()
+                yield tag, fut
@@ -1,5 +1,32 @@
-from gen_patch_json import _gen_patch_instructions, REMOVALS, add_python_abi
+from gen_patch_json import (
+    _add_dirty_diffs,
+    _artifact_twins,
+    _check_patch_instructions,
+    _gen_new_index,
+    _gen_new_index_per_key,
+    _gen_new_index_tracked,
+    _gen_patch_instructions,
+    _gen_shard_instructions,
+    REMOVALS,
+    _python_abi_constrains,
+    _shard_repodata,
+    add_python_abi,
+    changes,
+    worker_pool,
+)
+import get_license_family
+from patch_yaml_utils import patch_yaml_edit_index, rule_table
+from record_store import CowRecord, materialize_index
+from collections import defaultdict
 import copy
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+
+import pytest
 
 
 def test_gen_patch_instructions():
@@ -125,3 +152,378 @@ def test_add_python_abi():
     }
     add_python_abi(exact_record, "osx-64")
     assert exact_record["constrains"] == []
+
+
+def test_gen_new_index_artifact_twins():
+    def _record(name, version, build, **kwargs):
+        record = {
+            "name": name,
+            "version": version,
+            "build": build,
+            "build_number": 0,
+            "depends": ["python >=3.6", "xarray >=0.16.1", "numpy"],
+            "subdir": "noarch",
+            "timestamp": 1600000000000,
+            "md5": "a",
+            "size": 1,
+        }
+        record.update(kwargs)
+        return record
+
+    repodata = {"packages": {}, "packages.conda": {}}
+    for name, version, build in [
+        ("arviz", "0.11.2", "pyhd8ed1ab_0"),
+        ("arviz", "0.11.1", "pyhd8ed1ab_0"),
+        ("foo", "1.0", "pyhd8ed1ab_0"),
+    ]:
+        stem = "%s-%s-%s" % (name, version, build)
+        repodata["packages"][stem + ".tar.bz2"] = _record(name, version, build)
+        repodata["packages.conda"][stem + ".conda"] = _record(
+            name, version, build, md5="b", size=2, legacy_bz2_md5="a"
+        )
+    repodata["packages.conda"]["foo-1.0-pyhd8ed1ab_0.conda"]["timestamp"] += 1
+
+    # artifact_in selects the .tar.bz2 file only, and foo differs in timestamp
+    assert _artifact_twins(repodata, "noarch") == {
+        "arviz-0.11.1-pyhd8ed1ab_0.conda": "arviz-0.11.1-pyhd8ed1ab_0.tar.bz2"
+    }
+
+    new_index = _gen_new_index(repodata, "noarch")
+    _check_dirty_diffs(repodata, "noarch")
+    for index_key in ["packages", "packages.conda"]:
+        index = _gen_new_index_per_key(repodata, "noarch", index_key)
+        patch_yaml_edit_index(index, "noarch")
+        assert new_index[index_key] == materialize_index(index)
+    assert (
+        new_index["packages.conda"]["arviz-0.11.1-pyhd8ed1ab_0.conda"]
+        is not new_index["packages"]["arviz-0.11.1-pyhd8ed1ab_0.tar.bz2"]
+    )
+
+
+def test_gen_new_index_copy_on_write():
+    repodata = _per_key_fixture("linux-64")
+    raw = copy.deepcopy(repodata)
+
+    new_index = _gen_new_index(repodata, "linux-64")
+    assert repodata == raw
+    assert new_index["packages"] != raw["packages"]
+    for fn, record in new_index["packages"].items():
+        if record == raw["packages"][fn]:
+            assert record is repodata["packages"][fn]
+        else:
+            assert record is not repodata["packages"][fn]
+
+
+def _check_dirty_diffs(repodata, subdir):
+    new_index, dirty = _gen_new_index_tracked(repodata, subdir)
+    for pkgs_section_key in ["packages", "packages.conda"]:
+        for fn, record in repodata[pkgs_section_key].items():
+            if fn not in dirty[pkgs_section_key]:
+                assert new_index[pkgs_section_key][fn] is record
+
+    instructions = {"packages": defaultdict(dict), "packages.conda": defaultdict(dict)}
+    _add_dirty_diffs(instructions, repodata, new_index, dirty)
+    _check_patch_instructions(instructions, repodata, new_index)
+    return instructions, new_index
+
+
+@pytest.mark.parametrize("subdir", ["linux-64", "osx-64", "win-64"])
+def test_gen_patch_instructions_dirty(subdir):
+    repodata = _per_key_fixture(subdir)
+    instructions, new_index = _check_dirty_diffs(repodata, subdir)
+    assert instructions["packages"]
+
+    instructions["packages"].popitem()
+    with pytest.raises(AssertionError):
+        _check_patch_instructions(instructions, repodata, new_index)
+
+
+@pytest.mark.parametrize("shards", [1, 2, 3, 4])
+def test_gen_shard_instructions(shards):
+    repodata = _per_key_fixture("linux-64")
+    instructions = _gen_shard_instructions(repodata, "linux-64")
+    assert instructions["packages"]
+
+    parts = _shard_repodata(repodata, shards)
+    assert len(parts) == shards
+    names = [
+        {record["name"] for section in part.values() for record in section.values()}
+        for part in parts
+    ]
+    assert sum(len(part_names) for part_names in names) == len(set().union(*names))
+
+    merged = {"packages": {}, "packages.conda": {}}
+    for part in parts:
+        part_instructions = _gen_shard_instructions(part, "linux-64", verify=True)
+        for pkgs_section_key in merged:
+            merged[pkgs_section_key].update(part_instructions[pkgs_section_key])
+    assert json.dumps(merged, sort_keys=True) == json.dumps(
+        instructions, sort_keys=True
+    )
+
+
+def _loaded_rule_tables():
+    return rule_table.cache_info().currsize
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="forks on linux")
+def test_worker_pool_forks():
+    # the workers inherit what this process has loaded
+    rule_table.cache_clear()
+    rule_table("noarch")
+    with worker_pool(2) as exc:
+        assert exc.submit(_loaded_rule_tables).result() == 1
+
+
+def test_cow_record():
+    raw = {"name": "foo", "depends": ["a", "b"], "constrains": ["c"]}
+    record = CowRecord(raw)
+    depends = record["depends"]
+    assert depends == ["a", "b"] and not record.changed
+
+    depends.append("d")
+    record["depends"] = depends
+    record["constrains"] = record["constrains"]
+    record.get("constrains").remove("c")
+    del record["name"]
+    assert raw == {"name": "foo", "depends": ["a", "b"], "constrains": ["c"]}
+    assert record.materialize() == {"depends": ["a", "b", "d"], "constrains": []}
+    assert record.materialize()["depends"] is depends._own
+    assert record.dirty == {"name", "depends", "constrains"}
+
+    # a stale view does not write to a replaced value
+    record = CowRecord(raw)
+    depends = record["depends"]
+    record["depends"] = ["x"]
+    depends.append("y")
+    assert record.materialize()["depends"] == ["x"]
+    assert raw["depends"] == ["a", "b"]
+
+
+def _per_key_fixture(subdir):
+    """Records hitting each of the hardcoded patches of _gen_new_index_per_key."""
+    old = 1500000000000
+    new = 1700000000000
+    records = [
+        ("python", "2.7.15", "h1_0", old, ["openssl"], {}),
+        ("python", "3.6.7", "h2_0", old, ["vc 14.*"], {"track_features": "x"}),
+        ("python", "3.7.1", "h3_pypy", old, ["pypy3.7"], {}),
+        ("foo", "1.0", "py36_0", old, ["python >=3.6,<3.7.0a0"], {"license": "MIT"}),
+        ("foo", "1.1", "py_0", old, ["python >=3.6"], {"license": "BSD-3-Clause"}),
+        ("foo", "1.2", "py27_0", old, ["python <3", "python_abi 2.7.* *_cp27mu"], {}),
+        ("foo", "1.3", "h1_0", old, ["python 3.8.*"], {"features": "vc14"}),
+        ("foo", "1.4", "h1_0", new, ["numpy =1.11", "six =1.1|1.2"], {}),
+        ("python_abi", "3.7", "1_pypy37_pp73", old, [], {}),
+        ("pybind11", "2.2.1", "py36_0", new, ["python >=3.6,<3.7.0a0"], {}),
+        ("pybind11", "2.4.3", "py37_0", new, [], {"constrains": ["foo"]}),
+        ("pybind11-global", "2.6.1", "py38_0", new, [], {}),
+        ("vs2015_runtime", "14.16.27012", "hf0eaf9b_3", old, [], {}),
+        ("bar", "1.0", "h1_0", old, ["libflang >=5.0.0", "libllvm8 8.0.1 h1_0"], {}),
+        ("clang", "5.0.0", "h1_0", new, ["libllvm9 9.0.0 h1_0"], {}),
+        ("llvm", "5.0.0", "h1_0", new, [], {"constrains": ["clang 5.0.0"]}),
+        (
+            "gcc_impl_" + subdir,
+            "7.3.0",
+            "h1_0",
+            old,
+            ["binutils_impl_" + subdir + " 2.31 h1_0"],
+            {},
+        ),  # noqa
+        ("gcc_impl_" + subdir, "9.3.0", "h1_0", old, [], {}),
+        ("gxx_impl_" + subdir, "10.2.0", "h1_0", old, ["sysroot_linux-64"], {}),
+        ("gfortran_impl_" + subdir, "8.4.0", "h1_0", old, [], {}),
+        ("gfortran", "7.3.0", "h1_0", old, ["gfortran_" + subdir, "libgfortran"], {}),
+        ("baz", "1.0", "h1_0", old, ["libgfortran >=3.0.1"], {}),
+        ("baz", "1.1", "h1_0", old, ["libgfortran >=3.0"], {}),
+        ("baz", "1.2", "h1_0", old, ["libgfortran >=4"], {}),
+        ("cctools", "921", "h1_0", old, ["libcxx 4.0.1"], {}),
+        ("pyqt", "5.9.2", "py37h2a560b1_3", new, [], {}),
+        ("kernel-headers_linux-aarch64", "2.17", "h1_0", old, [], {}),
+        ("sysroot_linux-ppc64le", "2.17", "h1_0", old, ["kernel-headers 2.17"], {}),
+        ("binutils", "2.31", "h1_0", old, [], {}),
+        ("ld_impl_" + subdir, "2.31", "h1_0", old, [], {}),
+        ("gcc_" + subdir, "7.3.0", "h1_0", old, [], {}),
+        ("root_base", "6.20", "py37_0", old, ["python >=3.7,<3.8.0a0"], {}),
+        ("mesa-libgl-cos6-x86_64", "11.0.7", "h1_0", new, [], {}),
+        ("libx11-cos7-aarch64", "1.6.7", "h1_0", new, [], {"constrains": ["a"]}),
+        ("libx11-cos7-ppc64le", "1.6.7", "h1_0", new, ["sysroot_linux-ppc64le"], {}),
+        ("sysroot-cos7-x86_64", "2.17", "h1_0", new, [], {}),
+        ("libclang", "8.0.1", "h1_0", new, ["libllvm8 8.0.1 h1_0"], {}),
+        ("flang", "5.0.0", "h1_0", new, ["libflang 5.0.0"], {}),
+        ("flang", "6.0.0", "h1_0", new, ["libflang 6.0.0"], {}),
+        ("cling", "0.9", "h1_0", old, [], {}),
+        ("cling", "0.5", "h1_0", new, [], {"constrains": ["gcc"]}),
+    ]
+    packages = {}
+    for name, version, build, timestamp, depends, extra in records:
+        record = {
+            "name": name,
+            "version": version,
+            "build": build,
+            "build_number": 0,
+            "depends": list(depends),
+            "subdir": subdir,
+            "timestamp": timestamp,
+        }
+        record.update(copy.deepcopy(extra))
+        packages["%s-%s-%s.tar.bz2" % (name, version, build)] = record
+    return {"packages": packages, "packages.conda": {}}
+
+
+# sha256 of the JSON dump of _gen_new_index_per_key(_per_key_fixture(subdir))
+# before its patches were split into RECORD_HANDLERS
+PER_KEY_FIXTURE_DIGESTS = {
+    "noarch": "c2beacbd92c15d0384e7d14ba236d7492733554b77aa5099ca266ce82f578194",
+    "linux-64": "2a36e119abda6d5a3c00aa07c83dd4751991ae130432345a4f0bc849538d8e54",
+    "linux-aarch64": "f6f78d5fde80d2943e72fa555ec82febaa18e07881f497de73dcb5f78f743771",
+    "linux-ppc64le": "e1d346da6ef938ec4a0a39f756aca932cf55ee6b3bad7c043e2bf004ec11cc73",
+    "osx-64": "5aafb595771eb6bc7218ea9ff32ca3b523c8e3d63ee362788e65a06a00954945",
+    "osx-arm64": "e7e36592fe22271cb1a5dc235fb83313c08dbc6be44e069d2177cf7895e9db4f",
+    "win-64": "4f8c9d1eda5700e05bf5f1980343bf9d51f16d8970da4ac4c140c23e4d9f20bb",
+}
+
+
+@pytest.mark.parametrize("subdir", sorted(PER_KEY_FIXTURE_DIGESTS))
+def test_gen_new_index_per_key_fixture(subdir):
+    new_index = _gen_new_index_per_key(_per_key_fixture(subdir), subdir, "packages")
+    new_index = materialize_index(new_index)
+    dump = json.dumps(new_index, indent=2, sort_keys=True)
+    assert hashlib.sha256(dump.encode()).hexdigest() == PER_KEY_FIXTURE_DIGESTS[subdir]
+
+
+def _python_abi_fixture():
+    specs = [
+        "python",
+        "python >=2.7,<2.8.0a0",
+        "python 3.5.*",
+        "python >=3.8.0a,<3.9.0a0",
+        "python 2.7*",
+        "python >=3.6",
+        "python >=2.7,<3",
+        "python <3",
+        "python 2.6*",
+        "python >=3.10,<3.11.0a0",
+        "python >=3.7,<3.9",
+        "python 3.4*",
+        "python >=3.6.1",
+        "python 3.6.* *_cpython",
+        "python 3.9.*",
+        "python =3.7",
+    ]
+    builds = ["0", "py27_0", "py36h1234567_0", "py310h1_1", "np111py35_0", "pypy37_0"]
+    builds.append("h1_0")
+    extra_depends = [
+        [],
+        ["pypy"],
+        ["python_abi 3.7.* *_cp37m"],
+        ["numpy"],
+        ["python >=3.5"],
+    ]
+    records = [
+        {"name": "foo", "version": "1.0", "build": build, "depends": [spec] + extra}
+        for spec, build, extra in itertools.product(specs, builds, extra_depends)
+    ]
+    records.extend(
+        [
+            {"name": "python", "version": "3.6.8", "build": "0"},
+            {
+                "name": "python",
+                "version": "2.7.15",
+                "build": "h1_0",
+                "constrains": ["a"],
+            },
+            {"name": "python", "version": "3.7.1", "build": "h1_pypy"},
+            {
+                "name": "bar",
+                "version": "1.0",
+                "build": "py36_0",
+                "depends": ["python 3.6.*", "python >=3.6"],
+                "constrains": ["x"],
+            },
+        ]
+    )
+    return records
+
+
+# sha256 of the JSON dump of the _python_abi_fixture records and the sorted
+# changes after add_python_abi, before its results were cached
+PYTHON_ABI_FIXTURE_DIGESTS = {
+    "linux-64": "c9c4705b7fa6617cae68afe988537376e92b660db5477ed03079918de36f42e6",
+    "osx-64": "084a76b750849cbb4828e32daeb29696b9151577cd218758e8dc89b23fff8207",
+}
+
+
+@pytest.mark.parametrize("subdir", sorted(PYTHON_ABI_FIXTURE_DIGESTS))
+def test_add_python_abi_fixture(subdir):
+    _python_abi_constrains.cache_clear()
+    # the second pass only hits the cache
+    for _ in range(2):
+        changes.clear()
+        records = _python_abi_fixture()
+        for record in records:
+            add_python_abi(record, subdir)
+        dump = json.dumps([records, sorted(changes)], sort_keys=True)
+        assert (
+            hashlib.sha256(dump.encode()).hexdigest()
+            == PYTHON_ABI_FIXTURE_DIGESTS[subdir]
+        )
+    assert _python_abi_constrains.cache_info().hits > 0
+
+
+def test_get_license_family_cache(tmp_path, monkeypatch):
+    path = str(tmp_path / "license_families.json")
+    monkeypatch.setattr(get_license_family, "LICENSE_FAMILIES_PATH", path)
+    monkeypatch.setattr(get_license_family, "_families", None)
+    monkeypatch.setattr(get_license_family, "_new_families", {})
+
+    licenses = {
+        "MIT": "MIT",
+        "BSD-3-Clause AND GPL-3.0-or-later": "GPL",
+        "MIT AND Apache-2.0": None,
+        "GPL-2.0-only WITH Classpath-exception-2.0": "GPL",
+        "(((": None,
+    }
+    for license, family in licenses.items():
+        assert get_license_family.get_license_family(license) == family
+    get_license_family.save_license_families()
+    with open(path) as fh:
+        assert json.load(fh)["families"] == licenses
+
+    # a new process reads the table instead of parsing the strings again
+    monkeypatch.setattr(get_license_family, "_families", None)
+    monkeypatch.setattr(
+        get_license_family, "_parse_license_family", lambda license: "PARSED"
+    )
+    assert get_license_family.get_license_family("MIT") == "MIT"
+    assert get_license_family.get_license_family("Zlib") == "PARSED"
+    get_license_family.save_license_families()
+    with open(path) as fh:
+        assert json.load(fh)["families"] == dict(licenses, Zlib="PARSED")
+
+
+def _save_license_families(worker):
+    for i in range(20):
+        get_license_family._new_families[f"L{worker}-{i}"] = "MIT"
+        get_license_family.save_license_families()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs fork")
+def test_save_license_families_concurrently(tmp_path, monkeypatch):
+    path = str(tmp_path / "license_families.json")
+    monkeypatch.setattr(get_license_family, "LICENSE_FAMILIES_PATH", path)
+    monkeypatch.setattr(get_license_family, "_new_families", {})
+
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=_save_license_families, args=(w,)) for w in range(4)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    assert all(proc.exitcode == 0 for proc in procs)
+
+    # no worker lost the entries another one saved in the meantime
+    with open(path) as fh:
+        assert json.load(fh)["families"] == {
+            f"L{w}-{i}": "MIT" for w in range(4) for i in range(20)
+        }
+    assert os.stat(path).st_mode & 0o777 == 0o644
@@ -0,0 +1,80 @@
+import bz2
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import gen_patch_json
+from gen_patch_json import _gen_shard_instructions
+from patch_jobs import merge_partials, plan_jobs, select_names
+from test_gen_patch_json import _per_key_fixture
+
+RECIPE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def input_dir(tmp_path):
+    subdir_dir = tmp_path / "input" / "linux-64"
+    subdir_dir.mkdir(parents=True)
+    with bz2.open(subdir_dir / "repodata_from_packages.json.bz2", "wt") as fh:
+        json.dump(_per_key_fixture("linux-64"), fh)
+    return str(tmp_path / "input")
+
+
+def test_plan_jobs(input_dir):
+    repodata = _per_key_fixture("linux-64")
+    jobs = plan_jobs(["linux-64"], input_dir, 3)
+    assert [job["id"] for job in jobs] == [
+        "linux-64-000",
+        "linux-64-001",
+        "linux-64-002",
+    ]
+    assert jobs[0]["names"][0] is None and jobs[-1]["names"][1] is None
+    assert len({job["rules"] for job in jobs}) == 1
+
+    parts = [select_names(repodata, *job["names"]) for job in jobs]
+    for pkgs_section_key in ["packages", "packages.conda"]:
+        fns = [fn for part in parts for fn in part[pkgs_section_key]]
+        assert sorted(fns) == sorted(repodata[pkgs_section_key])
+    assert all(part["packages"] for part in parts)
+
+
+def test_run_and_merge_jobs(input_dir, tmp_path, monkeypatch):
+    jobs_dir = tmp_path / "jobs"
+    partials_dir = tmp_path / "partials"
+    env = dict(os.environ, CACHE_DIR=str(tmp_path / "cache"))
+
+    def _patch_jobs(*args):
+        subprocess.run(
+            [sys.executable, "patch_jobs.py", "--input-dir", input_dir, *args],
+            cwd=RECIPE_DIR,
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+    _patch_jobs(
+        "plan", str(jobs_dir), "--subdirs", "linux-64", "--jobs-per-subdir", "3"
+    )
+    for job_path in sorted(jobs_dir.iterdir()):
+        _patch_jobs("run", str(job_path), str(partials_dir), "--verify")
+
+    partials = [json.loads(path.read_text()) for path in sorted(partials_dir.iterdir())]
+    assert len(partials) == 3
+
+    monkeypatch.setattr(gen_patch_json, "_add_removals", lambda *args: None)
+    instructions = merge_partials("linux-64", partials)
+    expected = _gen_shard_instructions(_per_key_fixture("linux-64"), "linux-64")
+    for pkgs_section_key in ["packages", "packages.conda"]:
+        assert instructions[pkgs_section_key] == expected[pkgs_section_key]
+
+    with pytest.raises(ValueError, match="starts at"):
+        merge_partials("linux-64", partials[:1] + partials[2:])
+    with pytest.raises(ValueError, match="no job covers"):
+        merge_partials("linux-64", partials[:2])
+    with pytest.raises(ValueError, match="differ in rules"):
+        stale = json.loads(json.dumps(partials[1]))
+        stale["job"]["rules"] = "0" * 64
+        merge_partials("linux-64", [partials[0], stale, partials[2]])
@@ -1,9 +1,24 @@
+import copy
 from pathlib import Path
 
 import pytest
 import yaml
 
-from patch_yaml_utils import _test_patch_yaml, _apply_patch_yaml, ALLOWED_TEMPLATE_KEYS
+from patch_yaml_utils import (
+    _test_patch_yaml,
+    _apply_patch_yaml,
+    ALL_RULES,
+    ALLOWED_TEMPLATE_KEYS,
+    NameIndex,
+    PatchContext,
+    PatchRule,
+    RecordColumns,
+    Template,
+    VersionOrdinals,
+    patch_yaml_edit_index,
+    rule_table,
+    shortlist_relevant_filenames,
+)
 from patch_yaml_model import generate_schema, PatchYaml
 
 
@@ -130,6 +145,37 @@ def test_test_patch_yaml_op():
     assert _test_patch_yaml(patch_yaml, record, None, None)
 
 
+def test_test_patch_yaml_clause_order():
+    # the version is only compared for the records the clauses before it
+    # select; only clauses that cannot raise are moved ahead of it
+    record = {"name": "bar", "version": "1..0", "build_number": 0}
+    for if_block in [
+        {"name": "foo", "version_lt": "2.0"},
+        {"version_lt": "2.0", "name": "foo"},
+        {"build_number_gt": 5, "version_lt": "2.0"},
+    ]:
+        assert not _test_patch_yaml({"if": if_block}, record, None, None)
+    with pytest.raises(ValueError, match="1..0"):
+        _test_patch_yaml(
+            {"if": {"name": "bar", "version_lt": "2.0"}}, record, None, None
+        )
+
+
+def test_version_ordinals():
+    versions = VersionOrdinals(["1.0", "1.0.0", "0.9", "1.10", "1.2rc1", "foo-bar"])
+    assert versions.ranks["0.9"] < versions.ranks["1.0"]
+    assert versions.ranks["1.0"] == versions.ranks["1.0.0"]
+    assert versions.ranks["1.0"] < versions.ranks["1.2rc1"] < versions.ranks["1.10"]
+    assert "foo-bar" not in versions.ranks
+
+    assert versions.compare("1.10", "1.2rc1") == 1
+    assert versions.compare("1.0", "1.0.0") == 0
+    assert versions.compare("0.9", "1.0") == -1
+    # versions missing from the table are parsed
+    assert versions.compare("1.1", "1.0") == 1
+    assert versions.compare("0.1", "0.9") == -1
+
+
 def test_test_patch_yaml_in():
     patch_yaml = {"if": {"build_number_in": 10}}
     record = {"build_number": 10}
@@ -170,6 +216,14 @@ def test_test_patch_yaml_in():
     assert not _test_patch_yaml(patch_yaml, record, None, "blah")
 
 
+def test_test_patch_yaml_unknown_key():
+    with pytest.raises(KeyError):
+        _test_patch_yaml({"if": {"blah_lt": 10}}, {"blah": 9}, None, None)
+
+    with pytest.raises(KeyError, match="foo.yaml"):
+        PatchRule({"if": {"not_has_blah": "numpy"}, "then": []}, "foo.yaml")
+
+
 @pytest.mark.parametrize("sec", ["depends", "constrains"])
 def test_test_patch_yaml_has(sec):
     patch_yaml = {"if": {f"has_{sec}": "numpy"}}
@@ -285,6 +339,29 @@ def test_apply_patch_yaml_add_template(key, rkey):
         )
 
 
+def test_template():
+    template = Template("numpy >=1.0")
+    assert template.is_constant
+    assert template({"version": "1.2"}, "linux-64") == "numpy >=1.0"
+
+    template = Template("${name} ==${version} *_${build_number}")
+    assert not template.is_constant
+    assert template.fields == ("build_number", "name", "version")
+    record = {"name": "foo", "version": "1.2", "build_number": 3}
+    assert template(record, "linux-64") == "foo ==1.2 *_3"
+    assert template(record | {"build_number": 4}, "osx-64") == "foo ==1.2 *_4"
+    assert len(template.cache) == 2
+
+    template = Template("${old},<$next_version", allow_old=True)
+    assert template.fields == ("version",)
+    assert template({"version": "1.2"}, None, old="numpy >=1") == "numpy >=1,<1.3"
+
+
+def test_apply_patch_yaml_unknown_key():
+    with pytest.raises(KeyError):
+        _apply_patch_yaml({"then": [{"add_blah": "numpy"}]}, {}, None, None)
+
+
 @pytest.mark.parametrize("key", ["depends", "constrains"])
 def test_apply_patch_yaml_remove(key):
     patch_yaml = {"then": [{"remove_" + key: "blah"}]}
@@ -553,6 +630,285 @@ def test_apply_patch_yaml_loosen(pre, post):
     assert record == {"depends": pre + ["numpy >=1.0.0,<3.1.2.0a0"] + post}
 
 
+def test_name_index():
+    index = {
+        "numpy-1.0-0.tar.bz2": {"name": "numpy"},
+        "numpy-1.1-0.tar.bz2": {"name": "numpy"},
+        "numpy-base-1.0-0.tar.bz2": {"name": "numpy-base"},
+        "numpydoc-1.0-0.tar.bz2": {"name": "numpydoc"},
+        "scipy-1.0-0.tar.bz2": {"name": "scipy"},
+    }
+    name_index = NameIndex(index)
+
+    assert name_index.filenames_matching("numpy") == [
+        "numpy-1.0-0.tar.bz2",
+        "numpy-1.1-0.tar.bz2",
+    ]
+    assert name_index.filenames_matching("blah") == []
+    assert name_index.filenames_matching("numpy*") == [
+        "numpy-1.0-0.tar.bz2",
+        "numpy-1.1-0.tar.bz2",
+        "numpy-base-1.0-0.tar.bz2",
+        "numpydoc-1.0-0.tar.bz2",
+    ]
+    assert name_index.filenames_matching("numpy-*") == ["numpy-base-1.0-0.tar.bz2"]
+    assert name_index.filenames_matching("*py") == [
+        "numpy-1.0-0.tar.bz2",
+        "numpy-1.1-0.tar.bz2",
+        "scipy-1.0-0.tar.bz2",
+    ]
+    assert name_index.filenames_matching(["scipy", "numpy-base"]) == [
+        "numpy-base-1.0-0.tar.bz2",
+        "scipy-1.0-0.tar.bz2",
+    ]
+
+
+def test_name_index_timestamps():
+    index = {
+        "a-1-0.tar.bz2": {"name": "a", "timestamp": 30},
+        "a-2-0.tar.bz2": {"name": "a", "timestamp": 10},
+        "a-3-0.tar.bz2": {"name": "a"},
+        "b-1-0.tar.bz2": {"name": "b", "timestamp": 20},
+    }
+    name_index = NameIndex(index)
+    assert name_index.filenames() == [
+        "a-3-0.tar.bz2",
+        "a-2-0.tar.bz2",
+        "b-1-0.tar.bz2",
+        "a-1-0.tar.bz2",
+    ]
+    assert name_index.filenames((10, 30)) == ["a-2-0.tar.bz2", "b-1-0.tar.bz2"]
+    assert name_index.filenames((None, 10)) == ["a-3-0.tar.bz2"]
+    assert name_index.filenames_matching("a", (20, None)) == ["a-1-0.tar.bz2"]
+
+    def _shortlist(if_block):
+        rule = PatchRule({"if": if_block, "then": []}, "foo.yaml")
+        return shortlist_relevant_filenames(name_index, rule)
+
+    assert _shortlist({"timestamp_lt": 20}) == ["a-3-0.tar.bz2", "a-2-0.tar.bz2"]
+    assert _shortlist({"timestamp_le": 20, "not_timestamp_lt": 10}) == [
+        "a-2-0.tar.bz2",
+        "b-1-0.tar.bz2",
+    ]
+    assert _shortlist({"name": "a", "timestamp_gt": 10}) == ["a-1-0.tar.bz2"]
+    assert _shortlist({"name_in": ["a", "b"], "timestamp_ge": 20}) == [
+        "a-1-0.tar.bz2",
+        "b-1-0.tar.bz2",
+    ]
+    assert _shortlist({"version": "1.0"}) == name_index.filenames()
+
+
+@pytest.mark.parametrize(
+    "if_block",
+    [
+        {"build_number_gt": 0},
+        {"build_number_in": [0, 2]},
+        {"not_build_number_in": [1]},
+        {"version_lt": "1.10", "timestamp_ge": 20},
+        {"not_version_ge": "1.2"},
+        {"version": "1.2.0"},
+        {"subdir_in": "linux-64", "not_name": "b"},
+        {"name_in": ["a", "c"], "build_number_le": 1},
+        {"not_subdir": "noarch"},
+        {"build": "py*"},
+    ],
+)
+def test_record_columns(if_block):
+    index = {
+        "a-1.2-py_0.tar.bz2": {
+            "name": "a",
+            "version": "1.2",
+            "build": "py_0",
+            "build_number": 0,
+            "subdir": "noarch",
+            "timestamp": 30,
+        },
+        "a-1.10-py_1.tar.bz2": {
+            "name": "a",
+            "version": "1.10",
+            "build": "py_1",
+            "build_number": 1,
+            "subdir": "noarch",
+            "timestamp": 10,
+        },
+        "b-1.2.0-h1_2.tar.bz2": {
+            "name": "b",
+            "version": "1.2.0",
+            "build": "h1_2",
+            "build_number": 2,
+            "subdir": "linux-64",
+        },
+        "c-0.9-h1_0.tar.bz2": {
+            "name": "c",
+            "version": "0.9",
+            "build": "h1_0",
+            "build_number": 0,
+            "subdir": "linux-64",
+            "timestamp": 20,
+        },
+    }
+    versions = VersionOrdinals.from_indexes(index)
+    ctx = PatchContext("linux-64", versions=versions)
+    name_index = NameIndex(index)
+    columns = RecordColumns(index, name_index.fns, versions)
+    rule = PatchRule({"if": if_block, "then": []}, "foo.yaml")
+
+    shortlist = shortlist_relevant_filenames(name_index, rule, columns=columns)
+    assert set(shortlist) <= set(name_index.filenames())
+    assert sorted(fn for fn in shortlist if rule.test(index[fn], ctx, fn)) == sorted(
+        fn for fn in index if rule.test(index[fn], ctx, fn)
+    )
+
+
+def _fixture_index(subdir):
+    """Records for every package name the patch rules select on exactly."""
+    names = sorted(
+        {
+            str(name)
+            for rule in ALL_RULES
+            for key in ["name", "name_in"]
+            for name in (
+                rule.patch_yaml["if"].get(key)
+                if isinstance(rule.patch_yaml["if"].get(key), list)
+                else [rule.patch_yaml["if"].get(key)]
+            )
+            if name is not None and "*" not in str(name)
+        }
+    )
+    deps = [
+        "python >=3.8,<3.9.0a0",
+        "python_abi 3.10.* *_cp310",
+        "numpy >=1.21.6,<2.0a0",
+        "libgcc-ng >=12",
+        "openssl >=3.0.0,<4.0a0",
+        "setuptools",
+        "jaxlib >=0.4.1",
+        "cudatoolkit >=11.2,<12",
+    ]
+    index = {}
+    for i, name in enumerate(names + ["foo-bar", "python", "r-base"]):
+        for j, version in enumerate(["0.9", "1.2.0", "2.5.0", "3.11.4"]):
+            build = "py%d_h%d_%d" % (38 + j, i % 7, j)
+            fn = "%s-%s-%s.tar.bz2" % (name, version, build)
+            index[fn] = {
+                "name": name,
+                "version": version,
+                "build": build,
+                "build_number": j,
+                "subdir": subdir,
+                "timestamp": 1500000000000 + 30000000000 * j + 1000 * i,
+                "depends": deps[(i + j) % 5 : (i + j) % 5 + 1 + (i % 4)],
+                "constrains": deps[j : j + 1],
+                "license": "MIT",
+            }
+    return index
+
+
+@pytest.mark.parametrize("subdir", ["noarch", "linux-64", "osx-arm64", "win-64"])
+def test_patch_yaml_edit_index_engines(subdir):
+    index = _fixture_index(subdir)
+    rules_index = patch_yaml_edit_index(copy.deepcopy(index), subdir, engine="rules")
+    records_index = patch_yaml_edit_index(
+        copy.deepcopy(index), subdir, engine="records"
+    )
+    assert records_index == rules_index
+    assert rules_index != index
+
+
+def test_rule_table():
+    table = rule_table("linux-64")
+    for name in ["python", "numpy", "foo-bar"]:
+        candidates = table.candidates(name)
+        assert candidates == [rule for rule in ALL_RULES if rule in candidates]
+    assert all(
+        "subdir_in" not in rule.patch_yaml["if"]
+        or "linux-64" in rule.patch_yaml["if"]["subdir_in"]
+        for rule in table.candidates("python")
+    )
+    with pytest.raises(ValueError):
+        patch_yaml_edit_index({}, "linux-64", engine="foo")
+
+
+def test_if_clause_memo():
+    ctx = PatchContext("linux-64")
+    has_rule = PatchRule(
+        {"if": {"has_depends": ["numpy*", "python?( *)"]}, "then": []}, "foo.yaml"
+    )
+    not_has_rule = PatchRule(
+        {"if": {"not_has_depends": "python?( *)"}, "then": []}, "foo.yaml"
+    )
+    records = [
+        {"depends": ["python >=3.8", "numpy >=1.21"]},
+        {"depends": ["python >=3.8", "numpy-base"]},
+        {"depends": ["python >=3.8"]},
+        {"depends": ["pythonnet", "numpy"]},
+        {"depends": []},
+        {},
+    ]
+    for _ in range(2):
+        assert [has_rule.test(r, ctx, "fn") for r in records] == [
+            True,
+            True,
+            False,
+            False,
+            False,
+            False,
+        ]
+        assert [not_has_rule.test(r, ctx, "fn") for r in records] == [
+            False,
+            False,
+            False,
+            True,
+            True,
+            True,
+        ]
+    assert ctx.memo[("has", ("numpy*", "python?( *)"))]["python >=3.8"] == 2
+    assert ctx.memo[("has", ("python?( *)",))]["pythonnet"] == 0
+
+    empty_rule = PatchRule({"if": {"has_depends": []}, "then": []}, "foo.yaml")
+    assert empty_rule.test({"depends": []}, ctx, "fn")
+
+
+def test_rewrite_cache():
+    ctx = PatchContext("linux-64")
+    rule = PatchRule(
+        {
+            "if": {"name": "foo"},
+            "then": [
+                {"tighten_depends": {"name": "numpy", "max_pin": "x.x"}},
+                {
+                    "replace_depends": {
+                        "old": "python >=3.8",
+                        "new": "python >=3.8,<${next_version}.0a0",
+                    }
+                },
+            ],
+        },
+        "foo.yaml",
+    )
+    records = [
+        {"name": "foo", "version": "3.9", "depends": ["numpy >=1.21", "python >=3.8"]}
+        for _ in range(3)
+    ]
+    records[2]["version"] = "3.10"
+    for record in records:
+        rule.apply(record, ctx, "fn")
+    assert records[0]["depends"] == ["numpy >=1.21,<1.22.0a0", "python >=3.8,<3.10.0a0"]
+    assert records[1]["depends"] == records[0]["depends"]
+    assert records[1]["depends"] is not records[0]["depends"]
+    assert all(a is b for a, b in zip(records[0]["depends"], records[1]["depends"]))
+    assert records[2]["depends"] == [
+        "numpy >=1.21,<1.22.0a0",
+        "python >=3.8,<3.11.0a0",
+    ]
+    # tighten_depends has no template input, replace_depends reads the version
+    assert len(ctx.rewrites) == 3
+
+    record = {"name": "foo", "version": "3.9"}
+    rule.apply(record, ctx, "fn")
+    assert "depends" not in record
+
+
 def test_schema_up_to_date():
     schema_on_disk = (Path(__file__).parent / ("patch_yaml_model.json")).read_text()
     schema_str = generate_schema(write=False)
@@ -0,0 +1,415 @@
+import bz2
+import copy
+import difflib
+import io
+import json
+import os
+
+import pytest
+
+from conda_index.index import _apply_instructions
+from show_diff import (
+    _MISSING,
+    _JSONStream,
+    apply_instructions_view,
+    instructions_record_diffs,
+    iter_repodata_records,
+    load_patch_instructions,
+    load_repodata_digests,
+    print_spilled_diffs,
+    record_diff_key,
+    record_digest,
+    render_record_diff,
+    repodata_digests,
+    show_record_diffs,
+    sort_lists,
+    spill_record_diffs,
+)
+
+
+def _record(depends, **kwargs):
+    record = {"name": "foo", "version": "1.0", "build_number": 0, "depends": depends}
+    record.update(kwargs)
+    return record
+
+
+def test_record_diff_key():
+    ref = _record(["a", "b"], license_family="MIT")
+    assert record_diff_key(ref, _record(["b", "a"])) is None
+    assert record_diff_key(ref, _record(["a", "c"])) == (
+        ("depends", (True, True), (("-", "b", True), ("+", "c", True))),
+    )
+    assert record_diff_key(ref, _record(["a", "a", "b"])) == (
+        ("depends", (True, True), ("json", '["a", "b"]'), ("json", '["a", "a", "b"]')),
+    )
+    assert record_diff_key(ref, _record(["a", "b"], build_number=1)) == (
+        ("build_number", (True, True), 0, 1),
+    )
+    # version is the last key, the line of name gets or loses its comma
+    assert record_diff_key(ref, {**_record(["a", "b"]), "version": None}) == (
+        ("version", (False, False), "1.0", None),
+    )
+    no_version = _record(["a", "b"])
+    del no_version["version"]
+    assert record_diff_key(ref, no_version) == (
+        ("name", (True, False), "foo", "foo"),
+        ("version", (False, True), "1.0", _MISSING),
+    )
+
+
+def test_record_diff_key_list_position():
+    # the same spec is removed from all three records, but only when it was
+    # the last one does the diff show its neighbour losing the comma
+    ref_repodata = {
+        "packages": {
+            "foo-1.0-0.tar.bz2": _record(["x", "z"]),
+            "foo-1.0-1.tar.bz2": _record(["a0", "x"]),
+            "foo-1.0-2.tar.bz2": _record(["w", "x", "y"]),
+        },
+        "packages.conda": {},
+    }
+    new_repodata = {
+        "packages": {
+            "foo-1.0-0.tar.bz2": _record(["z"]),
+            "foo-1.0-1.tar.bz2": _record(["a0"]),
+            "foo-1.0-2.tar.bz2": _record(["w", "y"]),
+        },
+        "packages.conda": {},
+    }
+    keys = {
+        fn: record_diff_key(ref_repodata["packages"][fn], new_repodata["packages"][fn])
+        for fn in ref_repodata["packages"]
+    }
+    assert keys["foo-1.0-0.tar.bz2"] == keys["foo-1.0-2.tar.bz2"]
+    assert keys["foo-1.0-0.tar.bz2"] != keys["foo-1.0-1.tar.bz2"]
+
+    diffs = show_record_diffs("noarch", ref_repodata, new_repodata, False)
+    assert diffs == {
+        ('-    "x",',): {"noarch::foo-1.0-0.tar.bz2", "noarch::foo-1.0-2.tar.bz2"},
+        ('-    "a0",', '-    "x"', '+    "a0"'): {"noarch::foo-1.0-1.tar.bz2"},
+    }
+    for fn in ref_repodata["packages"]:
+        lines = render_record_diff(
+            ref_repodata["packages"][fn], new_repodata["packages"][fn]
+        )
+        assert f"noarch::{fn}" in diffs[tuple(lines)]
+
+
+def test_show_record_diffs():
+    ref_repodata = {
+        "packages": {
+            "foo-1.0-0.tar.bz2": _record(["a", "b"]),
+            "foo-1.0-1.tar.bz2": _record(["b", "c", "a"]),
+            "foo-1.0-2.tar.bz2": _record(["a", "b"], license_family="MIT"),
+        },
+        "packages.conda": {"foo-1.0-0.conda": _record(["a"], constrains=["x"])},
+    }
+    new_repodata = {
+        "packages": {
+            "foo-1.0-0.tar.bz2": _record(["a"]),
+            "foo-1.0-1.tar.bz2": _record(["a", "c"]),
+            "foo-1.0-2.tar.bz2": _record(["b", "a"]),
+        },
+        "packages.conda": {"foo-1.0-0.conda": _record(["a"], constrains=["y"])},
+    }
+
+    diffs = show_record_diffs("noarch", ref_repodata, new_repodata, False)
+    assert diffs == {
+        ('-    "a",', '-    "b"', '+    "a"'): {"noarch::foo-1.0-0.tar.bz2"},
+        ('-    "b",',): {"noarch::foo-1.0-1.tar.bz2"},
+        ('-    "x"', '+    "y"'): {"noarch::foo-1.0-0.conda"},
+    }
+
+    lines = show_record_diffs(
+        "noarch", ref_repodata, new_repodata, False, group_diffs=False
+    )
+    assert lines[0] == "noarch::foo-1.0-0.tar.bz2"
+    assert len(lines) == 3 * 2 + 3
+
+    diffs = show_record_diffs("noarch", ref_repodata, new_repodata, True)
+    assert diffs == {
+        tuple(
+            render_record_diff(
+                ref_repodata["packages"]["foo-1.0-0.tar.bz2"],
+                new_repodata["packages"]["foo-1.0-0.tar.bz2"],
+            )
+        ): {"noarch::foo-1.0-0.tar.bz2"}
+    }
+
+
+def test_spill_record_diffs(tmp_path, capsys):
+    diffs = {("-a", "+b"): {"noarch::foo-1.0-0.tar.bz2"}, ("-c",): {"noarch::x"}}
+    path = str(tmp_path / "noarch.diff")
+    assert spill_record_diffs(diffs, path)
+    print_spilled_diffs(path)
+    spilled = capsys.readouterr().out
+    assert not (tmp_path / "noarch.diff").exists()
+
+    # the lines are printed as the workers used to print them
+    for key, names in diffs.items():
+        for name in names:
+            print(name)
+        for line in key:
+            print(line)
+    assert spilled == capsys.readouterr().out
+
+    assert spill_record_diffs(["noarch::x", "-c"], path)
+    print_spilled_diffs(path)
+    assert capsys.readouterr().out == "noarch::x\n-c\n"
+
+    assert not spill_record_diffs({}, path)
+    print_spilled_diffs(path)
+    assert capsys.readouterr().out == ""
+
+
+def _baseline_grouped_diffs(subdir, ref_repodata, new_repodata):
+    # the grouping of show_record_diffs before it compared records by key
+    final_lines = {}
+    for index_key in ["packages", "packages.conda"]:
+        for name, ref_pkg in ref_repodata[index_key].items():
+            ref_pkg = copy.deepcopy(ref_pkg)
+            new_pkg = copy.deepcopy(new_repodata[index_key].get(name, {}))
+            ref_pkg.pop("license_family", None)
+            new_pkg.pop("license_family", None)
+            ref_pkg = sort_lists(ref_pkg)
+            new_pkg = sort_lists(new_pkg)
+            if ref_pkg == new_pkg:
+                continue
+            ref_lines = json.dumps(ref_pkg, indent=2, sort_keys=True).splitlines()
+            new_lines = json.dumps(new_pkg, indent=2, sort_keys=True).splitlines()
+            key = tuple(
+                ln
+                for ln in difflib.unified_diff(ref_lines, new_lines, n=0, lineterm="")
+                if not ln.startswith(("+++", "---", "@@"))
+            )
+            final_lines.setdefault(key, set()).add(f"{subdir}::{name}")
+    return final_lines
+
+
+def test_show_record_diffs_baseline():
+    # the same specs are removed and added, but the trailing commas and empty
+    # lists make the records render differently
+    changes = [
+        (["x", "z"], ["z"]),
+        (["a0", "x"], ["a0"]),
+        (["x"], []),
+        (["x", "z"], ["z"]),
+        ([], ["x"]),
+        (["a0"], ["a0", "x"]),
+        (["z"], ["x", "z"]),
+        (["a0", "y"], ["a0", "x"]),
+        (["y", "z"], ["x", "z"]),
+        (["x"], ["x", "x"]),
+    ]
+    ref_repodata = {"packages": {}, "packages.conda": {}}
+    new_repodata = {"packages": {}, "packages.conda": {}}
+    for i, (ref, new) in enumerate(changes):
+        fn = "foo-1.0-%d.tar.bz2" % i
+        ref_repodata["packages"][fn] = _record(ref, build_number=i, constrains=ref)
+        new_repodata["packages"][fn] = _record(new, build_number=i, constrains=ref)
+        fn = "foo-1.0-%d.conda" % i
+        ref_repodata["packages.conda"][fn] = _record(["a"], build_number=i)
+        new_repodata["packages.conda"][fn] = _record(["a"], constrains=new)
+    new_repodata["packages.conda"].pop("foo-1.0-0.conda")
+    # a list added after another list, difflib places its closing line by the
+    # length of the unchanged lines around it
+    for deps in [["a"], ["a", "b", "c", "d", "e"]]:
+        fn = "bar-1.0-%d.tar.bz2" % len(deps)
+        ref_repodata["packages"][fn] = _record(deps)
+        new_repodata["packages"][fn] = _record(deps, build_number=1, license=["q"])
+
+    diffs = show_record_diffs("noarch", ref_repodata, new_repodata, False)
+    assert diffs == _baseline_grouped_diffs("noarch", ref_repodata, new_repodata)
+    assert len(diffs) > 12
+    assert diffs[('-    "x",',)] == {
+        "noarch::foo-1.0-0.tar.bz2",
+        "noarch::foo-1.0-3.tar.bz2",
+    }
+
+
+def test_record_digest():
+    ref = _record(["a", "b"], license_family="MIT")
+    assert record_digest(ref) == record_digest(_record(["b", "a"]))
+    assert record_digest(ref) != record_digest(_record(["a", "a", "b"]))
+    assert record_digest(ref) != record_digest(_record(["a", "b"], build_number=1))
+
+
+def test_load_repodata_digests(tmp_path):
+    repodata = {"packages": {"foo-1.0-0.tar.bz2": _record(["a"])}, "packages.conda": {}}
+    path = str(tmp_path / "repodata.json.bz2")
+    with bz2.open(path, "wt") as fh:
+        json.dump(repodata, fh)
+
+    digests = load_repodata_digests(path, repodata)
+    assert digests == repodata_digests(repodata)
+    assert digests["packages.conda"] == {}
+    assert os.stat(path + ".digests.json").st_mode & 0o777 == 0o644
+
+    # the cached digests are used as long as the repodata file is unchanged
+    repodata["packages"]["foo-1.0-0.tar.bz2"]["depends"] = ["b"]
+    assert load_repodata_digests(path, repodata) == digests
+
+    with bz2.open(path, "wt") as fh:
+        json.dump(repodata, fh, indent=2)
+    assert load_repodata_digests(path, repodata) == repodata_digests(repodata)
+    assert load_repodata_digests(path, repodata) != digests
+
+    # the ref digests only short-circuit the comparison
+    new_repodata = {
+        "packages": {"foo-1.0-0.tar.bz2": _record(["b", "c"])},
+        "packages.conda": {},
+    }
+    ref_digests = load_repodata_digests(path, repodata)
+    diffs = show_record_diffs(
+        "noarch", repodata, new_repodata, False, ref_digests=ref_digests
+    )
+    assert list(diffs.values()) == [{"noarch::foo-1.0-0.tar.bz2"}]
+
+
+STREAM_REPODATA = {
+    "info": {"subdir": "noarch"},
+    "packages": {
+        "foo-1.0-%d.tar.bz2" % i: _record(["a", 'b \\" }'], build_number=i)
+        for i in range(20)
+    },
+    "packages.conda": {},
+    "removed": ["bar-1.0-0.tar.bz2"],
+    "repodata_version": 12345,
+}
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_json_stream(indent, chunk_size):
+    stream = _JSONStream(
+        io.StringIO(json.dumps(STREAM_REPODATA, indent=indent)), chunk_size=chunk_size
+    )
+    parsed = {}
+    for key in stream.members():
+        if key.startswith("packages"):
+            parsed[key] = {fn: stream.value() for fn in stream.members()}
+        else:
+            parsed[key] = stream.value()
+    assert parsed == STREAM_REPODATA
+    assert list(parsed) == list(STREAM_REPODATA)
+    assert list(parsed["packages"]) == list(STREAM_REPODATA["packages"])
+
+
+def test_iter_repodata_records(tmp_path):
+    path = str(tmp_path / "repodata.json.bz2")
+    with bz2.open(path, "wt") as fh:
+        json.dump(STREAM_REPODATA, fh)
+
+    records = list(iter_repodata_records(path))
+    assert records == [
+        ("packages", fn, record) for fn, record in STREAM_REPODATA["packages"].items()
+    ]
+
+    new_repodata = json.loads(json.dumps(STREAM_REPODATA))
+    new_repodata["packages"]["foo-1.0-3.tar.bz2"]["depends"] = ["a"]
+    assert show_record_diffs(
+        "noarch", iter_repodata_records(path), new_repodata, False
+    ) == show_record_diffs("noarch", STREAM_REPODATA, new_repodata, False)
+
+
+def test_instructions_record_diffs(tmp_path):
+    raw_repodata = {"packages": {}, "packages.conda": {}}
+    for i in range(6):
+        for ext in [".tar.bz2", ".conda"]:
+            raw_repodata["packages" if ext == ".tar.bz2" else "packages.conda"][
+                "foo-1.0-%d%s" % (i, ext)
+            ] = _record(["a"], build_number=i)
+    ref_instructions = {
+        "packages": {
+            "foo-1.0-0.tar.bz2": {"depends": ["a", "b"]},
+            "foo-1.0-1.tar.bz2": {"license": "MIT"},
+        },
+        "packages.conda": {"foo-1.0-2.conda": {"depends": []}},
+        "revoke": ["foo-1.0-3.tar.bz2"],
+        "remove": [],
+    }
+    new_instructions = {
+        "packages": {
+            "foo-1.0-0.tar.bz2": {"depends": ["a", "b"]},
+            "foo-1.0-1.tar.bz2": {"license": None},
+        },
+        "packages.conda": {},
+        "revoke": [],
+        "remove": ["foo-1.0-4.tar.bz2"],
+    }
+
+    subdir_dir = tmp_path / "noarch"
+    subdir_dir.mkdir()
+    (subdir_dir / "patch_instructions.json").write_text(json.dumps(ref_instructions))
+    assert load_patch_instructions(str(tmp_path), "noarch") == ref_instructions
+
+    diffs = instructions_record_diffs(
+        "noarch", raw_repodata, ref_instructions, new_instructions, False
+    )
+    ref_repodata = _apply_instructions(
+        "noarch", copy.deepcopy(raw_repodata), copy.deepcopy(ref_instructions)
+    )
+    new_repodata = _apply_instructions(
+        "noarch", copy.deepcopy(raw_repodata), copy.deepcopy(new_instructions)
+    )
+    assert diffs == show_record_diffs("noarch", ref_repodata, new_repodata, False)
+    assert set().union(*diffs.values()) == {
+        "noarch::foo-1.0-%d%s" % (i, ext)
+        for i in [1, 3, 4]
+        for ext in [".tar.bz2", ".conda"]
+    } | {"noarch::foo-1.0-2.conda"}
+    assert raw_repodata["packages"]["foo-1.0-3.tar.bz2"]["depends"] == ["a"]
+
+
+def test_apply_instructions_view():
+    repodata = {"info": {"subdir": "noarch"}, "packages": {}, "packages.conda": {}}
+    for i in range(8):
+        repodata["packages"]["foo-1.0-%d.tar.bz2" % i] = _record(
+            ["a"], build_number=i, license="MIT", extra={"x": 1, "y": 2}
+        )
+        repodata["packages.conda"]["foo-1.0-%d.conda" % i] = _record(
+            ["a"], build_number=i
+        )
+    repodata["packages"]["empty-1.0-0.tar.bz2"] = {}
+    instructions = {
+        "patch_instructions_version": 1,
+        "packages": {
+            "foo-1.0-0.tar.bz2": {"depends": ["a", "b"], "license": None},
+            "foo-1.0-1.tar.bz2": {"license_family": None, "extra": {"y": 3}},
+            "foo-1.0-2.tar.bz2": {"constrains": ["c"]},
+            "missing-1.0-0.tar.bz2": {"depends": []},
+        },
+        "packages.conda": {
+            "foo-1.0-2.conda": {"constrains": ["d"], "build_number": 10},
+            "foo-1.0-3.conda": {"depends": ["e"]},
+        },
+        "revoke": ["foo-1.0-3.tar.bz2", "foo-1.0-4.tar.bz2", "foo-1.0-4.tar.bz2"],
+        "remove": [
+            "foo-1.0-5.tar.bz2",
+            "foo-1.0-6.conda",
+            "foo-1.0-6.conda",
+            "empty-1.0-0.tar.bz2",
+            "missing-1.0-0.tar.bz2",
+        ],
+    }
+    raw = copy.deepcopy(repodata)
+
+    view = apply_instructions_view("noarch", repodata, instructions)
+    expected = _apply_instructions(
+        "noarch", copy.deepcopy(repodata), copy.deepcopy(instructions)
+    )
+    assert repodata == raw
+    assert set(view) == set(expected)
+    for key, value in expected.items():
+        if key.startswith("packages"):
+            assert list(view[key]) == list(value)
+            assert len(view[key]) == len(value)
+            assert dict(view[key].items()) == value
+            assert all(fn in view[key] for fn in value)
+            assert "foo-1.0-5.tar.bz2" not in view[key]
+        else:
+            assert view[key] == value
+    assert (
+        view["packages"]["foo-1.0-7.tar.bz2"]
+        is repodata["packages"]["foo-1.0-7.tar.bz2"]
+    )
@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from subdir_schedule import (
+    MEMORY_PER_COMPRESSED_BYTE,
+    SubdirScheduler,
+    estimate_costs,
+    parse_memory,
+    read_stats,
+    repodata_sizes,
+    run_stats,
+    schedule_order,
+    write_stats,
+)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [("1000", 1000), ("512M", 512 << 20), ("1.5g", 3 << 29), ("8GB", 8 << 30)],
+)
+def test_parse_memory(value, expected):
+    assert parse_memory(value) == expected
+
+
+def test_estimate_costs(tmp_path):
+    cache_dir = tmp_path / "cache"
+    for subdir, size in [("linux-64", 300), ("noarch", 200), ("win-64", 100)]:
+        (cache_dir / subdir).mkdir(parents=True)
+        (cache_dir / subdir / "repodata_from_packages.json.bz2").write_bytes(
+            b"x" * size
+        )
+    subdirs = ["noarch", "win-64", "linux-64", "osx-64"]
+    sizes = repodata_sizes(subdirs, "file:///nonexistent", str(cache_dir))
+    assert sizes == {"linux-64": 300, "noarch": 200, "win-64": 100}
+
+    # by size, with the largest known size for the unknown ones
+    costs = estimate_costs(subdirs, sizes, {})
+    assert costs["osx-64"] == costs["linux-64"]
+    assert costs["win-64"] == (100, 100 * MEMORY_PER_COMPRESSED_BYTE)
+    assert schedule_order(subdirs, costs) == ["linux-64", "osx-64", "noarch", "win-64"]
+
+    # by the run times of the previous run, or the average time per byte
+    stats = {
+        "noarch": {"seconds": 60.0, "size": 200},
+        "win-64": {"seconds": 20.0, "size": 100},
+    }
+    costs = estimate_costs(subdirs, sizes, stats)
+    assert costs["linux-64"][0] == pytest.approx(80 / 300 * 300)
+    assert schedule_order(subdirs, costs) == ["linux-64", "osx-64", "noarch", "win-64"]
+
+    seconds = {("prepare", "noarch"): 1.0, (0, "noarch"): 2.0, ("subdir", "win-64"): 3}
+    new_stats = run_stats(subdirs, sizes, stats, seconds)
+    assert new_stats == {
+        "noarch": {"seconds": 3.0, "size": 200},
+        "win-64": {"seconds": 3, "size": 100},
+    }
+    path = str(tmp_path / "stats.json")
+    write_stats(stats, path)
+    write_stats(new_stats, path)
+    assert read_stats(path) == new_stats
+    assert os.stat(path).st_mode & 0o777 == 0o644
+    assert read_stats(str(tmp_path / "missing.json")) == {}
+
+
+def test_subdir_scheduler():
+    lock = threading.Lock()
+    running = []
+    started = []
+    peak = []
+
+    def _job(name, memory):
+        with lock:
+            running.append(memory)
+            started.append(name)
+            peak.append(sum(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(memory)
+        return name
+
+    with ThreadPoolExecutor(max_workers=4) as exc:
+        scheduler = SubdirScheduler(exc, 4, max_memory=10)
+        for name, priority, memory in [
+            ("a", 3, 12),
+            ("c", 1, 4),
+            ("b", 2, 6),
+            ("d", 1, 4),
+            ("e", 0, 1),
+        ]:
+            scheduler.submit(("subdir", name), priority, memory, _job, name, memory)
+        order = [fut.result() for _, fut in scheduler.as_completed()]
+
+    # "a" is larger than the budget and runs alone, the others wait for it
+    # and start by priority
+    assert order[0] == "a"
+    assert started[:2] == ["a", "b"]
+    assert sorted(order) == ["a", "b", "c", "d", "e"]
+    assert peak[0] == 12 and max(peak[1:]) <= 10
+    assert set(scheduler.seconds) == {("subdir", name) for name in order}